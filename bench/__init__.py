@@ -0,0 +1,5 @@
+"""
+An offline benchmark of the servers: the real servers run with a fake model and a fake vector store,
+so the throughput of everything around the model can be measured without a 7B model or Weaviate.
+    python -m bench --clients 8 --requests 10
+"""
@@ -0,0 +1,97 @@
+import argparse
+import http.client
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from bench.load import run_http, run_websocket
+
+"""
+Starts every server under test with the fakes, waits for /ready, runs the load and prints
+the results as json, so two runs can be compared by a script.
+"""
+
+PORTS = {
+    'http': 9000,
+    'websocket': 9001,
+}
+
+def wait_ready(port: int, timeout: float=120):
+    """Poll /ready until the server answers 200."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection("localhost", port, timeout=5)
+            connection.request("GET", "/ready")
+            response = connection.getresponse()
+            response.read()
+            connection.close()
+            if response.status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError(f"The server on port {port} was not ready in {timeout}s")
+
+def run(protocol: str, args) -> dict:
+    """Run the server of a protocol in its own process and put the load on it."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env.update({
+        'PYTHONPATH': root + os.pathsep + env.get('PYTHONPATH', ""),
+        'BENCH_TOKENS_PER_SECOND': str(args.tokens_per_second),
+        'BENCH_PREFILL_MS': str(args.prefill_ms),
+        'BENCH_MAX_TOKENS': str(args.max_tokens),
+        'BENCH_STORE_LATENCY_MS': str(args.store_latency_ms),
+        'WS_COMPRESSION': args.compression,
+    })
+    # A folder of its own, so the settings, the .env and the memories of the checkout are not used
+    with tempfile.TemporaryDirectory() as folder:
+        process = subprocess.Popen([sys.executable, "-m", "bench.serve", protocol], cwd=folder, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL)
+        try:
+            wait_ready(PORTS[protocol])
+            if protocol == 'http':
+                return run_http("localhost", PORTS[protocol], args.clients, args.requests)
+            return run_websocket(f"ws://localhost:{PORTS[protocol]}", args.clients, args.requests,
+                                 f"memorylane.{args.wire}")
+        finally:
+            process.send_signal(signal.SIGINT)
+            try:
+                process.wait(30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the servers with a fake model and vector store")
+    parser.add_argument("--protocol", choices=["http", "websocket", "both"], default="both")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent clients")
+    parser.add_argument("--requests", type=int, default=10, help="requests per client")
+    parser.add_argument("--tokens-per-second", type=float, default=20, help="decode speed of the fake model")
+    parser.add_argument("--prefill-ms", type=float, default=0.5, help="prefill cost of a prompt token")
+    parser.add_argument("--max-tokens", type=int, default=32, help="tokens generated per request")
+    parser.add_argument("--store-latency-ms", type=float, default=5, help="latency of a vector store call")
+    parser.add_argument("--wire", choices=["json", "msgpack"], default="json",
+                        help="the subprotocol of the websocket clients, python -m bench.wire compares their sizes")
+    parser.add_argument("--compression", choices=["deflate", "none"], default="deflate",
+                        help="permessage-deflate on the websocket server")
+    parser.add_argument("--output", help="also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the logs of the servers")
+    args = parser.parse_args()
+
+    protocols = ["http", "websocket"] if args.protocol == "both" else [args.protocol]
+    results = {
+        'config': {key: value for key, value in vars(args).items() if key not in ("output", "verbose")},
+        'results': {protocol: run(protocol, args) for protocol in protocols},
+    }
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+if __name__ == "__main__":
+    main()
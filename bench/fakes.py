@@ -0,0 +1,104 @@
+import threading
+import time
+import zlib
+from typing import Any, Dict, Iterable, List, Optional
+from uuid import uuid4
+from langchain.docstore.document import Document
+
+"""
+Fakes of the model and the vector store with a configurable cost, deterministic so two runs
+of the benchmark do the same work.
+"""
+
+WORDS = ("the", "memory", "lane", "is", "a", "long", "road", "and", "we", "walk", "it", "together")
+
+class FakeState:
+    """A saved llama state, what the scheduler and the KV cache read from one."""
+
+    def __init__(self, tokens: List[int], size: int):
+        self.input_ids = tokens
+        self.n_tokens = len(tokens)
+        self.llama_state_size = size
+
+class FakeLlamaClient:
+    """Stands in for llama_cpp.Llama: evaluates the tokens its context does not hold yet
+        at prefill_cost seconds each, then generates at tokens_per_second.
+    """
+
+    def __init__(self, tokens_per_second: float=20, prefill_cost: float=0.0005, state_size: int=1 << 20):
+        self.tokens_per_second = tokens_per_second
+        self.prefill_cost = prefill_cost
+        self.state_size = state_size
+        # The tokens the fake context holds
+        self._tokens: List[int] = []
+
+    def tokenize(self, text: bytes) -> List[int]:
+        """One token per word, BOS first like llama."""
+        return [1] + [zlib.crc32(word) & 0xffff for word in text.split()]
+
+    def save_state(self) -> FakeState:
+        return FakeState(list(self._tokens), self.state_size)
+
+    def load_state(self, state: FakeState):
+        self._tokens = list(state.input_ids)
+
+    def __call__(self, prompt: str, stream: bool=True, max_tokens: int=32, stop: Optional[List[str]]=None, **kwargs: Any):
+        tokens = self.tokenize(prompt.encode())
+        def generate():
+            shared = 0
+            for a, b in zip(self._tokens, tokens):
+                if a != b:
+                    break
+                shared += 1
+            time.sleep((len(tokens) - shared) * self.prefill_cost)
+            self._tokens = tokens
+            seed = zlib.crc32(prompt.encode())
+            for i in range(max_tokens):
+                time.sleep(1 / self.tokens_per_second)
+                word = WORDS[(seed + i) % len(WORDS)]
+                self._tokens.append(zlib.crc32(word.encode()) & 0xffff)
+                yield {"choices": [{"text": " " + word}]}
+        return generate()
+
+class FakeLlamaCpp:
+    """Stands in for langchain's LlamaCpp, only what the scheduler uses."""
+
+    def __init__(self, model_path: str="fake", max_tokens: int=32, temperature: float=0.8, seed: int=-1, **kwargs: Any):
+        self.model_path = model_path
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.seed = seed
+        self.client = FakeLlamaClient(**kwargs)
+
+    def _get_parameters(self, stop: Optional[List[str]]=None) -> Dict[str, Any]:
+        return {"max_tokens": self.max_tokens, "temperature": self.temperature, "stop": stop or []}
+
+class FakeVectorStore:
+    """An in-memory vector store that takes latency seconds per call and returns the newest memories."""
+
+    def __init__(self, latency: float=0.005):
+        self.latency = latency
+        self._memories: Dict[Any, List[Document]] = {}
+        self._lock = threading.Lock()
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]]=None, **kwargs: Any) -> List[str]:
+        time.sleep(self.latency)
+        ids = []
+        with self._lock:
+            for i, text in enumerate(texts):
+                metadata = dict(metadatas[i]) if metadatas is not None else {}
+                metadata["id"] = str(uuid4())
+                self._memories.setdefault(metadata.get("namespace"), []).append(Document(page_content=text, metadata=metadata))
+                ids.append(metadata["id"])
+        return ids
+
+    def similarity_search(self, query: str, k: int=4, **kwargs: Any) -> List[Document]:
+        time.sleep(self.latency)
+        with self._lock:
+            return list(self._memories.get(kwargs.get("namespace"), [])[-k:])
+
+    def delete(self, ids: Iterable[str], **kwargs: Any):
+        ids = set(ids)
+        with self._lock:
+            for namespace, memories in self._memories.items():
+                self._memories[namespace] = [doc for doc in memories if doc.metadata["id"] not in ids]
@@ -0,0 +1,151 @@
+import asyncio
+import http.client
+import json
+import threading
+import time
+from typing import Any, Dict, List, Optional
+import websockets
+from client.client import Client
+from server.codec import get_codec
+
+"""
+The load generator: N clients, each sending its requests one after the other, over the
+websocket server or the http server (as Server-Sent Events, so the first token can be timed).
+Every request gives a sample: its latency, its time to first token, its token count and, over
+the websocket, the payload bytes of its responses.
+"""
+
+def build_request(client_id: int, turn: int) -> dict:
+    """The prompt request of a turn of a client, the same one the example client sends."""
+    chat_text = {
+        'user_name': "### {user_name}: {user_text}",
+        'ai_name': "### {ai_name}: {ai_text}",
+    }
+    complete_prompt = "This is a chat between an AI and a human.\n{history}\nChat:\n" \
+        + chat_text['user_name'] + "\n" + chat_text['ai_name']
+    return {
+        'chat_text': chat_text,
+        'complete_prompt': complete_prompt,
+        'args': {'history': ""},
+        'names': {'user_name': 'Human', 'ai_name': 'AI'},
+        'chat': {'user_text': f" Hello my friend, this is message {turn}!", 'ai_text': " "},
+        'user_id': f"bench-{client_id}",
+        'conversation_id': f"bench-{client_id}",
+        'stream': True,
+    }
+
+class BenchClient(Client):
+    """The example client without the print of every message, in any subprotocol."""
+
+    async def connect(self, uri, subprotocol: Optional[str]=None):
+        self.websocket = await websockets.connect(uri, subprotocols=[subprotocol] if subprotocol else None)
+        self.codec = get_codec(self.websocket.subprotocol)
+
+    async def receive_message(self):
+        return await self.websocket.recv()
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    """The average and the p50, p95 and p99 of the values."""
+    if not values:
+        return {'avg': None, 'p50': None, 'p95': None, 'p99': None}
+    values = sorted(values)
+    def at(q: float) -> float:
+        return values[min(len(values) - 1, int(q * len(values)))]
+    return {'avg': sum(values) / len(values), 'p50': at(0.5), 'p95': at(0.95), 'p99': at(0.99)}
+
+def summarize(samples: List[Dict[str, Any]], wall: float) -> Dict[str, Any]:
+    """The throughput and the latency percentiles of a run."""
+    ok = [sample for sample in samples if sample['error'] is None]
+    tokens = sum(sample['tokens'] for sample in ok)
+    received = sum(sample.get('bytes', 0) for sample in ok)
+    return {
+        'requests': len(samples),
+        'errors': len(samples) - len(ok),
+        'seconds': wall,
+        'requests_per_second': len(ok) / wall if wall else None,
+        'tokens_per_second': tokens / wall if wall else None,
+        'latency': percentiles([sample['latency'] for sample in ok]),
+        'ttft': percentiles([sample['ttft'] for sample in ok if sample['ttft'] is not None]),
+        'bytes_per_token': received / tokens if received and tokens else None,
+    }
+
+async def websocket_client(uri: str, client_id: int, requests: int, samples: List[Dict[str, Any]],
+                           subprotocol: Optional[str]=None):
+    for turn in range(requests):
+        start = time.perf_counter()
+        sample = {'latency': None, 'ttft': None, 'tokens': 0, 'bytes': 0, 'error': None}
+        client = BenchClient()
+        try:
+            # The server answers one prompt per connection
+            await client.connect(uri, subprotocol)
+            await client.send_message(client.codec.encode_request(build_request(client_id, turn)))
+            while True:
+                message = await client.receive_message()
+                sample['bytes'] += len(message.encode() if isinstance(message, str) else message)
+                response = client.codec.decode_response(message)
+                if response['status'] == 0:
+                    if sample['ttft'] is None:
+                        sample['ttft'] = time.perf_counter() - start
+                    continue
+                if response['status'] != 23:
+                    sample['error'] = response.get('error') or "error status"
+                else:
+                    sample['tokens'] = len(response['chat']['ai_text'].split())
+                break
+            await client.disconnect()
+        except Exception as e:
+            sample['error'] = str(e)
+        sample['latency'] = time.perf_counter() - start
+        samples.append(sample)
+
+def http_client(host: str, port: int, client_id: int, requests: int, samples: List[Dict[str, Any]]):
+    connection = http.client.HTTPConnection(host, port, timeout=300)
+    for turn in range(requests):
+        start = time.perf_counter()
+        sample = {'latency': None, 'ttft': None, 'tokens': 0, 'error': None}
+        try:
+            body = json.dumps(build_request(client_id, turn))
+            connection.request("GET", "/prompt", body=body,
+                               headers={'Content-Type': "application/json", 'Accept': "text/event-stream"})
+            response = connection.getresponse()
+            if response.status != 200:
+                response.read()
+                raise RuntimeError(f"HTTP {response.status}")
+            for line in response:
+                if not line.startswith(b"data: "):
+                    continue
+                event = json.loads(line[6:])
+                if event['status'] == 0:
+                    if sample['ttft'] is None:
+                        sample['ttft'] = time.perf_counter() - start
+                elif event['status'] != 23:
+                    sample['error'] = event.get('error') or "error status"
+                else:
+                    sample['tokens'] = len(event['chat']['ai_text'].split())
+        except Exception as e:
+            sample['error'] = str(e)
+            connection.close()
+            connection = http.client.HTTPConnection(host, port, timeout=300)
+        sample['latency'] = time.perf_counter() - start
+        samples.append(sample)
+    connection.close()
+
+def run_websocket(uri: str, clients: int, requests: int, subprotocol: Optional[str]=None) -> Dict[str, Any]:
+    """Run the clients against the websocket server and summarize their samples."""
+    samples: List[Dict[str, Any]] = []
+    async def run():
+        await asyncio.gather(*(websocket_client(uri, i, requests, samples, subprotocol) for i in range(clients)))
+    start = time.perf_counter()
+    asyncio.run(run())
+    return summarize(samples, time.perf_counter() - start)
+
+def run_http(host: str, port: int, clients: int, requests: int) -> Dict[str, Any]:
+    """Run the clients against the http server and summarize their samples."""
+    samples: List[Dict[str, Any]] = []
+    threads = [threading.Thread(target=http_client, args=(host, port, i, requests, samples)) for i in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(samples, time.perf_counter() - start)
@@ -0,0 +1,45 @@
+import os
+import runpy
+import sys
+
+"""
+Runs one of the servers with the fakes in place of the model and the vector store.
+    python -m bench.serve http|websocket
+The fakes are configured with BENCH_TOKENS_PER_SECOND, BENCH_PREFILL_MS (per prompt token),
+BENCH_MAX_TOKENS and BENCH_STORE_LATENCY_MS, the rest of the server reads its usual variables.
+"""
+
+ENTRY_POINTS = {
+    'http': "main.py",
+    'websocket': "websocket_main.py",
+}
+
+def main():
+    if len(sys.argv) != 2 or sys.argv[1] not in ENTRY_POINTS:
+        print(f"Usage: python -m bench.serve {'|'.join(ENTRY_POINTS)}")
+        sys.exit(2)
+    import server.database
+    import server.models
+    from bench.fakes import FakeLlamaCpp, FakeVectorStore
+
+    def load_llm(model_path: str) -> FakeLlamaCpp:
+        return FakeLlamaCpp(
+            model_path,
+            max_tokens=int(os.getenv("BENCH_MAX_TOKENS", 32)),
+            tokens_per_second=float(os.getenv("BENCH_TOKENS_PER_SECOND", 20)),
+            prefill_cost=float(os.getenv("BENCH_PREFILL_MS", 0.5)) / 1000,
+        )
+    server.models.load_llm = load_llm
+    server.database.setup_vectorstore = lambda name, embeddings: FakeVectorStore(
+        float(os.getenv("BENCH_STORE_LATENCY_MS", 5)) / 1000)
+    # Nothing real is loaded, and nothing is printed per token
+    os.environ["MODEL_PATH"] = "fake"
+    os.environ["EMBEDDINGS"] = "weaviate"
+    os.environ["EMBEDDINGS_CACHE_PATH"] = ""
+    os.environ["COMPACTION_INTERVAL"] = "0"
+    os.environ["ECHO_TOKENS"] = "false"
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    runpy.run_path(os.path.join(root, ENTRY_POINTS[sys.argv[1]]), run_name="__main__")
+
+if __name__ == "__main__":
+    main()
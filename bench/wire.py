@@ -0,0 +1,69 @@
+import argparse
+import json
+import zlib
+from typing import Any, Dict, List
+from bench.fakes import WORDS
+from server.codec import get_codec, subprotocols
+from server.protocol import SERVER_CODES, PromptResponse
+
+"""
+The bytes the websocket server puts on the wire per token, for every subprotocol with and
+without permessage-deflate. The responses of a request are written like the server writes
+them: a running frame per tokens_per_frame tokens, then the final response.
+    python -m bench.wire
+Compression is done like permessage-deflate does it: raw deflate with a shared window across
+the messages of the connection, every message flushed and without its last 4 bytes.
+"""
+
+def responses(tokens: int, tokens_per_frame: int) -> List[PromptResponse]:
+    """The responses of a request of tokens tokens, streamed tokens_per_frame at a time."""
+    words = [" " + WORDS[i % len(WORDS)] for i in range(tokens)]
+    frames = [PromptResponse(status=SERVER_CODES['RUNNING'], token="".join(words[i:i + tokens_per_frame]))
+              for i in range(0, tokens, tokens_per_frame)]
+    prompt = "This is a chat between an AI and a human.\n\nChat:\n### Human: Hello my friend!\n### AI:"
+    chat = {'user_text': " Hello my friend!", 'ai_text': "".join(words)}
+    frames.append(PromptResponse(status=SERVER_CODES['SUCCESS'], prompt=prompt + "".join(words), chat=chat))
+    return frames
+
+def frame_header(length: int) -> int:
+    """The size of the header of a server frame, server frames are not masked."""
+    if length < 126:
+        return 2
+    return 4 if length < 65536 else 10
+
+def measure(subprotocol: str, compress: bool, tokens: int=256, tokens_per_frame: int=1,
+            window_bits: int=12, mem_level: int=5) -> Dict[str, Any]:
+    """The wire bytes of a request in a subprotocol; the window and memory level are the websockets defaults."""
+    codec = get_codec(subprotocol)
+    compressor = zlib.compressobj(wbits=-window_bits, memLevel=mem_level) if compress else None
+    total = 0
+    messages = responses(tokens, tokens_per_frame)
+    for response in messages:
+        message = codec.encode_response(response)
+        payload = message.encode() if isinstance(message, str) else message
+        if compressor is not None:
+            payload = (compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+        total += frame_header(len(payload)) + len(payload)
+    return {
+        'messages': len(messages),
+        'bytes': total,
+        'bytes_per_token': total / tokens,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the websocket bytes per token of every wire format")
+    parser.add_argument("--tokens", type=int, default=256, help="tokens generated per request")
+    parser.add_argument("--tokens-per-frame", type=int, nargs="+", default=[1, 16],
+                        help="tokens coalesced in a frame, STREAM_MAX_TOKENS")
+    args = parser.parse_args()
+
+    results = {}
+    for tokens_per_frame in args.tokens_per_frame:
+        for subprotocol in subprotocols():
+            for compress in (False, True):
+                name = f"{subprotocol}{'+deflate' if compress else ''}/{tokens_per_frame}"
+                results[name] = measure(subprotocol, compress, args.tokens, tokens_per_frame)
+    print(json.dumps({'config': vars(args), 'results': results}, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,42 @@
 import asyncio
+from typing import Optional
 import websockets
-import json
+import websockets.exceptions
+from server.codec import get_codec, subprotocols
+
+"""
+An example websocket client, run it from the root of the repository:
+	python -m client.client
+"""
 class Client:
 	def __init__(self):
 		self.server = None
 		self.websocket = None
+		self.codec = get_codec()
 
-	async def connect(self, uri):
-		self.websocket = await websockets.connect(uri)
-		
+	async def connect(self, uri, subprotocol: Optional[str]=None, compression: Optional[str]="deflate"):
+		"""Connect to the server, asking for a subprotocol (memorylane.json or memorylane.msgpack)
+			and permessage-deflate unless compression is None.
+			The messages are written in the subprotocol the server picked, json if it picked none.
+		"""
+		self.websocket = await websockets.connect(uri, subprotocols=[subprotocol] if subprotocol else None,
+			compression=compression)
+		self.codec = get_codec(self.websocket.subprotocol)
 
 	async def send_message(self, message):
 		await self.websocket.send(message)
 
+	async def send_request(self, request: dict):
+		"""Send a request written in the subprotocol of the connection."""
+		await self.send_message(self.codec.encode_request(request))
+
+	async def receive_response(self) -> Optional[dict]:
+		"""The next response read with the subprotocol of the connection, None once the connection is closed."""
+		message = await self.receive_message()
+		if message is None:
+			return None
+		return self.codec.decode_response(message)
+
 	async def receive_message(self):
 		try:
 			message = await self.websocket.recv()
@@ -59,17 +83,19 @@ Chat:
 			'ai_text':' '
 		}
 	}
-	# convert to json
-	request = json.dumps(request)
 	client = Client()
-	await client.connect('ws://localhost:9001')
+	# MessagePack when it is installed, else json
+	await client.connect('ws://localhost:9001', subprotocol=subprotocols()[0])
 	
-	await client.send_message(request)
+	await client.send_request(request)
 	print('Sent message: {}'.format(request))
-	response = await client.receive_message()
-
-	if response:
-		response = json.loads(response)
-		print(response)
+	# The server sends the tokens as they get generated and then the final response
+	while True:
+		response = await client.receive_response()
+		if not response:
+			break
+		if response['status'] != 0:
+			print(response)
+			break
 if __name__ == '__main__':
 	asyncio.get_event_loop().run_until_complete(main())
\ No newline at end of file
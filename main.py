@@ -1,123 +1,76 @@
-from langchain.llms import LlamaCpp
-from langchain import PromptTemplate, LLMChain
-from langchain.callbacks.base import CallbackManager
-from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.vectorstores import Weaviate
 from dotenv import load_dotenv
 import os
 from server.http_server import HttpRequestHandler, PromptRequest, PromptResponse, validate_prompt_request
-from http.server import HTTPServer
-
+from server.models import setup_registry
+from server.database import setup_memory, setup_compaction
+from server.startup import Startup
+from http.server import HTTPServer, ThreadingHTTPServer
+import importlib
 import json
-import weaviate
 
 def setup_server()->HTTPServer:
-    """Setup the server."""
-    global callback_manager, llm, model_path
-    # Create the callback manager
-    callback_manager = CallbackManager([ StreamingStdOutCallbackHandler()])
+    """Setup the server, it is bound right away and the model loads in the background."""
+    global registry
+    # The models are loaded on demand
+    registry = setup_registry(settings)
+    HttpRequestHandler.registry = registry
+    HttpRequestHandler.startup = startup
 
-    # Load the model
-    llm = LlamaCpp(
-        model_path=model_path,
-        callback_manager=callback_manager,
-        verbose=True,
-        streaming=True,
-    )
+    # Every connection gets its own thread, a slow /prompt does not hold up the others
+    server = ThreadingHTTPServer(('localhost', 9000), HttpRequestHandler)
+    server.daemon_threads = True
+    return server
 
-    return HTTPServer(('localhost', 9000), HttpRequestHandler)
+def setup_model():
+    """Load the default model."""
+    registry.set_default(registry.default)
 
 def setup_database():
     """Setup the database."""
-    global WEAVIATE_URL, client
-    # Connect to weaviate
-    WEAVIATE_URL = os.getenv("WEAVIATE_URL")
-    client = weaviate.Client(
-        url=WEAVIATE_URL,
-        additional_headers={
-            'X-OpenAI-Api-Key': os.getenv("OPENAI_API_KEY"),
-        }
+    global embeddings, vectorstore
+    from server.embeddings import load_embeddings
+    # Load the embeddings, none means weaviate computes them
+    embeddings = load_embeddings(
+        os.getenv("EMBEDDINGS", "weaviate"),
+        os.getenv("EMBEDDINGS_MODEL"),
+        cache_path=os.getenv("EMBEDDINGS_CACHE_PATH"),
+        cache_max_bytes=int(os.getenv("EMBEDDINGS_CACHE_MAX_BYTES", 256 * 1024 * 1024)),
     )
+    # Create the vector store with its caches, the memories are saved in the background
+    vectorstore = setup_memory(embeddings, settings.get("vectorstore_name"))
+    HttpRequestHandler.vectorstore = vectorstore
 
-    # Check if the class Chat exists
-    #client.schema.delete_all()
-    client.schema.get()
-    chat_exists = False
-    for class_ in client.schema.get()['classes']:
-        if class_['class'] == 'Chat':
-            chat_exists = True
-            break
-
-    if not chat_exists:
-        # Create the class
-        schema = {
-        "classes": [
-            {
-                "class": "Chat",
-                "description": "A chat between two people",
-                "vectorizer": "text2vec-openai",
-                "moduleConfig": {
-                    "text2vec-openai": {
-                    "model": "ada",
-                    "modelVersion": "002",
-                    "type": "text"
-                    }
-                },
-                "properties": [
-                    {
-                        "dataType": ["text"],
-                        "description": "The content of the chat",
-                        "moduleConfig": {
-                            "text2vec-openai": {
-                            "skip": False,
-                            "vectorizePropertyName": False
-                            }
-                        },
-                        "name": "content",
-                    },
-                ],
-            },
-            ]
-        }
-
-        client.schema.create(schema)
-    # Create the vector store
-    client.schema.get()
-    return client
+def setup_compactor():
+    """Dedupe and summarize the memories in the background, with the default model."""
+    global compactor
+    compactor = setup_compaction(vectorstore, registry)
+    HttpRequestHandler.compactor = compactor
 
 def load_settings():
-    """Load the settings from the settings.json file."""
-    global settings, model_path
-    settings = json.load(open("settings.json"))
-    if settings.model_name is not None:
-        # Search for the model in the models folder
-        model_folder = os.path.join("models", settings.model_name)
-        if os.path.isdir(model_folder):
-            model_path = model_folder
-        else:
-            raise Exception(f"Could not find model {settings.model_name} in the models folder")
+    """Load the settings from the settings.json file, POST /settings writes it."""
+    global settings
+    settings = {}
+    if os.path.exists("settings.json"):
+        with open("settings.json") as f:
+            settings = json.load(f)
 load_dotenv(".env") # load environment variables from ".env
 settings = None
 load_settings()
-# import environment variables
-model_path = os.getenv("MODEL_PATH")
-
 
-count = 0
-running = False
 
-callback_manager = None
-llm = None
-WEAVIATE_URL=None
-client=None
+registry = None
+embeddings=None
+vectorstore = None
+compactor = None
 
+# Bind first, /health answers while the rest loads and early prompts wait for /ready
+startup = Startup()
 server=setup_server()
-client = setup_database()
-vectorstore = Weaviate(client, "Chat", "content")
-HttpRequestHandler.vectorstore = vectorstore
-HttpRequestHandler.llm = llm
-HttpRequestHandler.callback_manager = callback_manager
+imports = startup.run("imports", lambda: importlib.import_module("server.chain"))
+model = startup.run("model", setup_model)
+memory = startup.run("memory", setup_database)
+compaction = startup.run("compaction", setup_compactor, after=[model, memory])
+startup.complete(imports, model, memory, compaction)
 
 try:
     server.serve_forever()
@@ -125,4 +78,9 @@ except KeyboardInterrupt:
     print("Stopping server")
 finally:
     server.server_close()
+    if compactor is not None:
+        compactor.close()
+    registry.close()
+    if vectorstore is not None:
+        vectorstore.close()
     print("Server closed")
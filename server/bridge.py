@@ -0,0 +1,130 @@
+import asyncio
+import threading
+from typing import List, Optional
+
+"""
+Moves tokens from the thread running the chain to a coroutine on the asyncio event loop.
+The chain runs in an executor so the event loop keeps answering pings and new clients.
+TokenBuffer does the same for the threads of the http server.
+"""
+
+class TokenBridge:
+    """An asyncio queue that worker threads can put tokens into."""
+
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop]=None, max_pending: int=0):
+        """Initialize the bridge on the running loop (or the given one).
+            max_pending: the most characters waiting for the reader (0 means unbounded),
+                past that the bridge drops the queued tokens and every token after them
+        """
+        self.loop = loop or asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.max_pending = max_pending
+        self.pending = 0
+        self.overflowed = False
+        self.closed = False
+
+    def put(self, token: str):
+        """Queue a token, safe to call from any thread."""
+        self.loop.call_soon_threadsafe(self._put, token)
+
+    def close(self):
+        """Mark the end of the tokens, safe to call from any thread."""
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+
+    def _put(self, token: str):
+        if self.overflowed:
+            return
+        if self.max_pending and self.pending + len(token) > self.max_pending:
+            # The reader is too slow, stop holding tokens for it
+            self.overflowed = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.pending = 0
+            return
+        self.pending += len(token)
+        self.queue.put_nowait(token)
+
+    async def batch(self, max_tokens: int, interval: float) -> List[str]:
+        """Wait for a token and return it with the ones that follow it.
+            The batch ends after max_tokens tokens or interval seconds, but a reader that
+            fell behind gets every token already queued. Returns [] once the bridge is closed.
+        """
+        if self.closed:
+            return []
+        tokens = []
+        token = await self.queue.get()
+        deadline = self.loop.time() + interval
+        while token is not None:
+            self.pending -= len(token)
+            tokens.append(token)
+            if not self.queue.empty():
+                token = self.queue.get_nowait()
+                continue
+            timeout = deadline - self.loop.time()
+            if len(tokens) >= max_tokens or timeout <= 0:
+                break
+            try:
+                token = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+        if token is None:
+            self.closed = True
+        return tokens
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        token = await self.queue.get()
+        if token is None:
+            self.closed = True
+            raise StopAsyncIteration
+        self.pending -= len(token)
+        return token
+
+class TokenBuffer:
+    """TokenBridge for threads: the chain's thread puts tokens, the thread writing to the client takes them."""
+
+    def __init__(self, max_pending: int=0):
+        """Initialize the buffer.
+            max_pending: the most characters waiting for the reader (0 means unbounded),
+                past that the buffer drops the queued tokens and every token after them
+        """
+        self.max_pending = max_pending
+        self.pending = 0
+        self.overflowed = False
+        self.closed = False
+        self._tokens: List[str] = []
+        self._condition = threading.Condition()
+
+    def put(self, token: str):
+        """Queue a token."""
+        with self._condition:
+            if self.overflowed or self.closed:
+                return
+            if self.max_pending and self.pending + len(token) > self.max_pending:
+                # The reader is too slow, stop holding tokens for it
+                self.overflowed = True
+                self._tokens.clear()
+                self.pending = 0
+                return
+            self._tokens.append(token)
+            self.pending += len(token)
+            self._condition.notify()
+
+    def close(self):
+        """Mark the end of the tokens."""
+        with self._condition:
+            self.closed = True
+            self._condition.notify()
+
+    def take(self) -> Optional[List[str]]:
+        """Wait for tokens and return every one queued, None once the buffer is closed and empty."""
+        with self._condition:
+            while not self._tokens and not self.closed:
+                self._condition.wait()
+            if not self._tokens:
+                return None
+            tokens, self._tokens = self._tokens, []
+            self.pending = 0
+            return tokens
@@ -0,0 +1,228 @@
+import json
+import os
+import threading
+import time
+from typing import Callable, List, Optional
+
+from server.protocol import SERVER_CODES, PromptRequest, PromptResponse
+from server.completion_cache import CompletionCache
+from server.history import HistoryPacker
+from server.metrics import metrics
+from server.scheduler import GenerationCancelled, Scheduler
+from server.semantic_cache import SemanticCache
+from server.template_cache import TemplateCache
+
+"""
+The chain shared by the websocket and http servers.
+It builds the prompt, pulls the memories from the vector store, has the scheduler
+generate the answer and saves the new memory.
+"""
+
+# The compiled templates, shared by every request
+templates = TemplateCache(int(os.getenv("TEMPLATE_CACHE_SIZE", 128)))
+# The memories are searched for HISTORY_CANDIDATES docs, the packer keeps the ones that fit the budget
+history_candidates = int(os.getenv("HISTORY_CANDIDATES", 8))
+history = HistoryPacker(budget=int(os.getenv("HISTORY_TOKEN_BUDGET", 512)))
+# The completions of the requests that ask for the cache, COMPLETION_CACHE_SIZE 0 turns it off
+completions = None
+if int(os.getenv("COMPLETION_CACHE_SIZE", 1024)) > 0:
+    completions = CompletionCache(
+        int(os.getenv("COMPLETION_CACHE_SIZE", 1024)),
+        path=os.getenv("COMPLETION_CACHE_PATH") or None,
+        max_bytes=int(os.getenv("COMPLETION_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+    )
+# The answers of the templates that opt in, found again for paraphrased user texts
+semantic = None
+if int(os.getenv("SEMANTIC_CACHE_SIZE", 1024)) > 0:
+    semantic = SemanticCache(
+        threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.95)),
+        ttl=float(os.getenv("SEMANTIC_CACHE_TTL", 3600)),
+        max_entries=int(os.getenv("SEMANTIC_CACHE_SIZE", 1024)),
+    )
+
+def conversation_key(prompt_request: PromptRequest) -> str:
+    """The conversation a request belongs to, its id or else its names."""
+    if prompt_request.conversation_id is not None:
+        return prompt_request.conversation_id
+    return json.dumps(prompt_request.names, sort_keys=True)
+
+def memory_namespace(prompt_request: PromptRequest) -> str:
+    """The partition of the memories a request saves to and searches, its user id or else the user's name."""
+    if prompt_request.user_id is not None:
+        return prompt_request.user_id
+    return str(prompt_request.names.get("user_name", ""))
+
+def generate(prompt_request: PromptRequest, scheduler: Scheduler, prompt: str,
+             on_token: Optional[Callable[[str], None]]=None, cancel: Optional[threading.Event]=None) -> str:
+    """Generate the text of a formatted prompt, from the completion cache when the request asks for it.
+        Only a model that always answers a prompt the same way, with temperature 0 or a fixed seed, uses the cache.
+        A cached completion is replayed through on_token token by token, like a generated one.
+    """
+    params = None
+    if prompt_request.cache and completions is not None:
+        llm = scheduler.llm
+        params = {**llm._get_parameters(None), 'seed': getattr(llm, "seed", None)}
+        if not deterministic(params):
+            completions.skipped += 1
+            params = None
+    if params is None:
+        return scheduler.generate(prompt, on_token=on_token, session=conversation_key(prompt_request), cancel=cancel)
+    key = completions.key(getattr(llm, "model_path", None), params, prompt)
+    tokens = completions.get(key)
+    if tokens is None:
+        job = scheduler.submit(prompt, on_token=on_token, session=conversation_key(prompt_request), cancel=cancel)
+        output = job.result()
+        completions.put(key, job.tokens)
+        return output
+    return replay(tokens, on_token=on_token, cancel=cancel)
+
+def deterministic(params: dict) -> bool:
+    """Whether the llama parameters always generate the same text for a prompt."""
+    seed = params.get('seed')
+    return params.get('temperature') == 0 or (seed is not None and seed >= 0)
+
+def replay(tokens: List[str], on_token: Optional[Callable[[str], None]]=None,
+           cancel: Optional[threading.Event]=None) -> str:
+    """Send cached tokens through on_token like generated ones and return their text."""
+    for token in tokens:
+        if cancel is not None and cancel.is_set():
+            raise GenerationCancelled("The generation was cancelled")
+        if on_token is not None:
+            on_token(token)
+    return "".join(tokens)
+
+def run_chain(prompt_request: PromptRequest, scheduler: Scheduler, vectorstore,
+              on_token: Optional[Callable[[str], None]]=None, cancel: Optional[threading.Event]=None) -> PromptResponse:
+    """Run a chain.
+        on_token is called from the scheduler thread for every generated token.
+        Setting cancel stops the generation, the chain then raises GenerationCancelled and saves nothing.
+    """
+
+    if prompt_request.args is None:
+        raise ValueError("Args must be a dictionary")
+    input_variables = []
+    input_variables.extend(list(prompt_request.names.keys()))
+    input_variables.extend(list(prompt_request.chat.keys()))
+    input_variables.extend(list(prompt_request.args.keys()))
+    # The template time is getting the template and formatting it, the retrieval between is not counted
+    start = time.perf_counter()
+    template = templates.get(prompt_request.complete_prompt, input_variables)
+    template_time = time.perf_counter() - start
+
+    # A template that opts in gets the answer of a user text that means the same, without the model
+    cached, scope, vector = None, None, None
+    embeddings = getattr(vectorstore, "embedding", None)
+    if prompt_request.semantic_cache and semantic is not None and embeddings is not None:
+        scope = semantic.scope(prompt_request.complete_prompt, prompt_request.names,
+                               getattr(scheduler.llm, "model_path", None), memory_namespace(prompt_request))
+        vector = semantic.embed(prompt_request.chat.get("user_text", "").strip(), embeddings)
+        cached, _ = semantic.lookup(scope, vector)
+
+    output = ""
+    if prompt_request.memory and cached is None:
+        # Get docs from the user's partition of the vector store, repeated queries come from the retrieval cache
+        with metrics.timer("retrieval_seconds"):
+            docs = vectorstore.similarity_search(
+                prompt_request.chat_text["user_name"].format(**prompt_request.chat, **prompt_request.names),
+                k=history_candidates, namespace=memory_namespace(prompt_request))
+        # Best first, as many as fit in the token budget
+        prompt_request.args["history"] = history.pack([doc.page_content for doc in docs], scheduler.count_tokens)
+    # Format the prompt once, the response reuses it
+    variables = {**prompt_request.args, **prompt_request.names, **prompt_request.chat}
+    start = time.perf_counter()
+    complete_prompt = template.format(**{key: variables[key] for key in template.input_variables})
+    metrics.observe("template_seconds", template_time + time.perf_counter() - start)
+    if cached is not None:
+        output = replay(cached, on_token=on_token, cancel=cancel)
+    else:
+        # Run the chain, the session lets the scheduler start from the conversation's last KV state
+        tokens = []
+        def collect(token: str):
+            tokens.append(token)
+            if on_token is not None:
+                on_token(token)
+        output = generate(prompt_request, scheduler, complete_prompt, on_token=collect, cancel=cancel)
+        if scope is not None:
+            semantic.put(scope, vector, tokens)
+    chat=prompt_request.chat
+    chat["ai_text"]+=output
+    output=complete_prompt+output
+    if prompt_request.save:
+        save_memory(prompt_request, vectorstore)
+    # Create the response
+    response = PromptResponse(status=SERVER_CODES['SUCCESS'], prompt=output, chat=chat)
+
+    # Return the response
+    return response
+
+def save_memory(prompt_request: PromptRequest, vectorstore):
+    """Save the user and the ai lines of the request's chat as a memory."""
+    chat_text = prompt_request.chat_text
+    text = f'{chat_text["user_name"]}\n{chat_text["ai_name"]}'.format(**prompt_request.chat, **prompt_request.names)
+    # Save the embeddings to the database tagged with the user and the conversation,
+    # with a WriteBehindStore this only queues the text
+    metadata = {"namespace": memory_namespace(prompt_request), "conversation_id": conversation_key(prompt_request)}
+    vectorstore.add_texts([text], metadatas=[metadata])
+
+class ChatSession:
+    """A conversation held by the server between turns, so a turn only sends the new user text.
+        The prompt only grows: every turn appends its user and ai lines to the last prompt and
+        its output, so the conversation's KV state always holds all of it but the new lines.
+    """
+
+    def __init__(self, prompt_request: PromptRequest):
+        """Start a session from the request of its first turn."""
+        self.request = prompt_request
+        # The ai text the client starts every answer with
+        self.ai_text = prompt_request.chat.get("ai_text", "")
+        # The prompt so far, with the last output
+        self.prompt: Optional[str] = None
+        self.turns = 0
+
+    def turn_request(self, user_text: str) -> PromptRequest:
+        """The request of a turn, the first request with a new chat."""
+        request = self.request
+        return PromptRequest(
+            complete_prompt=request.complete_prompt,
+            chat_text=request.chat_text,
+            names=request.names,
+            chat={**request.chat, 'user_text': user_text, 'ai_text': self.ai_text},
+            args=dict(request.args),
+            save=request.save,
+            memory=request.memory,
+            conversation_id=request.conversation_id,
+            user_id=request.user_id,
+            model=request.model,
+            cache=request.cache,
+            semantic_cache=request.semantic_cache,
+        )
+
+def fits_context(prompt: str, scheduler: Scheduler) -> bool:
+    """Whether the prompt leaves the model room to answer."""
+    return scheduler.count_tokens(prompt) <= scheduler.prompt_budget
+
+def run_session(session: ChatSession, user_text: str, scheduler: Scheduler, vectorstore,
+                on_token: Optional[Callable[[str], None]]=None, cancel: Optional[threading.Event]=None) -> PromptResponse:
+    """Run a turn of a session, the response only has the new ai text.
+        The first turn, and a turn the conversation no longer fits the context for, run the whole
+        chain and start the prompt over from the template, with the memories of that turn.
+        A cancelled turn leaves the session as it was before it.
+    """
+    request = session.turn_request(user_text)
+    chat, names, chat_text = request.chat, request.names, request.chat_text
+    prompt = None
+    if session.prompt is not None:
+        prompt = session.prompt + "\n" + chat_text["user_name"].format(**chat, **names) \
+            + "\n" + chat_text["ai_name"].format(**chat, **names)
+    if prompt is None or not fits_context(prompt, scheduler):
+        response = run_chain(request, scheduler, vectorstore, on_token=on_token, cancel=cancel)
+        session.prompt = response.prompt
+        output = chat["ai_text"][len(session.ai_text):]
+    else:
+        output = generate(request, scheduler, prompt, on_token=on_token, cancel=cancel)
+        session.prompt = prompt + output
+        chat["ai_text"] += output
+        if request.save:
+            save_memory(request, vectorstore)
+    session.turns += 1
+    return PromptResponse(status=SERVER_CODES['SUCCESS'], prompt=output, chat=chat)
@@ -0,0 +1,117 @@
+import importlib.util
+import json
+from typing import Any, Dict, List, Optional, Union
+from server.protocol import PromptResponse
+
+"""
+How the websocket messages are written, chosen by the subprotocol the client asks for:
+    memorylane.json - the json every client spoke before, also used without a subprotocol
+    memorylane.msgpack - MessagePack, the fields of the responses are one letter codes and the
+                         empty ones are left out, so a token frame is {"s": 0, "t": token}
+With json every token frame carries the five fields of the response, mostly nulls, and is many
+times the size of the token. The requests are written with their full field names in both.
+"""
+
+JSON_SUBPROTOCOL = "memorylane.json"
+MSGPACK_SUBPROTOCOL = "memorylane.msgpack"
+
+# The field codes of the responses in MessagePack
+RESPONSE_CODES = {
+    'status': 's',
+    'token': 't',
+    'prompt': 'p',
+    'error': 'e',
+    'chat': 'c',
+}
+RESPONSE_FIELDS = {code: field for field, code in RESPONSE_CODES.items()}
+
+class JsonCodec:
+    """The json messages, the same bytes the servers always sent."""
+
+    subprotocol = JSON_SUBPROTOCOL
+
+    def encode_response(self, response: PromptResponse) -> str:
+        """Write a response."""
+        return response.to_json()
+
+    def decode_response(self, message: Union[str, bytes]) -> Dict[str, Any]:
+        """Read a response."""
+        return json.loads(message)
+
+    def encode_request(self, request: dict) -> str:
+        """Write a request."""
+        return json.dumps(request)
+
+    def decode_request(self, message: Union[str, bytes]) -> Dict[str, Any]:
+        """Read a request."""
+        request = json.loads(message)
+        if not isinstance(request, dict):
+            raise ValueError("A request must be an object")
+        return request
+
+class MsgpackCodec:
+    """MessagePack messages, the responses with short field codes and without their empty fields."""
+
+    subprotocol = MSGPACK_SUBPROTOCOL
+
+    def __init__(self):
+        """Import msgpack."""
+        try:
+            import msgpack
+        except ImportError:
+            raise ImportError(
+                "Could not import msgpack. "
+                "Please install it with `pip install msgpack`."
+            )
+        self.msgpack = msgpack
+
+    def encode_response(self, response: PromptResponse) -> bytes:
+        """Write a response, the fields that are None or empty are left out."""
+        fields = {'status': response.status, 'token': response.token, 'prompt': response.prompt,
+                  'error': response.error, 'chat': response.chat}
+        return self.msgpack.packb({RESPONSE_CODES[field]: value for field, value in fields.items()
+                                   if value is not None and value != "" and value != {}})
+
+    def decode_response(self, message: Union[str, bytes]) -> Dict[str, Any]:
+        """Read a response, with the full field names and None for the fields left out."""
+        if isinstance(message, str):
+            raise ValueError("A msgpack message must be binary")
+        coded = self.msgpack.unpackb(message)
+        return {field: coded.get(code) for code, field in RESPONSE_FIELDS.items()}
+
+    def encode_request(self, request: dict) -> bytes:
+        """Write a request."""
+        return self.msgpack.packb(request)
+
+    def decode_request(self, message: Union[str, bytes]) -> Dict[str, Any]:
+        """Read a request."""
+        if isinstance(message, str):
+            raise ValueError("A msgpack message must be binary")
+        request = self.msgpack.unpackb(message)
+        if not isinstance(request, dict):
+            raise ValueError("A request must be a map")
+        return request
+
+CODECS = {
+    JSON_SUBPROTOCOL: JsonCodec,
+    MSGPACK_SUBPROTOCOL: MsgpackCodec,
+}
+
+# The codecs are stateless, one of each is shared by every connection
+_codecs: Dict[str, Any] = {}
+
+def subprotocols() -> List[str]:
+    """The subprotocols the server offers, MessagePack only when msgpack is installed."""
+    offered = [JSON_SUBPROTOCOL]
+    if importlib.util.find_spec("msgpack") is not None:
+        offered.insert(0, MSGPACK_SUBPROTOCOL)
+    return offered
+
+def get_codec(subprotocol: Optional[str]=None):
+    """The codec of a subprotocol, json when there is none."""
+    subprotocol = subprotocol or JSON_SUBPROTOCOL
+    if subprotocol not in CODECS:
+        raise ValueError(f"Unknown subprotocol {subprotocol}")
+    if subprotocol not in _codecs:
+        _codecs[subprotocol] = CODECS[subprotocol]()
+    return _codecs[subprotocol]
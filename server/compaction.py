@@ -0,0 +1,181 @@
+import logging
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+import numpy as np
+
+"""
+Every saved turn is a new memory, so without compaction the store only grows and the
+k memories of a search are often the same turn said again. MemoryCompactor runs in the
+background and goes over the conversations of the vector store:
+    1. memories whose vectors are closer than similarity are merged, the newest one is kept
+    2. a conversation with more than max_memories memories has its oldest ones rolled into
+       summaries written by the model, when the scheduler is idle, or dropped without a scheduler
+The memories are compared a block at a time, so a conversation of thousands of memories never
+builds the whole similarity matrix. The memories of a summary are chosen so its prompt fits the
+context of the model, a memory longer than half of it is cut so two always fit.
+The store needs conversations(), memories(conversation_id) and delete(ids),
+see server/vectorstores.py. The scheduler needs generate, count_tokens and prompt_budget.
+"""
+
+SUMMARY_PROMPT = """Below are old parts of a conversation. Summarize what was said and learned in a few sentences.
+
+{memories}
+
+Summary:"""
+
+class MemoryCompactor:
+    """Dedupes and summarizes the memories of the vector store in the background."""
+
+    def __init__(self, vectorstore, scheduler=None, similarity: float=0.95, max_memories: int=200,
+                 summarize_batch: int=20, interval: float=60, dedupe_block: int=512):
+        """Initialize the compactor, start runs it every interval seconds.
+            similarity: the cosine similarity two memories are merged at
+            max_memories: the most memories a conversation keeps
+            summarize_batch: the most memories that go into one summary
+            dedupe_block: how many memories are compared at a time
+        """
+        self.vectorstore = vectorstore
+        self.scheduler = scheduler
+        self.similarity = similarity
+        self.max_memories = max_memories
+        self.summarize_batch = max(2, summarize_batch)
+        self.dedupe_block = max(1, dedupe_block)
+        self.interval = interval
+        self.runs = 0
+        self.merged = 0
+        self.summarized = 0
+        self.dropped = 0
+        self.last_run: Optional[float] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Start the background thread."""
+        self._thread = threading.Thread(target=self._run, name="compaction", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Stop the background thread."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def stats(self) -> Dict[str, Any]:
+        """Return what the compaction did so far."""
+        return {
+            'runs': self.runs,
+            'merged': self.merged,
+            'summarized': self.summarized,
+            'dropped': self.dropped,
+            'last_run': self.last_run,
+        }
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.compact()
+            except Exception as e:
+                logging.error(f"Compacting the memories failed: {e}")
+
+    def compact(self):
+        """Compact every conversation once."""
+        start = time.monotonic()
+        for conversation_id in self.vectorstore.conversations():
+            if self._stop.is_set():
+                break
+            memories = self.vectorstore.memories(conversation_id)
+            # The conversation id is only unique together with the user
+            namespaces: Dict[Any, List[dict]] = {}
+            for memory in memories:
+                namespaces.setdefault(memory["metadata"].get("namespace"), []).append(memory)
+            for namespace, group in namespaces.items():
+                group = self._dedupe(namespace, group)
+                self._cap(namespace, conversation_id, group)
+        self.runs += 1
+        self.last_run = time.monotonic() - start
+
+    def _dedupe(self, namespace, memories: List[dict]) -> List[dict]:
+        """Delete the memories a newer memory is too close to, return the ones left."""
+        if len(memories) < 2:
+            return memories
+        vectors = np.asarray([memory["vector"] for memory in memories], dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        # Newest first, a memory is kept unless a kept one is close to it
+        kept: List[int] = []
+        removed = []
+        for end in range(len(memories), 0, -self.dedupe_block):
+            start = max(0, end - self.dedupe_block)
+            block = vectors[start:end]
+            # Close to a memory kept from a newer block, then to one kept from this block
+            if kept:
+                close = ((block @ vectors[kept].T) >= self.similarity).any(axis=1)
+            else:
+                close = np.zeros(len(block), dtype=bool)
+            similar = (block @ block.T) >= self.similarity
+            block_kept: List[int] = []
+            for i in range(len(block) - 1, -1, -1):
+                if close[i] or (block_kept and similar[i, block_kept].any()):
+                    removed.append(memories[start + i]["id"])
+                else:
+                    block_kept.append(i)
+            kept.extend(start + i for i in block_kept)
+        if removed:
+            self.vectorstore.delete(removed, namespace=namespace)
+            self.merged += len(removed)
+        return [memories[i] for i in sorted(kept)]
+
+    def _idle(self) -> bool:
+        return self.scheduler.queue_depth == 0 and self.scheduler.active == 0
+
+    def _cap(self, namespace, conversation_id: str, memories: List[dict]):
+        """Bring a conversation down to max_memories memories, summarizing the oldest ones first."""
+        if len(memories) <= self.max_memories:
+            return
+        if self.scheduler is None:
+            oldest = memories[:len(memories) - self.max_memories]
+            self.vectorstore.delete([memory["id"] for memory in oldest], namespace=namespace)
+            self.dropped += len(oldest)
+            return
+        # The summaries written so far, they count towards max_memories
+        summaries = 0
+        for chunk in self._chunks(memories):
+            if len(memories) + summaries <= self.max_memories or len(chunk) < 2 or self._stop.is_set():
+                return
+            if not self._idle():
+                # Users come first, the summary waits for the next run
+                return
+            summary = self.scheduler.generate(
+                SUMMARY_PROMPT.format(memories="\n".join(text for _, text in chunk)),
+                session="compaction",
+            ).strip()
+            if summary:
+                metadata = {"namespace": namespace, "conversation_id": conversation_id, "summary": True}
+                self.vectorstore.add_texts([summary], metadatas=[metadata])
+                summaries += 1
+            self.vectorstore.delete([memory["id"] for memory, _ in chunk], namespace=namespace)
+            self.summarized += len(chunk)
+            memories = memories[len(chunk):]
+
+    def _chunks(self, memories: List[dict]) -> Iterator[List[tuple]]:
+        """The memories in (memory, text) chunks whose summary prompt fits the context, oldest first.
+            Every chunk but the last has at least two memories, so its summary shrinks the conversation.
+        """
+        available = self.scheduler.prompt_budget - self.scheduler.count_tokens(SUMMARY_PROMPT.format(memories=""))
+        limit = max(1, available // 2)
+        chunk: List[tuple] = []
+        used = 0
+        for memory in memories:
+            text = memory["text"]
+            # The count has the BOS token, which makes room for the newline between the memories
+            tokens = self.scheduler.count_tokens(text)
+            while tokens > limit and text:
+                text = text[:max(0, len(text) * limit // tokens - 1)]
+                tokens = self.scheduler.count_tokens(text)
+            if chunk and (used + tokens > available or len(chunk) == self.summarize_batch):
+                yield chunk
+                chunk, used = [], 0
+            chunk.append((memory, text))
+            used += tokens
+        if chunk:
+            yield chunk
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+"""
+Canned greetings, retried requests and health probes send the same prompt again and again, and
+with temperature 0 or a fixed seed the model answers it the same way every time. CompletionCache
+keeps the tokens of those answers keyed by sha256(model, parameters, formatted prompt), so the
+prompt is generated once and then replayed token by token. A model with a temperature above 0
+and no fixed seed answers differently every time, its requests never use the cache.
+
+The newest completions are kept in memory, in LRU order. With a path, every completion is
+also kept in a SQLite file that survives restarts, and once it holds more than max_bytes the
+least recently used ones are deleted. Only requests that ask for it (cache true) use the cache.
+"""
+
+class CompletionCache:
+    """The tokens of the completions of deterministic prompts, in memory and on disk."""
+
+    def __init__(self, maxsize: int=1024, path: Optional[str]=None, max_bytes: int=64 * 1024 * 1024):
+        """Initialize the cache, opening the file of the disk tier if there is a path.
+            maxsize: how many completions are kept in memory
+            max_bytes: how many bytes of tokens the file holds
+        """
+        self.maxsize = maxsize
+        self.path = path
+        self.max_bytes = max_bytes
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        # Requests that asked for the cache on a model that is not deterministic
+        self.skipped = 0
+        self.evictions = 0
+        self._completions: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._bytes = 0
+        if path:
+            folder = os.path.dirname(path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS completions (key BLOB PRIMARY KEY, tokens TEXT NOT NULL, used REAL NOT NULL) WITHOUT ROWID"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS completions_used ON completions (used)")
+            self._bytes = self._db.execute("SELECT COALESCE(SUM(LENGTH(tokens)), 0) FROM completions").fetchone()[0]
+
+    def key(self, model: Optional[str], params: Dict[str, Any], prompt: str) -> bytes:
+        """The cache key of a prompt generated by a model with its parameters."""
+        return hashlib.sha256(json.dumps([model, params, prompt], sort_keys=True, default=str).encode()).digest()
+
+    def get(self, key: bytes) -> Optional[List[str]]:
+        """The tokens of a completion, from memory or else from the file, None if it is not cached."""
+        with self._lock:
+            if key in self._completions:
+                self._completions.move_to_end(key)
+                self.memory_hits += 1
+                return self._completions[key]
+            row = None
+            if self._db is not None:
+                row = self._db.execute("SELECT tokens FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE completions SET used = ? WHERE key = ?", (time.time(), key))
+            self.disk_hits += 1
+            tokens = json.loads(row[0])
+            self._remember(key, tokens)
+            return tokens
+
+    def put(self, key: bytes, tokens: List[str]):
+        """Cache the tokens of a completion."""
+        tokens = list(tokens)
+        with self._lock:
+            self._remember(key, tokens)
+            if self._db is None:
+                return
+            blob = json.dumps(tokens)
+            self._db.execute("BEGIN")
+            old = self._db.execute("SELECT LENGTH(tokens) FROM completions WHERE key = ?", (key,)).fetchone()
+            self._db.execute("INSERT OR REPLACE INTO completions (key, tokens, used) VALUES (?, ?, ?)",
+                             (key, blob, time.time()))
+            self._bytes += len(blob) - (old[0] if old else 0)
+            if self._bytes > self.max_bytes:
+                self._evict()
+            self._db.execute("COMMIT")
+
+    def _remember(self, key: bytes, tokens: List[str]):
+        self._completions[key] = tokens
+        self._completions.move_to_end(key)
+        while len(self._completions) > self.maxsize:
+            self._completions.popitem(last=False)
+
+    def _evict(self):
+        # Go down to 90% of max_bytes so the next few saves do not evict again
+        target = self._bytes - int(self.max_bytes * 0.9)
+        freed = 0
+        keys = []
+        for key, size in self._db.execute("SELECT key, LENGTH(tokens) FROM completions ORDER BY used"):
+            if freed >= target:
+                break
+            keys.append((key,))
+            freed += size
+        self._db.executemany("DELETE FROM completions WHERE key = ?", keys)
+        self._bytes -= freed
+        self.evictions += len(keys)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the size and the hit ratio of both tiers."""
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            'size': len(self._completions),
+            'maxsize': self.maxsize,
+            'bytes': self._bytes if self._db is not None else None,
+            'max_bytes': self.max_bytes if self._db is not None else None,
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'skipped': self.skipped,
+            'hit_ratio': (self.memory_hits + self.disk_hits) / lookups if lookups else None,
+            'evictions': self.evictions,
+        }
+
+    def close(self):
+        """Close the file of the disk tier."""
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
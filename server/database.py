@@ -0,0 +1,180 @@
+import logging
+import os
+from typing import Optional
+
+"""
+The vector store of the memories and its Weaviate schema, shared by the websocket and http servers.
+"""
+
+def partition_properties(vectorizer: str="text2vec-openai") -> list:
+    """The properties a chat is filtered on: the user (namespace) and the conversation.
+        They are matched whole and never vectorized.
+    """
+    properties = []
+    for name, description in (("namespace", "The user the chat belongs to"),
+                              ("conversation_id", "The conversation the chat belongs to")):
+        property_ = {
+            "dataType": ["text"],
+            "description": description,
+            "name": name,
+            "tokenization": "field",
+            "indexFilterable": True,
+            "indexSearchable": False,
+        }
+        if vectorizer != "none":
+            property_["moduleConfig"] = {vectorizer: {"skip": True}}
+        properties.append(property_)
+    return properties
+
+def chat_class(class_name: str="Chat", vectorizer: str="text2vec-openai") -> dict:
+    """The class the chats are saved in.
+        vectorizer none means the vectors are sent with the objects.
+    """
+    if vectorizer == "none":
+        return {
+            "class": class_name,
+            "description": "A chat between two people",
+            "vectorizer": "none",
+            "properties": [
+                {
+                    "dataType": ["text"],
+                    "description": "The content of the chat",
+                    "name": "content",
+                },
+                *partition_properties(vectorizer),
+            ],
+        }
+    return {
+        "class": class_name,
+        "description": "A chat between two people",
+        "vectorizer": "text2vec-openai",
+        "moduleConfig": {
+            "text2vec-openai": {
+            "model": "ada",
+            "modelVersion": "002",
+            "type": "text"
+            }
+        },
+        "properties": [
+            {
+                "dataType": ["text"],
+                "description": "The content of the chat",
+                "moduleConfig": {
+                    "text2vec-openai": {
+                    "skip": False,
+                    "vectorizePropertyName": False
+                    }
+                },
+                "name": "content",
+            },
+            *partition_properties(vectorizer),
+        ],
+    }
+
+def setup_chat_class(client, class_name: str="Chat", vectorizer: str="text2vec-openai"):
+    """Create the chat class if it does not exist."""
+    # Check if the class Chat exists
+    #client.schema.delete_all()
+    for class_ in client.schema.get()['classes']:
+        if class_['class'] == class_name:
+            # Classes made before the memories were partitioned get the partition properties
+            existing = {property_['name'] for property_ in class_.get('properties', [])}
+            for property_ in partition_properties(vectorizer):
+                if property_['name'] not in existing:
+                    client.schema.property.create(class_name, property_)
+            return
+    # Create the class
+    client.schema.create({"classes": [chat_class(class_name, vectorizer)]})
+
+def setup_vectorstore(name: str, embeddings):
+    """Create the vector store the memories are kept in.
+        weaviate - the Weaviate server at WEAVIATE_URL, in the WEAVIATE_CLASS class
+        local - a memory mapped store in the VECTORSTORE_PATH folder, no server needed
+    """
+    if name == "local":
+        from server.vectorstores import MmapVectorStore
+        return MmapVectorStore(
+            os.getenv("VECTORSTORE_PATH", "memories"),
+            embeddings,
+            ivf_threshold=int(os.getenv("VECTORSTORE_IVF_THRESHOLD", 20000)),
+            nprobe=int(os.getenv("VECTORSTORE_NPROBE", 8)),
+        )
+    if name == "weaviate":
+        import weaviate
+        from server.vectorstores import WeaviateStore
+        # Connect to weaviate
+        client = weaviate.Client(
+            url=os.getenv("WEAVIATE_URL"),
+            additional_headers={
+                'X-OpenAI-Api-Key': os.getenv("OPENAI_API_KEY"),
+            }
+        )
+        # Create the chat class, with our own embeddings the vectors are sent with the objects
+        class_name = os.getenv("WEAVIATE_CLASS", "Chat")
+        setup_chat_class(client, class_name, "text2vec-openai" if embeddings is None else "none")
+        return WeaviateStore(client, class_name, "content", embedding=embeddings)
+    raise ValueError(f"Unknown vector store {name}")
+
+def setup_hybrid(vectorstore):
+    """Put the BM25 index of RETRIEVAL_MODE hybrid or lexical next to the vector store."""
+    from server.hybrid import BM25Index, HybridStore
+    mode = os.getenv("RETRIEVAL_MODE", "vector")
+    if mode == "vector":
+        return vectorstore
+    # The index is kept on disk, so only its first start reads the memories out of the store
+    index = BM25Index(os.getenv("LEXICAL_INDEX_PATH", "memories/lexical.jsonl") or None)
+    if len(index) == 0 and hasattr(vectorstore, "conversations"):
+        # A new index starts with the memories already in the store
+        for conversation_id in vectorstore.conversations():
+            memories = vectorstore.memories(conversation_id)
+            index.add([memory["id"] for memory in memories], [memory["text"] for memory in memories],
+                      [memory["metadata"] for memory in memories])
+    return HybridStore(
+        vectorstore,
+        index,
+        mode=mode,
+        rrf_k=int(os.getenv("RRF_K", 60)),
+        vector_timeout=float(os.getenv("VECTOR_SEARCH_TIMEOUT", 0)),
+    )
+
+def setup_memory(embeddings, name: Optional[str]=None):
+    """Create the vector store with the layers the chain uses in front of it:
+        the lexical index, the retrieval cache, then the write-behind queue of the saved memories.
+        name is the vector store (weaviate, local), VECTORSTORE when None.
+    """
+    from server.retrieval_cache import RetrievalCacheStore
+    from server.write_behind import WriteBehindStore
+    if embeddings is None and int(os.getenv("SEMANTIC_CACHE_SIZE", 1024)) > 0:
+        logging.warning("The semantic cache needs EMBEDDINGS local or openai, requests with semantic_cache run the model")
+    vectorstore = setup_vectorstore(name or os.getenv("VECTORSTORE", "weaviate"), embeddings)
+    # Under the caches, so it gets the ids the store gave the memories
+    vectorstore = setup_hybrid(vectorstore)
+    vectorstore = RetrievalCacheStore(
+        vectorstore,
+        maxsize=int(os.getenv("RETRIEVAL_CACHE_SIZE", 1024)),
+        ttl=float(os.getenv("RETRIEVAL_CACHE_TTL", 300)),
+    )
+    # The memories are saved in the background, through the cache so it sees the writes
+    return WriteBehindStore(
+        vectorstore,
+        batch_size=int(os.getenv("SAVE_BATCH_SIZE", 32)),
+        flush_interval=float(os.getenv("SAVE_FLUSH_INTERVAL", 1.0)),
+    )
+
+def setup_compaction(vectorstore, scheduler=None):
+    """Start the background compaction of the memories, None when COMPACTION_INTERVAL is 0.
+        With COMPACTION_SUMMARIZE the model rolls the oldest memories into summaries when it is idle.
+    """
+    from server.compaction import MemoryCompactor
+    interval = float(os.getenv("COMPACTION_INTERVAL", 0))
+    if interval <= 0:
+        return None
+    compactor = MemoryCompactor(
+        vectorstore,
+        scheduler=scheduler if os.getenv("COMPACTION_SUMMARIZE", "true").lower() == "true" else None,
+        similarity=float(os.getenv("COMPACTION_SIMILARITY", 0.95)),
+        max_memories=int(os.getenv("COMPACTION_MAX_MEMORIES", 200)),
+        interval=interval,
+    )
+    compactor.start()
+    return compactor
@@ -0,0 +1,146 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+"""
+A line is embedded again every time it comes back: as the memory query of the next turn,
+when a request is retried or replayed, and when the same text is saved twice. CachedEmbeddings
+wraps an embeddings backend and keeps every vector it computed in a SQLite file, keyed by
+sha256(model, text), so the vector is computed once and survives restarts.
+
+The vectors are stored as raw float32 bytes. Once the file holds more than max_bytes of
+vectors the least recently used ones are deleted.
+"""
+
+class CachedEmbeddings(Embeddings):
+    """An embeddings backend with a persistent, content addressed cache in front of it."""
+
+    def __init__(self, embeddings: Embeddings, path: str, max_bytes: int=256 * 1024 * 1024,
+                 model_name: Optional[str]=None):
+        """Open the cache file, creating it if needed.
+            model_name: part of the key, so a new model never gets the vectors of the old one
+        """
+        self.embeddings = embeddings
+        self.path = path
+        self.max_bytes = max_bytes
+        self.model_name = model_name or getattr(embeddings, "model_name", None) \
+            or getattr(embeddings, "model", None) or type(embeddings).__name__
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS vectors (key BLOB PRIMARY KEY, vector BLOB NOT NULL, used REAL NOT NULL) WITHOUT ROWID"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS vectors_used ON vectors (used)")
+        self._bytes = self._db.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM vectors").fetchone()[0]
+
+    def key(self, text: str) -> bytes:
+        """The cache key of a text."""
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode()).digest()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed a list of documents, only computing the vectors not in the cache."""
+        return self._embed(list(texts), self.embeddings.embed_documents)
+
+    def embed_query(self, text: str) -> List[float]:
+        """Embed a query."""
+        return self._embed([text], lambda texts: [self.embeddings.embed_query(texts[0])])[0]
+
+    def _embed(self, texts: List[str], embed) -> List[List[float]]:
+        keys = [self.key(text) for text in texts]
+        vectors = self._get(keys)
+        # Every missing text is embedded once, even if it is in the list twice
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors and key not in missing:
+                missing[key] = text
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            computed = embed(list(missing.values()))
+            new = dict(zip(missing.keys(), computed))
+            self._put(new)
+            vectors.update(new)
+        return [vectors[key] for key in keys]
+
+    def _get(self, keys: List[bytes]) -> Dict[bytes, List[float]]:
+        """Read the cached vectors of the keys and mark them as used."""
+        unique = list(set(keys))
+        vectors = {}
+        with self._lock:
+            for start in range(0, len(unique), 500):
+                chunk = unique[start:start + 500]
+                rows = self._db.execute(
+                    f"SELECT key, vector FROM vectors WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                for key, vector in rows:
+                    vectors[key] = np.frombuffer(vector, dtype=np.float32).tolist()
+            if vectors:
+                now = time.time()
+                self._db.executemany("UPDATE vectors SET used = ? WHERE key = ?", [(now, key) for key in vectors])
+        return vectors
+
+    def _put(self, vectors: Dict[bytes, List[float]]):
+        """Save new vectors, evicting the least recently used ones past max_bytes."""
+        now = time.time()
+        rows = [(key, np.asarray(vector, dtype=np.float32).tobytes(), now) for key, vector in vectors.items()]
+        with self._lock:
+            size = self._bytes
+            self._db.execute("BEGIN")
+            try:
+                for key, blob, used in rows:
+                    old = self._db.execute("SELECT LENGTH(vector) FROM vectors WHERE key = ?", (key,)).fetchone()
+                    self._db.execute("INSERT OR REPLACE INTO vectors (key, vector, used) VALUES (?, ?, ?)", (key, blob, used))
+                    self._bytes += len(blob) - (old[0] if old else 0)
+                if self._bytes > self.max_bytes:
+                    self._evict()
+                self._db.execute("COMMIT")
+            except BaseException:
+                # Nothing of the save is kept, and the connection is not left in its transaction
+                self._db.execute("ROLLBACK")
+                self._bytes = size
+                raise
+
+    def _evict(self):
+        # Go down to 90% of max_bytes so the next few saves do not evict again
+        target = self._bytes - int(self.max_bytes * 0.9)
+        freed = 0
+        keys = []
+        for key, size in self._db.execute("SELECT key, LENGTH(vector) FROM vectors ORDER BY used"):
+            if freed >= target:
+                break
+            keys.append((key,))
+            freed += size
+        self._db.executemany("DELETE FROM vectors WHERE key = ?", keys)
+        self._bytes -= freed
+        self.evictions += len(keys)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the size and the hit ratio of the cache."""
+        lookups = self.hits + self.misses
+        return {
+            'model': self.model_name,
+            'bytes': self._bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else None,
+            'evictions': self.evictions,
+        }
+
+    def close(self):
+        """Close the cache file."""
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,121 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List, Optional, Tuple
+from langchain.embeddings.base import Embeddings
+
+"""
+The embedding backends. The vectors are computed here and sent to the vector store,
+so with the local backend retrieval never leaves the machine.
+    local - a sentence-transformers model running on the CPU (pip install sentence-transformers)
+    openai - OpenAI's ada-002, computed by the server
+    weaviate - no embeddings here, Weaviate's text2vec-openai module computes them
+"""
+
+class EmbeddingBatcher:
+    """Collects the texts of concurrent callers and embeds them in one batch."""
+
+    def __init__(self, embed_batch: Callable[[List[str]], List[List[float]]], batch_size: int=32, max_wait: float=0.005):
+        """Initialize the batcher and start its thread.
+            embed_batch: embeds a list of texts
+            batch_size: the most texts in one batch
+            max_wait: seconds the first text of a batch waits for others to join it
+        """
+        self.embed_batch = embed_batch
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.batches = 0
+        self.texts = 0
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="embeddings", daemon=True)
+        self._thread.start()
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        """Embed the texts, blocking until their batch ran."""
+        if not texts:
+            return []
+        future: Future = Future()
+        self._queue.put((texts, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            size = len(batch[0][0])
+            deadline = time.monotonic() + self.max_wait
+            while size < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                size += len(batch[-1][0])
+            self._embed(batch)
+
+    def _embed(self, batch: List[Tuple[List[str], Future]]):
+        texts = [text for texts, _ in batch for text in texts]
+        try:
+            vectors = self.embed_batch(texts)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        self.batches += 1
+        self.texts += len(texts)
+        start = 0
+        for texts, future in batch:
+            future.set_result(vectors[start:start + len(texts)])
+            start += len(texts)
+
+class LocalEmbeddings(Embeddings):
+    """A sentence-transformers model running in the process, fed in batches."""
+
+    def __init__(self, model_name: str="sentence-transformers/all-MiniLM-L6-v2", device: str="cpu",
+                 batch_size: int=32, max_wait: float=0.005):
+        """Load the model."""
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise ImportError(
+                "Could not import sentence_transformers. "
+                "Please install it with `pip install sentence-transformers`."
+            )
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.model = SentenceTransformer(model_name, device=device)
+        self.batcher = EmbeddingBatcher(self._encode, batch_size=batch_size, max_wait=max_wait)
+
+    def _encode(self, texts: List[str]) -> List[List[float]]:
+        # Normalized, so the dot product is the cosine similarity
+        vectors = self.model.encode(texts, batch_size=self.batch_size, normalize_embeddings=True, convert_to_numpy=True)
+        return vectors.tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed a list of documents."""
+        return self.batcher.embed(list(texts))
+
+    def embed_query(self, text: str) -> List[float]:
+        """Embed a query."""
+        return self.batcher.embed([text])[0]
+
+def load_embeddings(backend: str, model_name: Optional[str]=None, cache_path: Optional[str]=None,
+                    cache_max_bytes: int=256 * 1024 * 1024) -> Optional[Embeddings]:
+    """Create the embeddings of a backend, None means the vector store embeds by itself.
+        With a cache_path the vectors are cached on disk, see server/embedding_cache.py
+    """
+    if backend == "local":
+        embeddings = LocalEmbeddings(model_name) if model_name else LocalEmbeddings()
+    elif backend == "openai":
+        from langchain.embeddings import OpenAIEmbeddings
+        embeddings = OpenAIEmbeddings()
+    elif backend == "weaviate":
+        return None
+    else:
+        raise ValueError(f"Unknown embeddings backend {backend}")
+    if cache_path:
+        from server.embedding_cache import CachedEmbeddings
+        embeddings = CachedEmbeddings(embeddings, cache_path, max_bytes=cache_max_bytes)
+    return embeddings
@@ -0,0 +1,80 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List
+
+"""
+The memories put in the prompt. The vector store returns candidates best first and
+HistoryPacker takes them in that order while they fit in a token budget, so the history
+never overflows the context and fills the room it is given.
+
+Counting tokens needs the model's tokenizer, the count of every memory is cached so
+packing the same memories again costs a dictionary lookup.
+"""
+
+class HistoryPacker:
+    """Packs memories into the token budget of the history."""
+
+    def __init__(self, budget: int=512, item_template: str="{text}", separator: str="\n", maxsize: int=4096):
+        """Initialize the packer.
+            budget: the most tokens the history takes
+            item_template: how one memory is written, {text} is the memory
+            separator: what goes between two memories
+            maxsize: how many token counts are cached
+        """
+        self.budget = budget
+        self.item_template = item_template
+        self.separator = separator
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._counts: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def count(self, text: str, count_tokens: Callable[[str], int]) -> int:
+        """The number of tokens of a text, from the cache when it was counted before."""
+        key = hashlib.sha256(text.encode()).digest()
+        with self._lock:
+            if key in self._counts:
+                self._counts.move_to_end(key)
+                self.hits += 1
+                return self._counts[key]
+        tokens = count_tokens(text)
+        with self._lock:
+            self.misses += 1
+            self._counts[key] = tokens
+            while len(self._counts) > self.maxsize:
+                self._counts.popitem(last=False)
+        return tokens
+
+    def pack(self, texts: List[str], count_tokens: Callable[[str], int]) -> str:
+        """Render the texts that fit in the budget, best first.
+            A memory too long for what is left is skipped, a shorter one after it may still fit.
+        """
+        separator = self.count(self.separator, count_tokens) if self.separator else 0
+        used = 0
+        packed = []
+        for text in texts:
+            item = self.item_template.format(text=text.strip())
+            tokens = self.count(item, count_tokens) + (separator if packed else 0)
+            if used + tokens > self.budget:
+                continue
+            used += tokens
+            packed.append(item)
+        return self.separator.join(packed)
+
+    def clear(self):
+        """Forget the token counts, for when the tokenizer changes."""
+        with self._lock:
+            self._counts.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the size and the hit ratio of the token count cache."""
+        lookups = self.hits + self.misses
+        return {
+            'budget': self.budget,
+            'size': len(self._counts),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else None,
+        }
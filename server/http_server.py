@@ -1,9 +1,12 @@
 import json
 import logging
+import os
 import re
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from langchain import PromptTemplate, LLMChain
-from langchain.callbacks.base import CallbackManager
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
+from server.bridge import TokenBuffer
+from server.metrics import metrics
+from server.protocol import SERVER_CODES, PromptRequest, PromptResponse, validate_prompt_request
 
 """
 The server that will handle the requests.
@@ -21,210 +24,219 @@ URL: http://localhost:9000
 				1. history (required): str - the history of the conversation
             save (optional): bool - whether to save the prompt to the database (default: False)
             memory (optional): bool - whether to use the memory (default: False)
+            conversation_id (optional): str - the conversation the prompt belongs to (default: the names)
+            user_id (optional): str - the user the memories are saved and searched for (default: the user's name)
+            model (optional): str - the model in the models folder to run the prompt on, with ALLOW_MODEL_SELECTION (default: the model of the settings)
+            cache (optional): bool - answer from the completion cache when the same prompt was generated before, only when the model has temperature 0 or a fixed seed (default: False)
+            semantic_cache (optional): bool - answer with the cached answer of a user text that means the same,
+                for the same template, names and user (default: False)
+            stream (optional): bool - send the tokens as Server-Sent Events while they get generated (default: False)
+                (sending the header Accept: text/event-stream does the same)
 	POST /settings - change the settings
         Args:
-            model_name (optional): str - the name of the model to use for the AI (default: vicuna-7b)
-                (vicuna-7b, pygmalion-7b)
-            vectorstore_name (optional): str - the name of the vectorstore to use for the AI (default: weaviate)
-                (weaviate is the only vectorstore supported at the moment)
+            model_name (optional): str - the model in the models folder the prompts run on by default (default: MODEL_PATH)
+                (vicuna-7b, pygmalion-7b) - it is loaded before the response, the running prompts keep their model
+            vectorstore_name (optional): str - the name of the vectorstore to use for the AI (default: VECTORSTORE)
+                (weaviate, local) - used from the next start of the server, the running one keeps its vectorstore
+	GET /health - 200 as soon as the server is up
+	GET /ready - 200 once the model and the database are loaded, 503 before; has the time of every startup phase
+	GET /metrics - the latency histograms and the counters in the Prometheus text format
+	GET /scheduler - get the loaded models and the queue depth and the wait times of their schedulers
+	GET /stats - get the stats of the scheduler and of the caches
 """
-SERVER_CODES = {
-    'SUCCESS': 23,
-    'ERROR': -1,
-    'RUNNING': 0
-}
-
 class HttpRequestHandler(BaseHTTPRequestHandler):
 	"""The HTTP request handler."""
-	llm=None
+	# HTTP/1.1 keeps the connection alive between requests, so every response has a length or is chunked
+	protocol_version="HTTP/1.1"
+	registry=None
 	vectorstore=None
-	callback_manager=None
+	compactor=None
+	# The background startup, requests wait up to STARTUP_WAIT_TIMEOUT seconds for it
+	startup=None
+	startup_timeout=float(os.getenv("STARTUP_WAIT_TIMEOUT", 120))
 	def do_POST(self):
 		"""Handle a POST request."""
 		logging.info("POST request received")
 		logging.info(f"Path: {self.path}")
+		if not self.read_body():
+			return
 		try:
+			if not self.wait_ready():
+				return
 			if re.search("/settings", self.path):
 				# Get the settings request from the content
-				content_length = int(self.headers['Content-Length'])
-				post_data = self.rfile.read(content_length)
-				settings_request = json.loads(post_data)
+				settings_request = self.read_json()
+				# Load the new model before it becomes the default, the running requests keep theirs
+				if settings_request.get("model_name"):
+					self.registry.set_default(settings_request["model_name"])
 				# Save the settings in json file
 				with open('settings.json', 'w') as f:
 					json.dump(settings_request, f)
 
-				self.send_response(200, "OK")
-				self.end_headers()
-				self.wfile.write(json.dumps({'status': SERVER_CODES['SUCCESS']}).encode())
+				self.send_json(200, {'status': SERVER_CODES['SUCCESS']}, "OK")
 			else:
-				self.send_response(404)
-				self.end_headers()
-				self.wfile.write(json.dumps({'status': SERVER_CODES['ERROR']}).encode())
+				self.send_json(404, {'status': SERVER_CODES['ERROR']})
 		except Exception as e:
 			logging.error(e)
-			self.send_response(500, "Internal Server Error or Invalid Request")
-			self.end_headers()
-			self.wfile.write(json.dumps({'status': SERVER_CODES['ERROR'], 'error': "Internal Server Error or Invalid Request"}).encode())
+			metrics.inc("errors_total")
+			self.send_json(500, {'status': SERVER_CODES['ERROR'], 'error': "Internal Server Error or Invalid Request"}, "Internal Server Error or Invalid Request")
         
 	def do_GET(self):
 		"""Handle a GET request."""
 		logging.info("GET request received")
 		logging.info(f"Path: {self.path}")
+		if not self.read_body():
+			return
 		try:
+			if re.search("/health", self.path):
+				self.send_json(200, {'status': 'ok', 'uptime': self.startup.report()['uptime']}, "OK")
+				return
+			if re.search("/metrics", self.path):
+				self.send_text(200, metrics.render(), "text/plain; version=0.0.4")
+				return
+			if re.search("/ready", self.path):
+				report = self.startup.report()
+				self.send_json(200 if report['ready'] else 503, report)
+				return
+			if not self.wait_ready():
+				return
+			from server.chain import run_chain, templates, history, completions, semantic
 			if re.search("/prompt", self.path):
+				metrics.inc("requests_total")
 				# Get the prompt request from the content
-				content_length = int(self.headers['Content-Length'])
-				post_data = self.rfile.read(content_length)
-				prompt_request = json.loads(post_data)
+				prompt_request = self.read_json()
+				stream = prompt_request.get("stream", False) or "text/event-stream" in self.headers.get("Accept", "")
 				prompt_request=validate_prompt_request(prompt_request)
-				prompt_response=run_chain(prompt_request, self.llm, self.vectorstore, self.callback_manager)
-				self.send_response(200, "OK")
-				self.send_header("Content-type", "application/json")
-				self.end_headers()
-				self.wfile.write(prompt_response.to_json().encode())
+				if stream:
+					self.stream_prompt(prompt_request)
+					return
+				with self.registry.lease(prompt_request.model) as scheduler:
+					prompt_response=run_chain(prompt_request, scheduler, self.vectorstore)
+				self.send_json(200, prompt_response.to_json(), "OK")
+			elif re.search("/scheduler", self.path):
+				# Queue depth and wait times of the scheduler of every loaded model
+				self.send_json(200, self.registry.stats(), "OK")
+			elif re.search("/stats", self.path):
+				# The scheduler and the caches
+				stats = {'scheduler': self.registry.stats(), 'templates': templates.stats(), 'history': history.stats()}
+				if hasattr(self.vectorstore, "stats"):
+					stats['vectorstore'] = self.vectorstore.stats()
+				if hasattr(getattr(self.vectorstore, "embedding", None), "stats"):
+					stats['embeddings'] = self.vectorstore.embedding.stats()
+				if self.compactor is not None:
+					stats['compaction'] = self.compactor.stats()
+				if completions is not None:
+					stats['completions'] = completions.stats()
+				if semantic is not None:
+					stats['semantic'] = semantic.stats()
+				self.send_json(200, stats, "OK")
 			else:
-				self.send_response(404)
-			self.end_headers()
+				self.send_json(404, {'status': SERVER_CODES['ERROR']})
 		except Exception as e:
 			logging.error(e)
-			self.send_response(500, "Internal Server Error or Invalid Request")
-			self.end_headers()
-			self.wfile.write(json.dumps({'status': SERVER_CODES['ERROR'], 'error': "Internal Server Error or Invalid Request"}).encode())
-        
-
-class PromptRequest:
-    """A request for a prompt."""
-
-    def __init__(self, complete_prompt, chat_text: dict={'user': '', 'ai': ''},
-		 names:dict={'user_name': 'user', 'ai_name': 'ai'}, chat:dict={'user_text': '', 'ai_text': ''}, args:dict=None,
-		 save: bool=False, memory:bool=False):
-        """Initialize the prompt request."""
-        self.args = args
-        self.names = names
-        self.complete_prompt = complete_prompt
-        self.chat_text = chat_text
-        self.chat = chat
-        self.save = save
-        self.memory = memory
-
-    def to_json(self):
-        dict={'args': self.args, 'names': self.names, 'complete_prompt': self.complete_prompt, 'chat_text': self.chat_text, 'chat': self.chat
-                , 'save': self.save, 'memory': self.memory}
-        return json.dumps(dict)
-    def __str__(self):
-        """Return the string representation of the prompt request."""
-        return f"PromptRequest(args={self.args}, names={self.names}, complete_prompt={self.complete_prompt}, chat_text={self.chat_text})"
-
-    def __repr__(self):
-        """Return the string representation of the prompt request."""
-        return self.__str__()
-
-class PromptResponse:
-    """A response to a prompt."""
-
-    def __init__(self, status: int, token: str|None=None, prompt: str|None=None, error: str|None=None, chat:dict={'user_text': '', 'ai_text': ''}):
-        """Initialize the prompt response."""
-        self.status = status
-        self.token = token
-        self.prompt = prompt
-        self.chat=chat
-        self.error = error
-	
-    def to_json(self):
-        dict={'status': self.status, 'token': self.token, 'prompt': self.prompt, 'error': self.error, 'chat': self.chat}
-        return json.dumps(dict)
-
-    def __str__(self):
-        """Return the string representation of the prompt response."""
-        return f"PromptResponse(status={self.status}, token={self.token}, error={self.error})"
-
-    def __repr__(self):
-        """Return the string representation of the prompt response."""
-        return self.__str__()
-
-def validate_prompt_request(prompt_dictionary: dict) -> PromptRequest:
-    """Validate the prompt request."""
-    
-    # Check if the completed prompt is a string and in the dictionary
-    if "complete_prompt" not in prompt_dictionary or not isinstance(prompt_dictionary["complete_prompt"], str):
-        raise ValueError("Prompt must be a string")
-    prompt = prompt_dictionary["complete_prompt"]
-    # Check if the chat text is a dictionary
-    if "chat_text" not in prompt_dictionary or not isinstance(prompt_dictionary["chat_text"], dict):
-        raise ValueError("Chat text must be a dictionary")
-    chat_text = prompt_dictionary["chat_text"]
-    # Check if the args is a dictionary
-    if "args" not in prompt_dictionary or not isinstance(prompt_dictionary["args"], dict):
-        raise ValueError("Args must be a dictionary")
-    args = prompt_dictionary["args"]
-    # Check if the names is a dictionary
-    if "names" not in prompt_dictionary or not isinstance(prompt_dictionary["names"], dict):
-        raise ValueError("Names must be a dictionary")
-    names = prompt_dictionary["names"]
-
-    # Check if the chat is a dictionary
-    if "chat" not in prompt_dictionary or not isinstance(prompt_dictionary["chat"], dict):
-        raise ValueError("Chat must be a dictionary")
-    chat = prompt_dictionary["chat"]
-    return PromptRequest(
-        complete_prompt=prompt,
-        chat_text=chat_text,
-        args=args,
-        names=names,
-        chat=chat,
-    )
-
-def run_chain(prompt_request: PromptRequest, llm, vectorstore, callback_manager: CallbackManager) -> PromptResponse:
-    """Run a chain."""
-    
-    input_variables = []
-    input_variables.extend(list(prompt_request.names.keys()))
-    input_variables.extend(list(prompt_request.chat.keys()))
-    template = None
-    if prompt_request.args is not None:
-        input_variables.extend(list(prompt_request.args.keys()))
-        print(input_variables)
-        template = PromptTemplate(
-            template=prompt_request.complete_prompt,
-            input_variables=input_variables,
-        )
-    
-    output = ""
-    # Create the chain
-    chain = LLMChain(
-        llm=llm,
-        prompt=template,
-        callback_manager=callback_manager,
-    )
-    if prompt_request.memory:
-        # Get docs from the vector store
-        docs = vectorstore.similarity_search(
-            prompt_request.chat_text["user_name"].format(**prompt_request.chat, **prompt_request.names),
-            k=4)
-        history = []
-        for doc in docs:
-            history.append(doc.page_content)
-        prompt_request.args["history"] = history
-    # Run the chain
-    output = chain.run(**prompt_request.args, **prompt_request.names, **prompt_request.chat)
-    chat=prompt_request.chat
-    chat["ai_text"]+=output
-    complete_prompt = prompt_request.complete_prompt.format(**prompt_request.args, **prompt_request.names, **prompt_request.chat)
-    output=complete_prompt+output
-    if prompt_request.save:
-        # Create query
-        chat_text = prompt_request.chat_text
-        
-        text = f'{chat_text["user_name"]}\n{chat_text["ai_name"]}'.format(**prompt_request.chat, **prompt_request.names)
-        
-        # Save the embeddings to the database
-        result=vectorstore.add_texts([text])
-        print(result)
-    # Create the response
-    response = PromptResponse(status=SERVER_CODES['SUCCESS'], prompt=output, chat=chat)
-    
-    # Return the response
-    return response
+			metrics.inc("errors_total")
+			self.send_json(500, {'status': SERVER_CODES['ERROR'], 'error': "Internal Server Error or Invalid Request"}, "Internal Server Error or Invalid Request")
+
+	def wait_ready(self) -> bool:
+		"""Wait for the startup, answering 503 if it failed or takes too long."""
+		if self.startup is None or self.startup.wait(self.startup_timeout):
+			return True
+		error = "The server failed to start" if self.startup.error is not None else "The server is starting"
+		self.send_json(503, {'status': SERVER_CODES['ERROR'], 'error': error}, "Service Unavailable")
+		return False
+
+	def read_body(self) -> bool:
+		"""Read the body of every request before it is handled, so the next request on the connection
+			starts where this one ends whatever the response. A body that can not be read closes the connection.
+		"""
+		self.body = b""
+		try:
+			content_length = int(self.headers.get('Content-Length', 0))
+		except ValueError:
+			content_length = -1
+		if content_length < 0 or "chunked" in self.headers.get('Transfer-Encoding', "").lower():
+			self.close_connection = True
+			self.send_json(400, {'status': SERVER_CODES['ERROR'], 'error': "Invalid Content-Length"}, "Bad Request")
+			return False
+		if content_length:
+			self.body = self.rfile.read(content_length)
+		return True
+
+	def read_json(self):
+		"""The json body of the request."""
+		return json.loads(self.body)
+
+	def send_json(self, code: int, body, message: str|None=None):
+		"""Send a json response, body is a dictionary or an already encoded string."""
+		if not isinstance(body, str):
+			body = json.dumps(body)
+		self.send_text(code, body, "application/json", message)
+
+	def send_text(self, code: int, body: str, content_type: str, message: str|None=None):
+		"""Send a text response with its length."""
+		body = body.encode()
+		self.send_response(code, message)
+		self.send_header("Content-type", content_type)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def stream_prompt(self, prompt_request: PromptRequest):
+		"""Run the chain and send the tokens as Server-Sent Events while they get generated.
+			Every event is a PromptResponse, running ones carry the tokens and the last one the whole prompt.
+		"""
+		# Coalesced between events, a client that reads slower than the model stops getting them
+		tokens = TokenBuffer(max_pending=int(os.getenv("STREAM_MAX_PENDING", 65536)))
+		result = {}
+		# Set when the client goes away, the generation stops instead of decoding for nobody
+		cancel = threading.Event()
+		from server.chain import run_chain
+		def chain():
+			try:
+				with self.registry.lease(prompt_request.model) as scheduler:
+					result['response'] = run_chain(prompt_request, scheduler, self.vectorstore, on_token=tokens.put,
+						cancel=cancel)
+			except Exception as e:
+				result['error'] = e
+			finally:
+				tokens.close()
+		# The chain gets its own thread so a slow client never holds up the scheduler
+		threading.Thread(target=chain, name="http-chain", daemon=True).start()
+
+		self.send_response(200, "OK")
+		self.send_header("Content-type", "text/event-stream")
+		self.send_header("Cache-Control", "no-cache")
+		self.send_header("Transfer-Encoding", "chunked")
+		self.end_headers()
+		try:
+			while True:
+				# Send everything that queued up while the last event was written
+				text = tokens.take()
+				if text is None:
+					break
+				self.send_event(PromptResponse(status=SERVER_CODES['RUNNING'], token="".join(text)).to_json())
+			if tokens.overflowed:
+				logging.info("Client is too slow, stopped streaming the tokens to it")
+			if 'error' in result:
+				logging.error(result['error'])
+				metrics.inc("errors_total")
+				self.send_event(json.dumps({'status': SERVER_CODES['ERROR'], 'error': "Internal Server Error or Invalid Request"}))
+			else:
+				self.send_event(result['response'].to_json())
+			self.send_chunk(b"")
+		except (BrokenPipeError, ConnectionResetError):
+			logging.info("Client closed the stream")
+			cancel.set()
+			self.close_connection = True
+
+	def send_event(self, data: str):
+		"""Send a Server-Sent Event as one chunk."""
+		self.send_chunk(f"data: {data}\n\n".encode())
+
+	def send_chunk(self, data: bytes):
+		"""Send a chunk of a chunked response, an empty chunk ends the response."""
+		self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+		self.wfile.flush()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,240 @@
+import json
+import logging
+import math
+import os
+import re
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from uuid import uuid4
+from langchain.docstore.document import Document
+
+"""
+Vectors find memories that mean the same thing but miss the exact names, numbers and rare
+words users refer back to. HybridStore wraps a vector store with a local BM25 inverted index
+of the same memories and fuses the two rankings with reciprocal rank fusion:
+    score(doc) = sum over the rankings of 1 / (rrf_k + rank of the doc)
+    vector - only the vector store
+    hybrid - both rankings fused, or only the lexical one when the vector search fails or
+             takes longer than vector_timeout (those results are not cached)
+    lexical - only the BM25 index, no embedding at all
+The index is partitioned by namespace like the vector stores, and kept in a json lines log
+so it survives restarts.
+"""
+
+def tokenize(text: str) -> List[str]:
+    """Split a text into lower case words."""
+    return re.findall(r"\w+", text.lower())
+
+class BM25Index:
+    """An in-memory BM25 inverted index, one per namespace."""
+
+    def __init__(self, path: Optional[str]=None, k1: float=1.2, b: float=0.75):
+        """Initialize the index, replaying its log when there is one."""
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        # namespace -> term -> doc id -> term frequency
+        self._postings: Dict[Any, Dict[str, Dict[str, int]]] = {}
+        # namespace -> doc id -> length, and the total length of the namespace
+        self._lengths: Dict[Any, Dict[str, int]] = {}
+        self._total: Dict[Any, int] = {}
+        # doc id -> (namespace, text, metadata)
+        self._docs: Dict[str, Tuple[Any, str, dict]] = {}
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            self._load()
+        elif path is not None and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def _load(self):
+        deleted = 0
+        with open(self.path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if "delete" in record:
+                    deleted += len(record["delete"])
+                    self._remove(record["delete"])
+                else:
+                    self._add(record["id"], record["text"], record["metadata"])
+        # Only the memories still in the index are written back
+        if deleted:
+            with open(self.path + ".tmp", "w") as f:
+                for _id, (_, text, metadata) in self._docs.items():
+                    f.write(json.dumps({"id": _id, "text": text, "metadata": metadata}) + "\n")
+            os.replace(self.path + ".tmp", self.path)
+
+    def _log(self, records: List[dict]):
+        if self.path is None:
+            return
+        with open(self.path, "a") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+
+    def add(self, ids: List[str], texts: List[str], metadatas: Optional[List[dict]]=None):
+        """Index the texts under their ids."""
+        records = []
+        with self._lock:
+            for i, (_id, text) in enumerate(zip(ids, texts)):
+                metadata = metadatas[i] if metadatas is not None else {}
+                self._add(_id, text, metadata)
+                records.append({"id": _id, "text": text, "metadata": metadata})
+            self._log(records)
+
+    def _add(self, _id: str, text: str, metadata: dict):
+        namespace = metadata.get("namespace")
+        terms = Counter(tokenize(text))
+        postings = self._postings.setdefault(namespace, {})
+        for term, frequency in terms.items():
+            postings.setdefault(term, {})[_id] = frequency
+        length = sum(terms.values())
+        self._lengths.setdefault(namespace, {})[_id] = length
+        self._total[namespace] = self._total.get(namespace, 0) + length
+        self._docs[_id] = (namespace, text, metadata)
+
+    def remove(self, ids: Iterable[str]):
+        """Take the ids out of the index."""
+        ids = list(ids)
+        with self._lock:
+            self._remove(ids)
+            self._log([{"delete": ids}])
+
+    def _remove(self, ids: List[str]):
+        for _id in ids:
+            if _id not in self._docs:
+                continue
+            namespace, text, _ = self._docs.pop(_id)
+            postings = self._postings[namespace]
+            for term in set(tokenize(text)):
+                postings[term].pop(_id, None)
+                if not postings[term]:
+                    del postings[term]
+            self._total[namespace] -= self._lengths[namespace].pop(_id)
+
+    def search(self, query: str, k: int=4, namespace: Any=None, all_namespaces: bool=False) -> List[Tuple[Document, float]]:
+        """Return the k docs with the best BM25 score for the query.
+            Only the namespace is searched, unless all_namespaces is set.
+        """
+        terms = set(tokenize(query))
+        scores: Dict[str, float] = {}
+        with self._lock:
+            namespaces = list(self._postings) if all_namespaces else [namespace]
+            for space in namespaces:
+                postings = self._postings.get(space)
+                if not postings:
+                    continue
+                lengths = self._lengths[space]
+                average = self._total[space] / max(len(lengths), 1)
+                for term in terms:
+                    documents = postings.get(term)
+                    if not documents:
+                        continue
+                    idf = math.log(1 + (len(lengths) - len(documents) + 0.5) / (len(documents) + 0.5))
+                    for _id, frequency in documents.items():
+                        norm = frequency + self.k1 * (1 - self.b + self.b * lengths[_id] / average)
+                        scores[_id] = scores.get(_id, 0) + idf * frequency * (self.k1 + 1) / norm
+            best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+            return [(Document(page_content=self._docs[_id][1], metadata=dict(self._docs[_id][2])), score)
+                    for _id, score in best]
+
+class PartialResults(list):
+    """The docs of a search that answered without one of its rankings, a cache must not keep them."""
+
+    cacheable = False
+
+class HybridStore:
+    """A vector store wrapper that adds a BM25 ranking and fuses it with the vector one."""
+
+    def __init__(self, vectorstore, index: BM25Index, mode: str="hybrid", rrf_k: int=60,
+                 vector_timeout: float=0, candidates: int=20):
+        """Initialize the wrapper.
+            mode: vector, hybrid or lexical
+            vector_timeout: seconds a hybrid search waits for the vector store before it answers
+                from the index alone, 0 waits for it
+            candidates: how many docs every ranking gives to the fusion
+        """
+        if mode not in ("vector", "hybrid", "lexical"):
+            raise ValueError(f"Unknown retrieval mode {mode}")
+        self.vectorstore = vectorstore
+        self.index = index
+        self.mode = mode
+        self.rrf_k = rrf_k
+        self.vector_timeout = vector_timeout
+        self.candidates = candidates
+        self.fused = 0
+        self.lexical_only = 0
+        self.fallbacks = 0
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="vector-search")
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.vectorstore, name)
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]]=None, **kwargs: Any) -> List[str]:
+        """Save the texts in the vector store and index them under the same ids."""
+        texts = list(texts)
+        ids = self.vectorstore.add_texts(texts, metadatas=metadatas, **kwargs)
+        if not ids or len(ids) != len(texts):
+            ids = [str(uuid4()) for _ in texts]
+        self.index.add(ids, texts, metadatas)
+        return ids
+
+    def delete(self, ids: Iterable[str], **kwargs: Any):
+        """Delete memories from the vector store and the index."""
+        ids = list(ids)
+        self.vectorstore.delete(ids, **kwargs)
+        self.index.remove(ids)
+
+    def similarity_search(self, query: str, k: int=4, **kwargs: Any) -> List[Document]:
+        """Return the docs of the query, ranked as the mode says."""
+        if self.mode == "vector":
+            return self.vectorstore.similarity_search(query, k=k, **kwargs)
+        namespace = kwargs.get("namespace")
+        lexical = [doc for doc, _ in self.index.search(query, max(k, self.candidates), namespace=namespace,
+                                                        all_namespaces=namespace is None)]
+        if self.mode == "lexical":
+            self.lexical_only += 1
+            return lexical[:k]
+        future = self._executor.submit(self.vectorstore.similarity_search, query, max(k, self.candidates), **kwargs)
+        try:
+            vector = future.result(timeout=self.vector_timeout or None)
+        except TimeoutError:
+            logging.warning(f"Vector search took longer than {self.vector_timeout}s, using the lexical ranking")
+            self.fallbacks += 1
+            return PartialResults(lexical[:k])
+        except Exception as e:
+            logging.error(f"Vector search failed, using the lexical ranking: {e}")
+            self.fallbacks += 1
+            return PartialResults(lexical[:k])
+        self.fused += 1
+        return self.fuse([vector, lexical], k)
+
+    def fuse(self, rankings: List[List[Document]], k: int) -> List[Document]:
+        """Reciprocal rank fusion of rankings, the same text is the same doc."""
+        scores: Dict[str, float] = {}
+        docs: Dict[str, Document] = {}
+        for ranking in rankings:
+            for rank, doc in enumerate(ranking):
+                scores[doc.page_content] = scores.get(doc.page_content, 0) + 1 / (self.rrf_k + rank + 1)
+                docs.setdefault(doc.page_content, doc)
+        best = sorted(scores, key=scores.get, reverse=True)[:k]
+        return [docs[text] for text in best]
+
+    def stats(self) -> Dict[str, Any]:
+        """Return how the searches were answered."""
+        stats = {
+            'mode': self.mode,
+            'indexed': len(self.index),
+            'fused': self.fused,
+            'lexical_only': self.lexical_only,
+            'fallbacks': self.fallbacks,
+        }
+        inner = getattr(self.vectorstore, "stats", None)
+        if inner is not None:
+            stats['store'] = inner()
+        return stats
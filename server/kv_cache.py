@@ -0,0 +1,123 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+"""
+Every turn of a chat resends the whole conversation, and llama.cpp only evaluates the
+tokens after the prefix its context already holds. The scheduler keeps the llama state
+(the KV cache) of every conversation here after its turn, and loads the state sharing
+the longest prefix with the next prompt so only the new suffix gets evaluated.
+"""
+
+class KVStateCache:
+    """The llama.cpp states of idle conversations, evicted LRU under a memory budget."""
+
+    def __init__(self, max_bytes: int, max_idle: float=0, min_prefix: int=16):
+        """Initialize the cache.
+            max_bytes: the memory budget of the saved states
+            max_idle: seconds after which an unused state is dropped (0 keeps them)
+            min_prefix: the fewest shared tokens worth loading another conversation's state for
+        """
+        self.max_bytes = max_bytes
+        self.max_idle = max_idle
+        self.min_prefix = min_prefix
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.tokens_reused = 0
+        # session -> (tokens, state, size, last used)
+        self._states: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def state_tokens(state) -> List[int]:
+        """The tokens evaluated in a saved llama state."""
+        tokens = getattr(state, "input_ids", None)
+        if tokens is None:
+            tokens = getattr(state, "eval_tokens", [])
+        n_tokens = getattr(state, "n_tokens", None)
+        tokens = list(tokens)
+        return tokens[:n_tokens] if n_tokens is not None else tokens
+
+    @staticmethod
+    def state_size(state) -> int:
+        """The bytes held by a saved llama state."""
+        size = getattr(state, "llama_state_size", None)
+        if size is None:
+            size = len(getattr(state, "llama_state", b""))
+        return size
+
+    @staticmethod
+    def common_prefix(a: Sequence[int], b: Sequence[int]) -> int:
+        """The number of leading tokens a and b share."""
+        n = 0
+        for x, y in zip(a, b):
+            if x != y:
+                break
+            n += 1
+        return n
+
+    def put(self, session: str, state):
+        """Keep the state a conversation ended its turn with."""
+        size = self.state_size(state)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._states.pop(session, None)
+            if old is not None:
+                self.size -= old[2]
+            self._states[session] = (self.state_tokens(state), state, size, time.monotonic())
+            self.size += size
+            self._evict()
+
+    def lookup(self, session: Optional[str], tokens: Sequence[int]) -> Tuple[Any, int]:
+        """Return the state sharing the longest prefix with tokens and the length of that prefix.
+            Any conversation's state can be used (they often share a system prompt), the
+            conversation's own state wins ties. Prefixes under min_prefix are not worth a load.
+        """
+        with self._lock:
+            self._evict()
+            best, best_prefix = None, 0
+            for key, (state_tokens, _, _, _) in self._states.items():
+                prefix = self.common_prefix(state_tokens, tokens)
+                if prefix < self.min_prefix:
+                    continue
+                if prefix > best_prefix or (prefix == best_prefix and key == session):
+                    best, best_prefix = key, prefix
+            if best is None:
+                self.misses += 1
+                return None, 0
+            state_tokens, state, size, _ = self._states[best]
+            self._states[best] = (state_tokens, state, size, time.monotonic())
+            self._states.move_to_end(best)
+            self.hits += 1
+            self.tokens_reused += best_prefix
+            return state, best_prefix
+
+    def _evict(self):
+        """Drop the least recently used states until the budget and max_idle hold."""
+        now = time.monotonic()
+        while self._states:
+            session, (_, _, size, last_used) = next(iter(self._states.items()))
+            idle = self.max_idle and now - last_used > self.max_idle
+            if self.size <= self.max_bytes and not idle:
+                break
+            del self._states[session]
+            self.size -= size
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the size and the hit ratio of the cache."""
+        lookups = self.hits + self.misses
+        return {
+            'states': len(self._states),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else None,
+            'tokens_reused': self.tokens_reused,
+            'evictions': self.evictions,
+        }
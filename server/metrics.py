@@ -0,0 +1,183 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+"""
+The metrics of the servers, shared by everything in the process through the metrics object.
+Histograms count observations in fixed buckets, so recording one costs a bisect and a lock
+and the memory does not grow with traffic. Counters only go up.
+
+Both servers export them as GET /metrics in the Prometheus text format (snapshot() has the
+same numbers as a dictionary, with percentiles estimated from the buckets).
+"""
+
+# Seconds, from a millisecond to two minutes
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# Cosine similarities, finer near 1 where the thresholds are
+SIMILARITY_BUCKETS = (0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.92, 0.94, 0.95, 0.96, 0.97, 0.98, 0.99, 1.0)
+# Tokens per second
+RATE_BUCKETS = (1, 2, 4, 6, 8, 10, 15, 20, 30, 40, 60, 80, 120, 160, 250)
+
+class Histogram:
+    """Observations counted in buckets, the last bucket is everything above the others."""
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float]=LATENCY_BUCKETS):
+        """Initialize the histogram."""
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        """Record an observation."""
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def percentile(self, q: float) -> Optional[float]:
+        """Estimate a percentile (0 to 1) by interpolating inside its bucket."""
+        with self._lock:
+            counts = list(self.counts)
+            count = self.count
+        if count == 0:
+            return None
+        rank = q * count
+        seen = 0
+        for i, bucket_count in enumerate(counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return the count, the average and the estimated percentiles."""
+        return {
+            'count': self.count,
+            'avg': self.sum / self.count if self.count else None,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'p99': self.percentile(0.99),
+        }
+
+    def render(self) -> List[str]:
+        """The histogram in the Prometheus text format."""
+        with self._lock:
+            counts = list(self.counts)
+            count, total = self.count, self.sum
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bucket, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f'{self.name}_bucket{{le="{bucket}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {count}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {count}")
+        return lines
+
+class Counter:
+    """A count that only goes up."""
+
+    def __init__(self, name: str, help: str):
+        """Initialize the counter."""
+        self.name = name
+        self.help = help
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int=1):
+        """Add to the count."""
+        with self._lock:
+            self.value += amount
+
+    def render(self) -> List[str]:
+        """The counter in the Prometheus text format."""
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter", f"{self.name} {self.value}"]
+
+class Metrics:
+    """The histograms and counters of the process."""
+
+    def __init__(self, prefix: str="memorylane"):
+        """Initialize the metrics, every name gets the prefix."""
+        self.prefix = prefix
+        self.histograms: Dict[str, Histogram] = {}
+        self.counters: Dict[str, Counter] = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name: str, help: str="", buckets: Sequence[float]=LATENCY_BUCKETS) -> Histogram:
+        """The histogram of a name, created the first time."""
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(f"{self.prefix}_{name}", help, buckets)
+            return self.histograms[name]
+
+    def counter(self, name: str, help: str="") -> Counter:
+        """The counter of a name, created the first time."""
+        with self._lock:
+            if name not in self.counters:
+                self.counters[name] = Counter(f"{self.prefix}_{name}", help)
+            return self.counters[name]
+
+    def observe(self, name: str, value: float):
+        """Record an observation in the histogram of a name."""
+        self.histogram(name).observe(value)
+
+    def inc(self, name: str, amount: int=1):
+        """Add to the counter of a name."""
+        self.counter(name).inc(amount)
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        """Record how many seconds the block took in the histogram of a name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return every metric as a dictionary."""
+        with self._lock:
+            histograms = dict(self.histograms)
+            counters = dict(self.counters)
+        return {
+            'histograms': {name: histogram.snapshot() for name, histogram in histograms.items()},
+            'counters': {name: counter.value for name, counter in counters.items()},
+        }
+
+    def render(self) -> str:
+        """Every metric in the Prometheus text format."""
+        with self._lock:
+            metrics = list(self.counters.values()) + list(self.histograms.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+# Declared up front so they have their help text and buckets, and show before the first request
+metrics.histogram("queue_wait_seconds", "Seconds a prompt waited for a decode slot")
+metrics.histogram("template_seconds", "Seconds spent building and formatting the prompt template")
+metrics.histogram("retrieval_seconds", "Seconds spent in similarity_search")
+metrics.histogram("prompt_eval_seconds", "Seconds from the first decode step of a prompt to its first token")
+metrics.histogram("ttft_seconds", "Seconds from submitting a prompt to its first token")
+metrics.histogram("decode_tokens_per_second", "Tokens per second after the first token", RATE_BUCKETS)
+metrics.histogram("save_seconds", "Seconds the vector store took to save a batch of memories")
+metrics.counter("requests_total", "Prompt requests received")
+metrics.counter("connections_total", "Websocket connections opened")
+metrics.counter("disconnects_total", "Websocket connections closed")
+metrics.counter("errors_total", "Requests that failed")
+metrics.counter("cancelled_total", "Generations cancelled by their client")
+metrics.counter("dropped_messages_total", "Broadcasts not sent to a client because its outbox was full")
+metrics.counter("slow_disconnects_total", "Clients disconnected because their outbox was full")
+metrics.histogram("semantic_cache_similarity", "Best cosine similarity of every semantic cache lookup", SIMILARITY_BUCKETS)
+metrics.counter("semantic_cache_hits_total", "Requests answered from the semantic cache")
+metrics.counter("semantic_cache_misses_total", "Semantic cache lookups that found no answer close enough")
@@ -0,0 +1,254 @@
+import glob
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+from server.kv_cache import KVStateCache
+from server.scheduler import Scheduler
+
+"""
+The models the servers can run. A model is a file in the models folder, or a folder holding one,
+and ModelRegistry loads them on demand, each with its own scheduler. Up to max_resident
+models are loaded or loading at once: when they are all taken, the least recently used one is
+unloaded, once its requests are done, before the next one loads, so the memory of a model is
+never held twice. The KV cache and parked state budgets are split between the max_resident models.
+Requests choose their model only with allow_selection, else they all run on the default one.
+
+The default model is the one requests without a model run on. With a free slot changing it loads
+the new model first and then switches, so no request waits. Without one it switches first and the
+requests wait while the old model is unloaded and the new one loads.
+"""
+
+MODEL_EXTENSIONS = (".bin", ".gguf", ".ggml")
+
+def find_model(name: str, folder: str="models") -> str:
+    """The path of the model file of a name: models/<name>, or the model file inside models/<name>/."""
+    if not name or os.path.basename(name) != name or name in (".", ".."):
+        raise ValueError(f"Invalid model name {name}")
+    path = os.path.join(folder, name)
+    if os.path.isfile(path):
+        return path
+    if os.path.isdir(path):
+        files = sorted(file for file in glob.glob(os.path.join(path, "*")) if file.endswith(MODEL_EXTENSIONS))
+        if files:
+            return files[0]
+    raise ValueError(f"Could not find model {name} in the {folder} folder")
+
+def load_llm(model_path: str):
+    """Load the LlamaCpp model of a file."""
+    from langchain.llms import LlamaCpp
+    return LlamaCpp(
+        model_path=model_path,
+        verbose=True,
+        streaming=True,
+    )
+
+def setup_scheduler(model_path: str) -> Scheduler:
+    """Load a model and create the scheduler that owns it, configured from the environment.
+        The memory budgets are for every resident model together, each model gets its share.
+    """
+    llm = load_llm(model_path)
+    models = max(1, int(os.getenv("MAX_RESIDENT_MODELS", 1)))
+    # The KV state of every conversation is kept between its turns
+    kv_cache = None
+    if int(os.getenv("KV_CACHE_MAX_BYTES", 0)) > 0:
+        kv_cache = KVStateCache(
+            int(os.getenv("KV_CACHE_MAX_BYTES")) // models,
+            max_idle=float(os.getenv("KV_CACHE_MAX_IDLE", 0)),
+        )
+    # The scheduler is the only user of the model, every request queues on it
+    return Scheduler(
+        llm,
+        max_active=int(os.getenv("SCHEDULER_MAX_ACTIVE", 1)),
+        quantum=int(os.getenv("SCHEDULER_QUANTUM", 64)),
+        echo=os.getenv("ECHO_TOKENS", "true").lower() == "true",
+        kv_cache=kv_cache,
+        max_parked_bytes=int(os.getenv("SCHEDULER_MAX_PARKED_BYTES", 2 * 1024 ** 3)) // models,
+    )
+
+def setup_registry(settings: Optional[dict]=None) -> "ModelRegistry":
+    """Create the registry of the models folder (MODELS_FOLDER).
+        The default model is the model_name of the settings, or else the file at MODEL_PATH.
+    """
+    model_path = os.getenv("MODEL_PATH")
+    folder = os.getenv("MODELS_FOLDER", "models")
+    def load(name: str) -> Scheduler:
+        return setup_scheduler(model_path if name == model_path else find_model(name, folder))
+    return ModelRegistry(
+        load,
+        (settings or {}).get("model_name") or model_path,
+        max_resident=int(os.getenv("MAX_RESIDENT_MODELS", 1)),
+        allow_selection=os.getenv("ALLOW_MODEL_SELECTION", "false").lower() == "true",
+    )
+
+class ModelRegistry:
+    """The loaded models and their schedulers, least recently used first."""
+
+    def __init__(self, load: Callable[[str], Scheduler], default: str, max_resident: int=1,
+                 allow_selection: bool=True):
+        """Initialize the registry, nothing is loaded until it is used.
+            load: loads a model by name and returns its scheduler
+            default: the model of the requests that do not choose one
+            max_resident: how many models are loaded or loading at once
+            allow_selection: whether requests may choose another model than the default
+        """
+        self.load = load
+        self.default = default
+        self.max_resident = max(1, max_resident)
+        self.allow_selection = allow_selection
+        self.loads = 0
+        self.unloads = 0
+        self._resident: OrderedDict = OrderedDict()
+        # Requests running on every scheduler, a scheduler is closed once its count is 0
+        self._users: Dict[Scheduler, int] = {}
+        self._loading: Dict[str, Future] = {}
+        self._lock = threading.Condition()
+
+    @contextmanager
+    def lease(self, name: Optional[str]=None) -> Iterator[Scheduler]:
+        """The scheduler of a model, loaded if needed; it is not unloaded while leased.
+            Raises ValueError for another model than the default when requests can not choose it.
+        """
+        if name is not None and name != self.default and not self.allow_selection:
+            raise ValueError("Requests can not choose the model, set ALLOW_MODEL_SELECTION to allow it")
+        scheduler = self._acquire(name or self.default)
+        try:
+            yield scheduler
+        finally:
+            self._release(scheduler)
+
+    def _release(self, scheduler: Scheduler):
+        with self._lock:
+            self._users[scheduler] -= 1
+            self._lock.notify_all()
+
+    def _acquire(self, name: str) -> Scheduler:
+        while True:
+            with self._lock:
+                if name in self._resident:
+                    self._resident.move_to_end(name)
+                    scheduler = self._resident[name]
+                    self._users[scheduler] += 1
+                    return scheduler
+                future = self._loading.get(name)
+                loader = future is None
+                if loader:
+                    if not self._resident and len(self._loading) >= self.max_resident:
+                        # Every slot is taken by a model that is loading, wait for one of them
+                        self._lock.wait()
+                        continue
+                    future = self._loading[name] = Future()
+                    # Make room first, so the model leaving is unloaded before this one loads
+                    retiring = self._evict(len(self._resident) + len(self._loading) - self.max_resident)
+            if not loader:
+                # Someone else is loading it, wait and take it from the resident models
+                future.result()
+                continue
+            try:
+                for thread in retiring:
+                    thread.join()
+                scheduler = self.load(name)
+            except BaseException as e:
+                with self._lock:
+                    del self._loading[name]
+                    self._lock.notify_all()
+                future.set_exception(e)
+                raise
+            with self._lock:
+                del self._loading[name]
+                self._resident[name] = scheduler
+                self._users[scheduler] = 0
+                self.loads += 1
+                self._lock.notify_all()
+            future.set_result(scheduler)
+
+    def _evict(self, count: int) -> List[threading.Thread]:
+        """Unload the count least recently used models, returns the threads that close them."""
+        threads = []
+        for _ in range(max(0, count)):
+            name, scheduler = self._resident.popitem(last=False)
+            self.unloads += 1
+            thread = threading.Thread(target=self._retire, args=(scheduler,), name=f"unload-{name}", daemon=True)
+            thread.start()
+            threads.append(thread)
+        return threads
+
+    def _retire(self, scheduler: Scheduler):
+        """Close a scheduler once the requests running on it are done."""
+        with self._lock:
+            while self._users[scheduler] > 0:
+                self._lock.wait()
+            del self._users[scheduler]
+        scheduler.close()
+
+    def set_default(self, name: str):
+        """Load a model and make it the default, the requests already running keep their model."""
+        with self._lock:
+            full = name not in self._resident and len(self._resident) + len(self._loading) >= self.max_resident
+        previous = self.default
+        if full:
+            # The old model is unloaded before the new one loads, the requests wait for the new one
+            self.default = name
+        try:
+            scheduler = self._acquire(name)
+        except BaseException:
+            if self.default == name:
+                self.default = previous
+            raise
+        self.default = name
+        self._release(scheduler)
+
+    def generate(self, prompt: str, stop: Optional[List[str]]=None, on_token: Optional[Callable[[str], None]]=None,
+                 session: Optional[str]=None, timeout: Optional[float]=None,
+                 cancel: Optional[threading.Event]=None) -> str:
+        """Generate with the default model."""
+        with self.lease() as scheduler:
+            return scheduler.generate(prompt, stop=stop, on_token=on_token, session=session, timeout=timeout,
+                                      cancel=cancel)
+
+    def count_tokens(self, text: str) -> int:
+        """The number of tokens of a text with the tokenizer of the default model."""
+        with self.lease() as scheduler:
+            return scheduler.count_tokens(text)
+
+    @property
+    def prompt_budget(self) -> int:
+        """The most prompt tokens the default model has room for."""
+        with self.lease() as scheduler:
+            return scheduler.prompt_budget
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of prompts waiting on every loaded model."""
+        with self._lock:
+            return sum(scheduler.queue_depth for scheduler in self._resident.values())
+
+    @property
+    def active(self) -> int:
+        """The number of prompts being decoded on every loaded model."""
+        with self._lock:
+            return sum(scheduler.active for scheduler in self._resident.values())
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the loaded models and the stats of their schedulers."""
+        with self._lock:
+            resident = list(self._resident.items())
+            loading = list(self._loading)
+        return {
+            'default': self.default,
+            'max_resident': self.max_resident,
+            'loading': loading,
+            'loads': self.loads,
+            'unloads': self.unloads,
+            'models': {name: scheduler.stats() for name, scheduler in resident},
+        }
+
+    def close(self):
+        """Close every loaded model once its queued prompts are done."""
+        with self._lock:
+            resident = list(self._resident.values())
+            self._resident.clear()
+        for scheduler in resident:
+            scheduler.close()
@@ -0,0 +1,143 @@
+import json
+
+"""
+The request and response objects shared by the websocket and http servers.
+"""
+SERVER_CODES = {
+    'SUCCESS': 23,
+    'ERROR': -1,
+    'RUNNING': 0,
+    'CANCELLED': 1
+}
+
+class PromptRequest:
+    """A request for a prompt."""
+
+    def __init__(self, complete_prompt, chat_text: dict={'user': '', 'ai': ''},
+                 names:dict={'user_name': 'user', 'ai_name': 'ai'}, chat:dict={'user_text': '', 'ai_text': ''}, args:dict=None,
+                 save: bool=False, memory:bool=False, conversation_id: str|None=None, user_id: str|None=None,
+                 model: str|None=None, session: bool=False, cache: bool=False, semantic_cache: bool=False):
+        """Initialize the prompt request."""
+        self.args = args
+        self.names = names
+        self.complete_prompt = complete_prompt
+        self.chat_text = chat_text
+        self.chat = chat
+        self.save = save
+        self.memory = memory
+        self.conversation_id = conversation_id
+        self.user_id = user_id
+        self.model = model
+        self.session = session
+        self.cache = cache
+        self.semantic_cache = semantic_cache
+
+    def to_json(self):
+        dict={'args': self.args, 'names': self.names, 'complete_prompt': self.complete_prompt, 'chat_text': self.chat_text, 'chat': self.chat
+                , 'save': self.save, 'memory': self.memory, 'conversation_id': self.conversation_id, 'user_id': self.user_id, 'model': self.model, 'session': self.session,
+                'cache': self.cache, 'semantic_cache': self.semantic_cache}
+        return json.dumps(dict)
+
+    def __str__(self):
+        """Return the string representation of the prompt request."""
+        return f"PromptRequest(args={self.args}, names={self.names}, complete_prompt={self.complete_prompt}, chat_text={self.chat_text})"
+
+    def __repr__(self):
+        """Return the string representation of the prompt request."""
+        return self.__str__()
+
+class PromptResponse:
+    """A response to a prompt."""
+
+    def __init__(self, status: int, token: str|None=None, prompt: str|None=None, error: str|None=None, chat:dict={'user_text': '', 'ai_text': ''}):
+        """Initialize the prompt response."""
+        self.status = status
+        self.token = token
+        self.prompt = prompt
+        self.chat=chat
+        self.error = error
+
+    def to_json(self):
+        dict={'status': self.status, 'token': self.token, 'prompt': self.prompt, 'error': self.error, 'chat': self.chat}
+        return json.dumps(dict)
+
+    def __str__(self):
+        """Return the string representation of the prompt response."""
+        return f"PromptResponse(status={self.status}, token={self.token}, error={self.error})"
+
+    def __repr__(self):
+        """Return the string representation of the prompt response."""
+        return self.__str__()
+
+def validate_prompt_request(prompt_dictionary: dict, save: bool=False, memory: bool=False) -> PromptRequest:
+    """Validate the prompt request.
+        save and memory are the defaults used when the request does not set them.
+    """
+
+    # Check if the completed prompt is a string and in the dictionary
+    if "complete_prompt" not in prompt_dictionary or not isinstance(prompt_dictionary["complete_prompt"], str):
+        raise ValueError("Prompt must be a string")
+    prompt = prompt_dictionary["complete_prompt"]
+    # Check if the chat text is a dictionary
+    if "chat_text" not in prompt_dictionary or not isinstance(prompt_dictionary["chat_text"], dict):
+        raise ValueError("Chat text must be a dictionary")
+    chat_text = prompt_dictionary["chat_text"]
+    # Check if the args is a dictionary
+    if "args" not in prompt_dictionary or not isinstance(prompt_dictionary["args"], dict):
+        raise ValueError("Args must be a dictionary")
+    args = prompt_dictionary["args"]
+    # Check if the names is a dictionary
+    if "names" not in prompt_dictionary or not isinstance(prompt_dictionary["names"], dict):
+        raise ValueError("Names must be a dictionary")
+    names = prompt_dictionary["names"]
+
+    # Check if the chat is a dictionary
+    if "chat" not in prompt_dictionary or not isinstance(prompt_dictionary["chat"], dict):
+        raise ValueError("Chat must be a dictionary")
+    chat = prompt_dictionary["chat"]
+    # Check the optional flags
+    save = prompt_dictionary.get("save", save)
+    if not isinstance(save, bool):
+        raise ValueError("Save must be a boolean")
+    memory = prompt_dictionary.get("memory", memory)
+    if not isinstance(memory, bool):
+        raise ValueError("Memory must be a boolean")
+    conversation_id = prompt_dictionary.get("conversation_id")
+    if conversation_id is not None and not isinstance(conversation_id, str):
+        raise ValueError("Conversation id must be a string")
+    user_id = prompt_dictionary.get("user_id")
+    if user_id is not None and not isinstance(user_id, str):
+        raise ValueError("User id must be a string")
+    model = prompt_dictionary.get("model")
+    if model is not None and not isinstance(model, str):
+        raise ValueError("Model must be a string")
+    session = prompt_dictionary.get("session", False)
+    if not isinstance(session, bool):
+        raise ValueError("Session must be a boolean")
+    cache = prompt_dictionary.get("cache", False)
+    if not isinstance(cache, bool):
+        raise ValueError("Cache must be a boolean")
+    semantic_cache = prompt_dictionary.get("semantic_cache", False)
+    if not isinstance(semantic_cache, bool):
+        raise ValueError("Semantic cache must be a boolean")
+    return PromptRequest(
+        complete_prompt=prompt,
+        chat_text=chat_text,
+        args=args,
+        names=names,
+        chat=chat,
+        save=save,
+        memory=memory,
+        conversation_id=conversation_id,
+        user_id=user_id,
+        model=model,
+        session=session,
+        cache=cache,
+        semantic_cache=semantic_cache,
+    )
+
+def validate_session_message(message: dict) -> str:
+    """Validate a later message of a session and return its user text."""
+    if "user_text" not in message or not isinstance(message["user_text"], str):
+        raise ValueError("User text must be a string")
+    return message["user_text"]
@@ -0,0 +1,112 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, List, Optional
+
+"""
+Many turns are the same few words ("hi", "continue", "ok"), and each one pays for an
+embedding and a vector query. RetrievalCacheStore wraps a vector store and keeps the
+results of similarity_search, keyed by the normalized query and k, for ttl seconds.
+
+The results are grouped by namespace (the namespace search argument and the namespace
+metadata of the saved texts). Saving texts in a namespace invalidates the cached results
+of that namespace and of the searches without one, which read every namespace; texts
+saved without one invalidate everything.
+"""
+
+class RetrievalCacheStore:
+    """A vector store wrapper with an LRU and TTL cache in front of similarity_search."""
+
+    def __init__(self, vectorstore, maxsize: int=1024, ttl: float=300):
+        """Initialize the cache."""
+        self.vectorstore = vectorstore
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # key -> (docs, namespace generation, global generation, time stored)
+        self._results: OrderedDict = OrderedDict()
+        self._generations: Dict[Hashable, int] = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.vectorstore, name)
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        """Lower case the query and collapse its whitespace."""
+        return " ".join(query.lower().split())
+
+    def similarity_search(self, query: str, k: int=4, **kwargs: Any) -> List:
+        """Return the cached docs of the query, searching the store on a miss."""
+        namespace = kwargs.get("namespace")
+        key = (namespace, self.normalize(query), k, repr(sorted(kwargs.items())))
+        with self._lock:
+            generation = self._generations.get(namespace, 0)
+            entry = self._results.get(key)
+            if entry is not None:
+                docs, entry_generation, entry_global, stored = entry
+                fresh = time.monotonic() - stored < self.ttl
+                if fresh and entry_generation == generation and entry_global == self._generation:
+                    self._results.move_to_end(key)
+                    self.hits += 1
+                    return list(docs)
+                del self._results[key]
+            self.misses += 1
+            global_generation = self._generation
+        docs = self.vectorstore.similarity_search(query, k=k, **kwargs)
+        if not getattr(docs, "cacheable", True):
+            # A degraded answer (see HybridStore), the next search tries the store again
+            return docs
+        with self._lock:
+            # Generations read before the search, a write during it makes the entry stale
+            self._results[key] = (list(docs), generation, global_generation, time.monotonic())
+            self._results.move_to_end(key)
+            while len(self._results) > self.maxsize:
+                self._results.popitem(last=False)
+        return docs
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]]=None, **kwargs: Any) -> List[str]:
+        """Save the texts, then invalidate the results of their namespaces."""
+        texts = list(texts)
+        ids = self.vectorstore.add_texts(texts, metadatas=metadatas, **kwargs)
+        namespaces = set()
+        if metadatas is not None:
+            namespaces = {metadata.get("namespace") for metadata in metadatas}
+        self.invalidate(namespaces if metadatas is not None and None not in namespaces else None)
+        return ids
+
+    def delete(self, ids: Iterable[str], namespace: Optional[Hashable]=None, **kwargs: Any):
+        """Delete memories, then invalidate the results of their namespace, of every namespace when None."""
+        self.vectorstore.delete(ids, **kwargs)
+        self.invalidate(None if namespace is None else [namespace])
+
+    def invalidate(self, namespaces: Optional[Iterable[Hashable]]=None):
+        """Make the results of the namespaces stale, of every namespace when None.
+            The searches without a namespace see every write, so they are always made stale.
+        """
+        with self._lock:
+            self.invalidations += 1
+            if namespaces is None:
+                self._generation += 1
+                return
+            for namespace in set(namespaces) | {None}:
+                self._generations[namespace] = self._generations.get(namespace, 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the size and the hit ratio of the cache."""
+        lookups = self.hits + self.misses
+        stats = {
+            'size': len(self._results),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else None,
+            'invalidations': self.invalidations,
+        }
+        inner = getattr(self.vectorstore, "stats", None)
+        if inner is not None:
+            stats['store'] = inner()
+        return stats
@@ -0,0 +1,384 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional
+from server.kv_cache import KVStateCache
+from server.metrics import metrics
+
+"""
+The scheduler owns the LlamaCpp instance and is the only thing allowed to touch it.
+Every client (websocket or http) submits its formatted prompt here and the scheduler
+decodes up to max_active prompts at once, round robin, a quantum of tokens at a time.
+
+llama.cpp only has one context, so switching between prompts saves the KV state of
+the prompt that is leaving and loads the state of the one that is coming back.
+If the model can not save its state the scheduler falls back to one prompt at a time.
+A state is the whole KV cache, about 1 GB for a 7B model with a 2048 context, so a switch
+costs far more than a token: by default one prompt is decoded at a time, and with more the
+parked states are held to max_parked_bytes, past which the resident prompt keeps the context.
+
+With a KVStateCache the state a conversation ends its turn with is kept, and its next
+prompt starts from it so llama.cpp only evaluates the tokens that are new.
+
+A job is cancelled by setting its cancel event, from any thread. The scheduler checks it
+before every token, so a cancelled job stops within a token, or never starts if it is still
+queued, and its result raises GenerationCancelled.
+"""
+
+class GenerationCancelled(Exception):
+    """The generation was cancelled before it finished."""
+
+class GenerationJob:
+    """A prompt waiting for, or being decoded by, the scheduler."""
+
+    def __init__(self, prompt: str, stop: Optional[List[str]]=None, on_token: Optional[Callable[[str], None]]=None,
+                 session: Optional[str]=None, cancel: Optional[threading.Event]=None):
+        """Initialize the job."""
+        self.prompt = prompt
+        self.stop = stop
+        self.on_token = on_token
+        self.session = session
+        # Set by whoever wants the generation stopped
+        self.cancel_event = cancel if cancel is not None else threading.Event()
+        # The prompt tokens a cached KV state already held
+        self.prefix_tokens = 0
+        # The bytes of the saved state while the job is swapped out
+        self.state_size = 0
+        self.tokens: List[str] = []
+        self.error: Optional[BaseException] = None
+        self.submitted_at: float = time.monotonic()
+        self.started_at: Optional[float] = None
+        # When the job first held the llama context, and when its first token came out
+        self.first_step_at: Optional[float] = None
+        self.first_token_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        # The llama_cpp generator and the saved KV state while the job is swapped out
+        self.stream = None
+        self.state = None
+        self._done = threading.Event()
+
+    @property
+    def output(self) -> str:
+        """The text generated so far."""
+        return "".join(self.tokens)
+
+    @property
+    def wait_time(self) -> Optional[float]:
+        """Seconds spent in the queue before the first decode step."""
+        if self.started_at is None:
+            return None
+        return self.started_at - self.submitted_at
+
+    def done(self) -> bool:
+        """Return True once the job finished or failed."""
+        return self._done.is_set()
+
+    def cancel(self):
+        """Stop the generation at the next token, safe to call from any thread."""
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        """Whether the job was asked to stop."""
+        return self.cancel_event.is_set()
+
+    def result(self, timeout: Optional[float]=None) -> str:
+        """Block until the job is done and return the generated text."""
+        if not self._done.wait(timeout):
+            raise TimeoutError("Generation did not finish in time")
+        if self.error is not None:
+            raise self.error
+        return self.output
+
+    def _finish(self, error: Optional[BaseException]=None):
+        self.error = error
+        self.finished_at = time.monotonic()
+        self.state = None
+        self._done.set()
+
+    def __repr__(self):
+        """Return the string representation of the job."""
+        return f"GenerationJob(tokens={len(self.tokens)}, wait_time={self.wait_time}, done={self.done()})"
+
+class Scheduler:
+    """Queues prompts from every client and interleaves their decoding on one model."""
+
+    def __init__(self, llm, max_active: int=1, quantum: int=64, max_queue: int=0, echo: bool=True,
+                 kv_cache: Optional[KVStateCache]=None, max_parked_bytes: int=0):
+        """Initialize the scheduler and start its worker thread.
+            llm: the LlamaCpp instance, the scheduler becomes its only user
+            max_active: how many prompts are decoded at the same time
+            quantum: how many tokens a prompt decodes before the next one gets a turn
+            max_queue: the maximum number of waiting prompts (0 means unbounded)
+            echo: print every token to stdout
+            kv_cache: where the KV state of each conversation is kept between turns
+            max_parked_bytes: the most bytes of saved states of swapped out prompts (0 means unbounded)
+        """
+        self.llm = llm
+        self.max_active = max(1, max_active) if self._can_swap() else 1
+        self.kv_cache = kv_cache if self._can_swap() else None
+        self.quantum = max(1, quantum)
+        self.max_parked_bytes = max_parked_bytes
+        self.echo = echo
+        self.completed = 0
+        self.cancelled = 0
+        self.parked_bytes = 0
+        # The size of the last saved state, what parking the resident prompt is expected to cost
+        self._state_size = 0
+        self._closed = False
+        self._pending: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._active: deque = deque()
+        self._resident: Optional[GenerationJob] = None
+        # The cached state the llama context still matches, if any
+        self._context_state = None
+        self._wait_times: deque = deque(maxlen=1000)
+        self._lock = threading.Lock()
+        # Held while the llama context is used, by the decode thread and by count_tokens
+        self._context_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="scheduler", daemon=True)
+        self._thread.start()
+
+    def submit(self, prompt: str, stop: Optional[List[str]]=None, on_token: Optional[Callable[[str], None]]=None,
+               session: Optional[str]=None, cancel: Optional[threading.Event]=None) -> GenerationJob:
+        """Queue a formatted prompt and return its job.
+            on_token is called from the scheduler thread for every generated token.
+            session names the conversation, its KV state is kept for its next prompt.
+            cancel stops the generation once it is set.
+        """
+        job = GenerationJob(prompt, stop=stop, on_token=on_token, session=session, cancel=cancel)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The scheduler is closed")
+            try:
+                self._pending.put_nowait(job)
+            except queue.Full:
+                raise RuntimeError("The scheduler queue is full")
+        return job
+
+    def generate(self, prompt: str, stop: Optional[List[str]]=None, on_token: Optional[Callable[[str], None]]=None,
+                 session: Optional[str]=None, timeout: Optional[float]=None,
+                 cancel: Optional[threading.Event]=None) -> str:
+        """Queue a formatted prompt and block until its text is generated.
+            Raises GenerationCancelled when cancel is set first.
+        """
+        return self.submit(prompt, stop=stop, on_token=on_token, session=session, cancel=cancel).result(timeout)
+
+    def count_tokens(self, text: str) -> int:
+        """The number of tokens of a text with the model's tokenizer.
+            The tokenizer belongs to the llama context, so it waits for the token being decoded.
+            The count includes the BOS token, so budgets built on it err on the safe side.
+        """
+        with self._context_lock:
+            return len(self.llm.client.tokenize(text.encode()))
+
+    @property
+    def prompt_budget(self) -> int:
+        """The most prompt tokens that leave the model room in its context for max_tokens more."""
+        n_ctx = getattr(self.llm, "n_ctx", None) or 2048
+        max_tokens = getattr(self.llm, "max_tokens", None) or 256
+        return n_ctx - max_tokens
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of prompts waiting for a decode slot."""
+        return self._pending.qsize()
+
+    @property
+    def active(self) -> int:
+        """The number of prompts currently being decoded."""
+        return len(self._active)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the queue depth and the wait times of the recent requests."""
+        with self._lock:
+            waits = sorted(self._wait_times)
+        stats = {
+            'queue_depth': self.queue_depth,
+            'active': self.active,
+            'max_active': self.max_active,
+            'quantum': self.quantum,
+            'completed': self.completed,
+            'cancelled': self.cancelled,
+            'parked_bytes': self.parked_bytes,
+            'max_parked_bytes': self.max_parked_bytes,
+            'wait_avg': None,
+            'wait_p95': None,
+            'wait_max': None,
+        }
+        if waits:
+            stats['wait_avg'] = sum(waits) / len(waits)
+            stats['wait_p95'] = waits[min(len(waits) - 1, int(len(waits) * 0.95))]
+            stats['wait_max'] = waits[-1]
+        if self.kv_cache is not None:
+            stats['kv_cache'] = self.kv_cache.stats()
+        return stats
+
+    def close(self):
+        """Stop the worker thread once the queued prompts are done, submitting afterwards raises."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._pending.put(None)
+        self._thread.join()
+
+    def _can_swap(self) -> bool:
+        client = getattr(self.llm, "client", None)
+        return hasattr(client, "save_state") and hasattr(client, "load_state")
+
+    def _run(self):
+        """Admit queued jobs and decode the active ones round robin."""
+        closing = False
+        while True:
+            if not closing:
+                closing = not self._admit()
+            if not self._active:
+                if closing:
+                    break
+                continue
+            job = self._active[0]
+            if self._step(job):
+                if self._can_park():
+                    self._active.rotate(-1)
+            else:
+                self._active.popleft()
+                if self._resident is job:
+                    self._resident = None
+
+    def _can_park(self) -> bool:
+        """Whether the state of the resident prompt fits in max_parked_bytes, for the next prompt to take its turn."""
+        if not self.max_parked_bytes or len(self._active) < 2 or self._resident is not self._active[0]:
+            return True
+        # Swapping the next prompt in frees its state
+        upcoming = self._active[1]
+        return self.parked_bytes + self._state_size - upcoming.state_size <= self.max_parked_bytes
+
+    def _admit(self) -> bool:
+        """Move queued jobs into free decode slots, returns False when closing."""
+        # Sleep on the queue while there is nothing to decode
+        block = not self._active
+        while len(self._active) < self.max_active:
+            try:
+                job = self._pending.get(block=block)
+            except queue.Empty:
+                break
+            if job is None:
+                return False
+            if job.cancelled:
+                # Cancelled while it waited, it never takes a slot
+                self._cancel(job)
+                continue
+            try:
+                self._start(job)
+            except Exception as e:
+                logging.error(e)
+                job._finish(e)
+            block = False
+        return True
+
+    def _start(self, job: GenerationJob):
+        job.started_at = time.monotonic()
+        with self._lock:
+            self._wait_times.append(job.wait_time)
+        metrics.observe("queue_wait_seconds", job.wait_time)
+        logging.info(f"Scheduler: request waited {job.wait_time:.3f}s, {self.queue_depth} still queued")
+        params = self.llm._get_parameters(job.stop)
+        # Nothing runs until the first next(), so the context is not touched yet
+        job.stream = self.llm.client(prompt=job.prompt, stream=True, **params)
+        self._active.append(job)
+
+    def _swap_in(self, job: GenerationJob):
+        """Make the llama context hold the KV state of the job."""
+        if self._resident is job:
+            return
+        client = self.llm.client
+        if self._resident is not None and not self._resident.done():
+            self._park(self._resident, client.save_state())
+        if job.state is not None:
+            client.load_state(job.state)
+            self._unpark(job)
+        elif self.kv_cache is not None:
+            # A job that never ran, start it from the cached state with the longest shared prefix
+            state, job.prefix_tokens = self.kv_cache.lookup(job.session, client.tokenize(job.prompt.encode()))
+            if state is not None and state is not self._context_state:
+                client.load_state(state)
+        self._context_state = None
+        self._resident = job
+        if job.first_step_at is None:
+            job.first_step_at = time.monotonic()
+
+    def _park(self, job: GenerationJob, state):
+        job.state = state
+        job.state_size = self._state_size = KVStateCache.state_size(state)
+        self.parked_bytes += job.state_size
+
+    def _unpark(self, job: GenerationJob):
+        if job.state is not None:
+            self.parked_bytes -= job.state_size
+        job.state = None
+        job.state_size = 0
+
+    def _step(self, job: GenerationJob) -> bool:
+        """Decode one quantum of the job, returns False once the job is finished."""
+        try:
+            for _ in range(self.quantum):
+                if job.cancelled:
+                    job.stream.close()
+                    self._cancel(job)
+                    return False
+                with self._context_lock:
+                    self._swap_in(job)
+                    chunk = next(job.stream)
+                token = chunk["choices"][0]["text"]
+                if job.first_token_at is None:
+                    self._first_token(job)
+                job.tokens.append(token)
+                if self.echo:
+                    print(token, end="", flush=True)
+                if job.on_token is not None:
+                    job.on_token(token)
+        except StopIteration:
+            if self.echo:
+                print("")
+            self.completed += 1
+            self._remember(job)
+            job._finish()
+            if job.first_token_at is not None and len(job.tokens) > 1 and job.finished_at > job.first_token_at:
+                metrics.observe("decode_tokens_per_second", (len(job.tokens) - 1) / (job.finished_at - job.first_token_at))
+            return False
+        except Exception as e:
+            logging.error(e)
+            job.stream.close()
+            self._unpark(job)
+            job._finish(e)
+            return False
+        return True
+
+    def _cancel(self, job: GenerationJob):
+        if self.echo and job.tokens:
+            print("")
+        logging.info(f"Scheduler: request cancelled after {len(job.tokens)} tokens")
+        self.cancelled += 1
+        metrics.inc("cancelled_total")
+        self._unpark(job)
+        job._finish(GenerationCancelled("The generation was cancelled"))
+
+    def _first_token(self, job: GenerationJob):
+        job.first_token_at = time.monotonic()
+        metrics.observe("ttft_seconds", job.first_token_at - job.submitted_at)
+        metrics.observe("prompt_eval_seconds", job.first_token_at - job.first_step_at)
+
+    def _remember(self, job: GenerationJob):
+        """Keep the KV state the job's conversation ended its turn with."""
+        if self.kv_cache is None or job.session is None:
+            return
+        try:
+            with self._context_lock:
+                self._context_state = self.llm.client.save_state()
+            self._state_size = KVStateCache.state_size(self._context_state)
+            self.kv_cache.put(job.session, self._context_state)
+        except Exception as e:
+            logging.error(e)
+            self._context_state = None
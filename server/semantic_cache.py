@@ -0,0 +1,148 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+from server.metrics import metrics
+
+"""
+Users greet a persona, thank it and ask it how it is doing in many words that mean the same
+thing ("hello there", "hi there"), and the model writes the same kind of answer every time.
+SemanticCache keeps the answers of a scope, a template with its names and model for one user,
+next to the embedding of the user text they answered. A user text whose cosine similarity with one of them
+is at least the threshold gets that answer back without running the model.
+
+Every scope is a small matrix of normalized vectors scanned with one matrix product, it holds
+the newest max_entries answers and forgets the ones older than ttl seconds. The best similarity
+of every lookup goes to a histogram, so the threshold can be tuned from how close the hits and
+the near misses were.
+"""
+
+class SemanticScope:
+    """The answers of a scope, a ring of max_entries vectors."""
+
+    def __init__(self, dimensions: int, max_entries: int):
+        """Initialize an empty scope."""
+        self.vectors = np.zeros((0, dimensions), dtype=np.float32)
+        self.answers: List[List[str]] = []
+        self.created = np.zeros(0, dtype=np.float64)
+        self.max_entries = max_entries
+        # The slot the next answer goes to once the ring is full
+        self.next = 0
+
+    def add(self, vector: np.ndarray, answer: List[str], now: float):
+        """Keep an answer, replacing the oldest one when the ring is full."""
+        if len(self.answers) < self.max_entries:
+            # Grow by doubling so adding stays cheap
+            if len(self.answers) == len(self.vectors):
+                capacity = min(self.max_entries, max(8, 2 * len(self.vectors)))
+                self.vectors = np.resize(self.vectors, (capacity, self.vectors.shape[1]))
+                self.created = np.resize(self.created, capacity)
+            slot = len(self.answers)
+            self.answers.append(answer)
+        else:
+            slot = self.next
+            self.next = (self.next + 1) % self.max_entries
+            self.answers[slot] = answer
+        self.vectors[slot] = vector
+        self.created[slot] = now
+
+    def trim(self):
+        """The vectors and creation times of the slots in use."""
+        return self.vectors[:len(self.answers)], self.created[:len(self.answers)]
+
+class SemanticCache:
+    """Answers of previous requests, found by the similarity of their user text."""
+
+    def __init__(self, threshold: float=0.95, ttl: float=3600, max_entries: int=1024, max_scopes: int=256):
+        """Initialize the cache.
+            threshold: the cosine similarity a user text needs with a cached one to get its answer
+            ttl: seconds an answer is used for
+            max_entries: how many answers a scope keeps
+            max_scopes: how many scopes are kept, the least recently used one is dropped
+        """
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_scopes = max_scopes
+        self.hits = 0
+        self.misses = 0
+        # Lookups whose best match was less than 0.05 under the threshold
+        self.near_misses = 0
+        self.hit_similarity = 0.0
+        self._scopes: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def scope(self, template: str, names: Dict[str, Any], model: Optional[str]=None, namespace: Any=None) -> str:
+        """The scope of the answers of a template with its names on a model.
+            namespace is the user the answers are for, an answer written from the memories of a
+            user is never given to another one.
+        """
+        return hashlib.sha256(json.dumps([model, template, names, namespace], sort_keys=True, default=str).encode()).hexdigest()
+
+    def embed(self, text: str, embeddings) -> np.ndarray:
+        """The normalized embedding of a user text."""
+        vector = np.asarray(embeddings.embed_query(text), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, scope: str, vector: np.ndarray) -> Tuple[Optional[List[str]], float]:
+        """The tokens of the answer most similar to the vector if it passes the threshold, and its similarity."""
+        with self._lock:
+            entries = self._scopes.get(scope)
+            slot, similarity = None, -1.0
+            if entries is not None and entries.vectors.shape[1] == len(vector):
+                self._scopes.move_to_end(scope)
+                vectors, created = entries.trim()
+                similarities = vectors @ vector
+                similarities[created < time.time() - self.ttl] = -1.0
+                if len(similarities):
+                    slot = int(np.argmax(similarities))
+                    similarity = float(similarities[slot])
+            if slot is not None and similarity >= self.threshold:
+                self.hits += 1
+                self.hit_similarity += similarity
+                answer = entries.answers[slot]
+            else:
+                self.misses += 1
+                if similarity >= self.threshold - 0.05:
+                    self.near_misses += 1
+                answer = None
+        if similarity >= 0:
+            metrics.observe("semantic_cache_similarity", similarity)
+        metrics.inc("semantic_cache_hits_total" if answer is not None else "semantic_cache_misses_total")
+        return answer, similarity
+
+    def put(self, scope: str, vector: np.ndarray, answer: List[str]):
+        """Keep the tokens of an answer under the vector of its user text."""
+        with self._lock:
+            entries = self._scopes.get(scope)
+            if entries is None or entries.vectors.shape[1] != len(vector):
+                # A new scope, or new embeddings whose vectors can not be compared with the old ones
+                entries = self._scopes[scope] = SemanticScope(len(vector), self.max_entries)
+            self._scopes.move_to_end(scope)
+            entries.add(vector, list(answer), time.time())
+            while len(self._scopes) > self.max_scopes:
+                self._scopes.popitem(last=False)
+
+    def clear(self):
+        """Forget every answer."""
+        with self._lock:
+            self._scopes.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the size, the hit ratio and how similar the hits were."""
+        lookups = self.hits + self.misses
+        return {
+            'threshold': self.threshold,
+            'ttl': self.ttl,
+            'scopes': len(self._scopes),
+            'answers': sum(len(entries.answers) for entries in self._scopes.values()),
+            'hits': self.hits,
+            'misses': self.misses,
+            'near_misses': self.near_misses,
+            'hit_ratio': self.hits / lookups if lookups else None,
+            'hit_similarity_avg': self.hit_similarity / self.hits if self.hits else None,
+        }
@@ -2,15 +2,27 @@ from typing import Callable
 import websockets
 import asyncio
 import json
-SERVER_CODES = {
-    'SUCCESS': 23,
-    'ERROR': -1,
-    'RUNNING': 0
-}
+from server.codec import get_codec, subprotocols
+from server.metrics import metrics
+from server.protocol import SERVER_CODES, PromptRequest, PromptResponse, validate_prompt_request
 
 class Server:
-	def __init__(self):
+	def __init__(self, max_outbox: int=256, overflow: str="drop"):
+		"""Every client gets an outbox of max_outbox messages and a writer task that sends them in order,
+			a broadcast only queues the message so a slow client never holds up the others.
+			overflow is what happens to a client whose outbox is full when a broadcast comes:
+				drop - the broadcast is not sent to it
+				disconnect - the client is disconnected
+		"""
+		if overflow not in ("drop", "disconnect"):
+			raise ValueError("Unknown overflow policy {}".format(overflow))
 		self.clients: dict= {}
+		self.outboxes: dict = {}
+		self.writers: dict = {}
+		# The clients being disconnected for being too slow
+		self.closing: set = set()
+		self.max_outbox = max_outbox
+		self.overflow = overflow
 		self.id: int = 0
 		self.on_message : Callable[[int, str], None] = lambda client_id, message: None
 		self.on_error : Callable[[int, str], None] = lambda client_id, error: None
@@ -21,6 +33,9 @@ class Server:
 	async def register(self, ws):
 		client_id = self.id
 		self.clients[self.id] = ws
+		self.outboxes[client_id] = asyncio.Queue(maxsize=self.max_outbox)
+		self.writers[client_id] = asyncio.ensure_future(self.write(client_id, ws, self.outboxes[client_id]))
+		metrics.inc("connections_total")
 		self.on_connect(self.id)
 		print("Client {} connected".format(ws.remote_address))
 		self.id += 1
@@ -29,23 +44,86 @@ class Server:
 	async def unregister(self, client_id):
 		if client_id in self.clients:
 			del self.clients[client_id]
+			self.writers.pop(client_id).cancel()
+			self.closing.discard(client_id)
+			# The messages still queued are never sent
+			outbox = self.outboxes.pop(client_id)
+			while not outbox.empty():
+				_, sent = outbox.get_nowait()
+				if sent is not None and not sent.done():
+					sent.set_exception(ValueError("Client {} not found".format(client_id)))
+			metrics.inc("disconnects_total")
 			self.on_disconnect(client_id)
 			print("Client {} disconnected from server".format(client_id))
 		else:
 			raise ValueError("Client {} not found".format(client_id))
 		
+	def snapshot(self) -> list:
+		"""The connected clients as (client_id, ws) pairs, safe to iterate while clients come and go"""
+		return list(self.clients.items())
+
+	async def write(self, client_id, ws, outbox):
+		"""Send the messages of the outbox of a client in order, the only task that writes to its socket
+			Once the connection is closed every message left fails with the error
+		"""
+		closed = None
+		while True:
+			message, sent = await outbox.get()
+			error = closed
+			if error is None:
+				try:
+					await ws.send(message)
+				except asyncio.CancelledError:
+					# The client was unregistered while the message was being sent
+					if sent is not None and not sent.done():
+						sent.set_exception(ValueError("Client {} not found".format(client_id)))
+					raise
+				except websockets.exceptions.ConnectionClosed as e:
+					error = closed = e
+				except Exception as e:
+					error = e
+				else:
+					self.on_send(client_id, message)
+			if sent is not None and not sent.done():
+				if error is None:
+					sent.set_result(None)
+				else:
+					sent.set_exception(error)
+
 	async def send_to_clients(self, message):
-		for id, client in self.clients.items():
-			await client.send(message)
-			self.on_send(id, message)
-	
+		"""Queue a message for every client and return right away, the writers send it at the same time"""
+		for client_id, ws in self.snapshot():
+			outbox = self.outboxes.get(client_id)
+			if outbox is None or client_id in self.closing:
+				continue
+			try:
+				outbox.put_nowait((message, None))
+			except asyncio.QueueFull:
+				if self.overflow == "disconnect":
+					self.closing.add(client_id)
+					metrics.inc("slow_disconnects_total")
+					print("Client {} is too slow, disconnecting it".format(client_id))
+					asyncio.ensure_future(ws.close(code=1008, reason="Too slow"))
+				else:
+					metrics.inc("dropped_messages_total")
+		# Let the writers run, a client that keeps up has an empty outbox by the next broadcast
+		await asyncio.sleep(0)
+
 	async def send_to_client(self, client_id, message):
+		"""Send a message to a client after the ones queued for it, waiting while its outbox is full"""
 		if client_id in self.clients.keys():
-			await self.clients[client_id].send(message)
-			self.on_send(client_id, message)
+			sent = asyncio.get_running_loop().create_future()
+			await self.outboxes[client_id].put((message, sent))
+			await sent
 		else:
 			raise ValueError("Client {} not found".format(client_id))
 		
+	async def send_response(self, client_id, response: PromptResponse):
+		"""Send a response written in the subprotocol of the client"""
+		if client_id not in self.clients.keys():
+			raise ValueError("Client {} not found".format(client_id))
+		await self.send_to_client(client_id, get_codec(self.clients[client_id].subprotocol).encode_response(response))
+
 	async def receive(self, client_id):
 		if client_id in self.clients.keys():
 			message = await self.clients[client_id].recv()
@@ -54,6 +132,11 @@ class Server:
 		else:
 			raise ValueError("Client {} not found".format(client_id))
 		
+	async def receive_request(self, client_id) -> dict:
+		"""Receive a message and read it in the subprotocol of the client"""
+		message = await self.receive(client_id)
+		return get_codec(self.clients[client_id].subprotocol).decode_request(message)
+
 	async def ws_handler(self, ws, uri):
 		"""Handles the websocket connection
 			will loop forever until the connection is closed by the client or until server_handler 
@@ -72,6 +155,9 @@ class Server:
 			print("Connection with client {} closed".format(ws.remote_address))
 			self.on_error(ws.remote_address, "Connection closed unexpectedly by client")
 			self.on_disconnect(ws.remote_address)
+		except Exception:
+			metrics.inc("errors_total")
+			raise
 		finally:
 			await self.unregister(client_id)
 
@@ -82,9 +168,13 @@ class Server:
 		else:
 			raise ValueError("Client {} not found".format(client_id))
 
-	def start(self, host, port, handler):
+	def start(self, host, port, handler, process_request=None, compression="deflate"):
+		"""Serve until stopped, process_request can answer plain HTTP requests (like health checks) itself
+			compression is "deflate" to offer permessage-deflate, or None
+		"""
 		self.server_handler = handler
-		start_server = websockets.serve(self.ws_handler, host, port)
+		start_server = websockets.serve(self.ws_handler, host, port, process_request=process_request,
+			subprotocols=subprotocols(), compression=compression)
 		asyncio.get_event_loop().run_until_complete(start_server)
 		asyncio.get_event_loop().run_forever()
 	
@@ -107,59 +197,33 @@ class Server:
 		2. ai_name: str - the ai's name
 	args: dict - the arguments to send to the AI (optional) (history is required)
 		1. history (required): str - the history of the conversation
-
-    The server will then send back a dictionary with the following keys:
-    status: int | SERVER_CODES - the status code [23: success, -1: error, 0: running]
-    token: str - the token that got generated
+	save (optional): bool - whether to save the chat to the database (default: True)
+	memory (optional): bool - whether to use the memory (default: True)
+	conversation_id (optional): str - the conversation the prompt belongs to (default: the names)
+	user_id (optional): str - the user the memories are saved and searched for (default: the user's name)
+	model (optional): str - the model in the models folder to run the prompt on, with ALLOW_MODEL_SELECTION (default: MODEL_PATH)
+	cache (optional): bool - answer from the completion cache when the same prompt was generated before, only when the model has temperature 0 or a fixed seed (default: False)
+		the output is the same for temperature 0 or a fixed seed, the tokens are streamed like generated ones
+	semantic_cache (optional): bool - answer with the cached answer of a user text that means the same,
+		for the same template, names and user (default: False)
+	session (optional): bool - keep the connection and the conversation for the next turns (default: False)
+		every later message is only {"user_text": str} - the new user text, or {"type": "end"} to end the session,
+		and the prompt of its response is only the new ai text
+
+    While a prompt runs the client can send {"type": "cancel"} to stop it, the generation stops within
+    a token, nothing is saved and the last response has the status cancelled.
+
+    The server will then send back a dictionary with the following keys,
+    one with status running for every token and a last one with the whole prompt:
+    status: int | SERVER_CODES - the status code [23: success, -1: error, 0: running, 1: cancelled]
+    token: str - the tokens that got generated since the last message
     error: str - the error message if there was an error
-"""
-
-class PromptRequest:
-    """A request for a prompt."""
-
-    def __init__(self, complete_prompt, chat_text: dict={'user': '', 'ai': ''},
-		 names:dict={'user_name': 'user', 'ai_name': 'ai'}, chat:dict={'user_text': '', 'ai_text': ''}, args:dict=None):
-        """Initialize the prompt request."""
-        self.args = args
-        self.names = names
-        self.complete_prompt = complete_prompt
-        self.chat_text = chat_text
-        self.chat = chat
-
-    def to_json(self):
-        dict={'args': self.args, 'names': self.names, 'complete_prompt': self.complete_prompt, 'chat_text': self.chat_text, 'chat': self.chat}
-        return json.dumps(dict)
-    def __str__(self):
-        """Return the string representation of the prompt request."""
-        return f"PromptRequest(args={self.args}, names={self.names}, complete_prompt={self.complete_prompt}, chat_text={self.chat_text})"
-
-    def __repr__(self):
-        """Return the string representation of the prompt request."""
-        return self.__str__()
-
-class PromptResponse:
-    """A response to a prompt."""
-
-    def __init__(self, status: int, token: str|None=None, prompt: str|None=None, error: str|None=None, chat:dict={'user_text': '', 'ai_text': ''}):
-        """Initialize the prompt response."""
-        self.status = status
-        self.token = token
-        self.prompt = prompt
-        self.chat=chat
-        self.error = error
-	
-    def to_json(self):
-        dict={'status': self.status, 'token': self.token, 'prompt': self.prompt, 'error': self.error, 'chat': self.chat}
-        return json.dumps(dict)
-
-    def __str__(self):
-        """Return the string representation of the prompt response."""
-        return f"PromptResponse(status={self.status}, token={self.token}, error={self.error})"
-
-    def __repr__(self):
-        """Return the string representation of the prompt response."""
-        return self.__str__()
 
+    The messages are json, unless the client asks for the memorylane.msgpack subprotocol:
+    then they are binary MessagePack, and the fields of the responses are written
+    s (status), t (token), p (prompt), e (error) and c (chat), without the empty ones.
+    Clients that ask for no subprotocol, or for memorylane.json, get json.
+"""
 
 if __name__ == '__main__':
 	print("Please run a server file instead")
\ No newline at end of file
@@ -0,0 +1,98 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Iterable, Optional
+
+"""
+Loading the model, the embeddings and the Weaviate schema takes tens of seconds, so the servers
+bind their socket first and do that work here, in background phases that run at the same time.
+/health answers as soon as the socket is bound, /ready once every phase is done, and requests
+that come in before that wait for it instead of being refused. How long every phase took is
+in the report of /ready.
+"""
+
+class Startup:
+    """The background phases of the server startup."""
+
+    def __init__(self):
+        """Initialize the startup, the clock starts now."""
+        self.started = time.monotonic()
+        self.error: Optional[BaseException] = None
+        self.phases: Dict[str, Dict[str, Any]] = {}
+        self._ready = threading.Event()
+        self._failed = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        """Whether every phase is done."""
+        return self._ready.is_set()
+
+    def run(self, name: str, function: Callable[[], Any], after: Iterable[Future]=()) -> Future:
+        """Run a phase on its own thread, once the phases it comes after are done."""
+        future: Future = Future()
+        after = list(after)
+        def phase():
+            try:
+                for previous in after:
+                    previous.result()
+                start = time.monotonic()
+                with self._lock:
+                    self.phases[name] = {'started': start - self.started, 'seconds': None, 'error': None}
+                result = function()
+                with self._lock:
+                    self.phases[name]['seconds'] = time.monotonic() - start
+                logging.info(f"Startup phase {name} took {self.phases[name]['seconds']:.2f}s")
+                future.set_result(result)
+            except BaseException as e:
+                self._fail(name, e)
+                future.set_exception(e)
+        with self._lock:
+            self.phases[name] = {'started': None, 'seconds': None, 'error': None}
+        threading.Thread(target=phase, name=f"startup-{name}", daemon=True).start()
+        return future
+
+    def complete(self, *futures: Future):
+        """Be ready once the futures are done."""
+        def wait():
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                return
+            with self._lock:
+                self.phases['total'] = {'started': 0, 'seconds': time.monotonic() - self.started, 'error': None}
+            self._ready.set()
+        threading.Thread(target=wait, name="startup", daemon=True).start()
+
+    def _fail(self, name: str, error: BaseException):
+        logging.error(f"Startup phase {name} failed: {error}")
+        with self._lock:
+            self.phases[name]['error'] = str(error)
+            if self.error is None:
+                self.error = error
+        self._failed.set()
+
+    def wait(self, timeout: Optional[float]=None) -> bool:
+        """Block until the server is ready, False if a phase failed or the timeout passed."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._ready.is_set():
+            if self._failed.is_set():
+                return False
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            self._ready.wait(0.1 if remaining is None else min(0.1, remaining))
+        return True
+
+    def report(self) -> Dict[str, Any]:
+        """Return whether the server is ready and how long every phase took."""
+        with self._lock:
+            phases = {name: dict(phase) for name, phase in self.phases.items()}
+        return {
+            'ready': self.ready,
+            'error': str(self.error) if self.error is not None else None,
+            'uptime': time.monotonic() - self.started,
+            'phases': phases,
+        }
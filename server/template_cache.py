@@ -0,0 +1,62 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List
+from langchain import PromptTemplate
+
+"""
+Clients send the same few templates over and over, so the compiled PromptTemplate
+(which validates the template by formatting it) is built once and kept here.
+"""
+
+class TemplateCache:
+    """A bounded LRU cache of PromptTemplates keyed by the template text and its variables."""
+
+    def __init__(self, maxsize: int=128):
+        """Initialize the cache."""
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._templates: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(template: str, input_variables: List[str]) -> str:
+        """Hash the template text and its set of variables."""
+        digest = hashlib.sha256(template.encode())
+        for variable in sorted(set(input_variables)):
+            digest.update(b"\0" + variable.encode())
+        return digest.hexdigest()
+
+    def get(self, template: str, input_variables: List[str]) -> PromptTemplate:
+        """Return the compiled template, building it on a miss."""
+        key = self.key(template, input_variables)
+        with self._lock:
+            prompt_template = self._templates.get(key)
+            if prompt_template is not None:
+                self._templates.move_to_end(key)
+                self.hits += 1
+                return prompt_template
+            self.misses += 1
+        # Build outside the lock, two threads racing on a miss build the same template
+        prompt_template = PromptTemplate(
+            template=template,
+            input_variables=sorted(set(input_variables)),
+        )
+        with self._lock:
+            self._templates[key] = prompt_template
+            self._templates.move_to_end(key)
+            while len(self._templates) > self.maxsize:
+                self._templates.popitem(last=False)
+        return prompt_template
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the size and the hit ratio of the cache."""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._templates),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else None,
+        }
@@ -0,0 +1,441 @@
+import json
+import os
+import threading
+from typing import Any, Dict, Iterable, List, Optional
+from uuid import uuid4
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+
+"""
+The vector stores the chain keeps its memories in.
+They have the part of langchain's VectorStore interface the chain uses:
+add_texts(texts, metadatas) and similarity_search(query, k).
+
+The memories are partitioned by the namespace in their metadata (the user).
+A search with a namespace only ranks the memories of that namespace.
+
+For the compaction (server/compaction.py) they also list their conversations,
+return the memories of a conversation with their vectors, and delete memories.
+"""
+
+class WeaviateStore:
+    """A Weaviate class that gets its vectors from our embeddings.
+        Without embeddings Weaviate's own vectorizer module is used.
+    """
+
+    def __init__(self, client: Any, index_name: str, text_key: str, embedding: Optional[Embeddings]=None,
+                 attributes: Optional[List[str]]=None):
+        """Initialize with a weaviate client."""
+        self._client = client
+        self._index_name = index_name
+        self._text_key = text_key
+        self._embedding = embedding
+        self._query_attrs = [text_key]
+        if attributes is not None:
+            self._query_attrs.extend(attributes)
+
+    @property
+    def embedding(self) -> Optional[Embeddings]:
+        """The embeddings the vectors come from."""
+        return self._embedding
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]]=None, **kwargs: Any) -> List[str]:
+        """Embed the texts in one batch and upload them with the batch API."""
+        from weaviate.util import get_valid_uuid
+
+        texts = list(texts)
+        vectors = None
+        if self._embedding is not None:
+            vectors = self._embedding.embed_documents(texts)
+        ids = []
+        batch = self._client.batch
+        for i, text in enumerate(texts):
+            properties = {self._text_key: text}
+            if metadatas is not None:
+                properties.update(metadatas[i])
+            _id = get_valid_uuid(uuid4())
+            batch.add_data_object(
+                data_object=properties,
+                class_name=self._index_name,
+                uuid=_id,
+                vector=vectors[i] if vectors is not None else None,
+            )
+            ids.append(_id)
+        # The batch API answers 200 even when objects fail, their errors are in the results
+        results = batch.create_objects() or []
+        errors = [result["result"]["errors"] for result in results if "errors" in (result.get("result") or {})]
+        if errors:
+            raise ValueError(f"Error during batch import: {errors}")
+        return ids
+
+    def similarity_search(self, query: str, k: int=4, **kwargs: Any) -> List[Document]:
+        """Return the docs most similar to the query."""
+        if self._embedding is not None:
+            return self.similarity_search_by_vector(self._embedding.embed_query(query), k=k, **kwargs)
+        query_obj = self._client.query.get(self._index_name, self._query_attrs)
+        return self._run(query_obj.with_near_text({"concepts": [query]}), k, **kwargs)
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int=4, **kwargs: Any) -> List[Document]:
+        """Return the docs most similar to the vector."""
+        query_obj = self._client.query.get(self._index_name, self._query_attrs)
+        return self._run(query_obj.with_near_vector({"vector": embedding}), k, **kwargs)
+
+    def _run(self, query_obj, k: int, **kwargs: Any) -> List[Document]:
+        where_filter = kwargs.get("where_filter")
+        if kwargs.get("namespace") is not None:
+            # A filtered search only looks at the vectors of the partition
+            # (Weaviate scans it flat when it is small, and filters the HNSW graph otherwise)
+            partition = {"path": ["namespace"], "operator": "Equal", "valueText": kwargs["namespace"]}
+            where_filter = {"operator": "And", "operands": [where_filter, partition]} if where_filter else partition
+        if where_filter:
+            query_obj = query_obj.with_where(where_filter)
+        result = query_obj.with_limit(k).do()
+        if "errors" in result:
+            raise ValueError(f"Error during query: {result['errors']}")
+        docs = []
+        for res in result["data"]["Get"][self._index_name]:
+            text = res.pop(self._text_key)
+            docs.append(Document(page_content=text, metadata=res))
+        return docs
+
+    def conversations(self) -> List[str]:
+        """The ids of the conversations that have memories."""
+        result = (
+            self._client.query.aggregate(self._index_name)
+            .with_group_by_filter(["conversation_id"])
+            .with_fields("groupedBy { value }")
+            .do()
+        )
+        if "errors" in result:
+            raise ValueError(f"Error during query: {result['errors']}")
+        groups = result["data"]["Aggregate"][self._index_name]
+        return [group["groupedBy"]["value"] for group in groups]
+
+    def memories(self, conversation_id: str, limit: int=10000) -> List[dict]:
+        """The memories of a conversation with their vectors, oldest first."""
+        result = (
+            self._client.query.get(self._index_name, [self._text_key, "namespace", "conversation_id"])
+            .with_additional(["id", "vector", "creationTimeUnix"])
+            .with_where({"path": ["conversation_id"], "operator": "Equal", "valueText": conversation_id})
+            .with_limit(limit)
+            .do()
+        )
+        if "errors" in result:
+            raise ValueError(f"Error during query: {result['errors']}")
+        memories = []
+        for res in result["data"]["Get"][self._index_name]:
+            additional = res.pop("_additional")
+            memories.append({
+                "id": additional["id"],
+                "text": res.pop(self._text_key),
+                "metadata": res,
+                "vector": additional["vector"],
+                "created": int(additional["creationTimeUnix"]),
+            })
+        memories.sort(key=lambda memory: memory["created"])
+        return memories
+
+    def delete(self, ids: Iterable[str], **kwargs: Any):
+        """Delete memories by id."""
+        for _id in ids:
+            self._client.data_object.delete(_id, class_name=self._index_name)
+
+class MmapVectorStore:
+    """An in-process vector store for single node deployments.
+        The vectors live in a NumPy memory mapped file and the texts in a json lines file next to it,
+        so a restart only maps the file back in. Small stores are searched exactly with one
+        matrix product, once there are ivf_threshold vectors an IVF index (k-means lists)
+        is built and a query only scores the nprobe lists closest to it.
+        Every namespace keeps the list of its rows, so a search in a namespace only scores those.
+        Deleted memories are only marked in deleted.txt until they are half the store,
+        then vacuum rewrites the files without them.
+    """
+
+    def __init__(self, path: str, embedding: Embeddings, ivf_threshold: int=20000, nprobe: int=8):
+        """Open the store in the path folder, creating it if needed."""
+        if embedding is None:
+            raise ValueError("The local vector store needs embeddings, set EMBEDDINGS to local or openai")
+        self._embedding = embedding
+        self.path = path
+        self.ivf_threshold = ivf_threshold
+        self.nprobe = nprobe
+        self.dim = None
+        self.count = 0
+        self._vectors = None
+        self._docs: List[dict] = []
+        # The IVF index: centroids, the list of every vector, and the count it was built at
+        self._centroids = None
+        self._assignments = None
+        self._lists: List[List[int]] = []
+        self._built_at = 0
+        # The rows of every namespace, and which rows are not deleted
+        self._partitions: Dict[str, List[int]] = {}
+        self._alive = np.ones(0, dtype=bool)
+        self._removed = 0
+        self._lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    @property
+    def embedding(self) -> Embeddings:
+        """The embeddings the vectors come from."""
+        return self._embedding
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _load(self):
+        """Map the vectors back in and read the texts and the index."""
+        if os.path.exists(self._file("vacuum")):
+            self._finish_vacuum()
+        if os.path.exists(self._file("docs.jsonl")):
+            with open(self._file("docs.jsonl")) as f:
+                self._docs = [json.loads(line) for line in f if line.strip()]
+        self.count = len(self._docs)
+        self._alive = np.ones(self.count, dtype=bool)
+        if os.path.exists(self._file("deleted.txt")):
+            with open(self._file("deleted.txt")) as f:
+                deleted = {line.strip() for line in f}
+            for row, doc in enumerate(self._docs):
+                if doc["id"] in deleted:
+                    self._alive[row] = False
+        self._removed = int(self.count - self._alive.sum())
+        for row, doc in enumerate(self._docs):
+            if self._alive[row]:
+                self._partition(row, doc)
+        if os.path.exists(self._file("meta.json")):
+            with open(self._file("meta.json")) as f:
+                self.dim = json.load(f)["dim"]
+            capacity = os.path.getsize(self._file("vectors.f32")) // (4 * self.dim)
+            if capacity:
+                self._vectors = np.memmap(self._file("vectors.f32"), dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+        if os.path.exists(self._file("ivf.npz")):
+            index = np.load(self._file("ivf.npz"))
+            self._centroids = index["centroids"]
+            self._assignments = np.full(len(self._docs), -1, dtype=np.int64)
+            built = index["assignments"][:self.count]
+            self._assignments[:len(built)] = built
+            self._built_at = int(index["built_at"])
+            # Vectors added after the last save of the index get their list now
+            missing = np.nonzero(self._assignments < 0)[0]
+            if len(missing):
+                self._assignments[missing] = np.argmax(self._vectors[missing] @ self._centroids.T, axis=1)
+            self._lists = self._group(self._assignments, len(self._centroids))
+
+    def _partition(self, row: int, doc: dict):
+        namespace = doc["metadata"].get("namespace")
+        if namespace is not None:
+            self._partitions.setdefault(namespace, []).append(row)
+
+    @staticmethod
+    def _group(assignments: np.ndarray, nlist: int) -> List[List[int]]:
+        """The rows of every IVF list."""
+        order = np.argsort(assignments, kind="stable")
+        bounds = np.cumsum(np.bincount(assignments, minlength=nlist))[:-1]
+        return [rows.tolist() for rows in np.split(order, bounds)]
+
+    def _reserve(self, rows: int):
+        """Grow the memory mapped file so it holds rows vectors."""
+        capacity = 0 if self._vectors is None else self._vectors.shape[0]
+        if rows <= capacity:
+            return
+        capacity = max(rows, capacity * 2, 1024)
+        if self._vectors is not None:
+            self._vectors.flush()
+            self._vectors = None
+        with open(self._file("vectors.f32"), "ab") as f:
+            f.truncate(capacity * self.dim * 4)
+        self._vectors = np.memmap(self._file("vectors.f32"), dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]]=None, **kwargs: Any) -> List[str]:
+        """Embed the texts in one batch and append them to the store."""
+        texts = list(texts)
+        if not texts:
+            return []
+        vectors = np.asarray(self._embedding.embed_documents(texts), dtype=np.float32)
+        # Normalized, so the dot product is the cosine similarity
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                with open(self._file("meta.json"), "w") as f:
+                    json.dump({"dim": self.dim}, f)
+            start = self.count
+            self._reserve(start + len(texts))
+            self._vectors[start:start + len(texts)] = vectors
+            self._vectors.flush()
+            docs = []
+            for i, text in enumerate(texts):
+                docs.append({"id": str(uuid4()), "text": text, "metadata": metadatas[i] if metadatas is not None else {}})
+            # The texts are written after the vectors, the texts file decides what is in the store
+            with open(self._file("docs.jsonl"), "a") as f:
+                for doc in docs:
+                    f.write(json.dumps(doc) + "\n")
+            for i, doc in enumerate(docs):
+                self._partition(start + i, doc)
+            self._alive = np.concatenate([self._alive, np.ones(len(docs), dtype=bool)])
+            self._docs.extend(docs)
+            self.count += len(texts)
+            self._index(start, vectors)
+        return [doc["id"] for doc in docs]
+
+    def _index(self, start: int, vectors: np.ndarray):
+        """Put new vectors in their IVF lists, rebuilding the index as the store doubles."""
+        if self.count < self.ivf_threshold:
+            return
+        if self._centroids is None or self.count >= 2 * self._built_at:
+            self._build()
+            return
+        list_ids = np.argmax(vectors @ self._centroids.T, axis=1)
+        self._assignments = np.concatenate([self._assignments, list_ids])
+        for i, list_id in enumerate(list_ids):
+            self._lists[list_id].append(start + i)
+
+    def _build(self, iterations: int=10, sample: int=50000):
+        """Cluster the vectors into sqrt(n) lists with spherical k-means."""
+        vectors = self._vectors[:self.count]
+        nlist = max(1, int(np.sqrt(self.count)))
+        rng = np.random.default_rng(0)
+        train = vectors[np.sort(rng.choice(self.count, min(sample, self.count), replace=False))]
+        centroids = train[rng.choice(len(train), nlist, replace=False)].copy()
+        for _ in range(iterations):
+            labels = np.argmax(train @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, train)
+            norms = np.linalg.norm(sums, axis=1)
+            # A list that lost all its vectors keeps its old centroid
+            filled = norms > 0
+            centroids[filled] = sums[filled] / norms[filled, None]
+        # Assign every vector in chunks so the memory stays flat
+        assignments = np.empty(self.count, dtype=np.int64)
+        for start in range(0, self.count, 65536):
+            assignments[start:start + 65536] = np.argmax(vectors[start:start + 65536] @ centroids.T, axis=1)
+        self._centroids = centroids
+        self._assignments = assignments
+        self._lists = self._group(assignments, nlist)
+        self._built_at = self.count
+        np.savez(self._file("ivf.npz"), centroids=centroids, assignments=assignments, built_at=self._built_at)
+
+    def similarity_search(self, query: str, k: int=4, **kwargs: Any) -> List[Document]:
+        """Return the docs most similar to the query."""
+        return self.similarity_search_by_vector(self._embedding.embed_query(query), k=k, **kwargs)
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int=4, **kwargs: Any) -> List[Document]:
+        """Return the docs most similar to the vector."""
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k=k, **kwargs)]
+
+    def similarity_search_with_score_by_vector(self, embedding: List[float], k: int=4, **kwargs: Any):
+        """Return the docs most similar to the vector with their cosine similarity.
+            namespace: only search the memories of this namespace
+        """
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= max(np.linalg.norm(query), 1e-12)
+        namespace = kwargs.get("namespace")
+        with self._lock:
+            if self.count == 0:
+                return []
+            partition = None
+            if namespace is not None:
+                partition = np.asarray(self._partitions.get(namespace, []), dtype=np.int64)
+            size = self.count if partition is None else len(partition)
+            if self._centroids is not None and size >= self.ivf_threshold:
+                # Only score the lists closest to the query
+                nprobe = min(self.nprobe, len(self._centroids))
+                closest = np.argpartition(-(self._centroids @ query), nprobe - 1)[:nprobe]
+                if partition is None:
+                    rows = np.fromiter((row for list_id in closest for row in self._lists[list_id]), dtype=np.int64)
+                    rows = rows[self._alive[rows]]
+                else:
+                    rows = partition[np.isin(self._assignments[partition], closest)]
+            elif partition is None and self._removed:
+                rows = np.nonzero(self._alive)[0]
+            else:
+                rows = partition
+            vectors = self._vectors[:self.count] if rows is None else self._vectors[rows]
+            scores = vectors @ query
+            k = min(k, len(scores))
+            if k == 0:
+                return []
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            results = []
+            for i in top:
+                row = int(i) if rows is None else int(rows[i])
+                doc = self._docs[row]
+                results.append((Document(page_content=doc["text"], metadata=dict(doc["metadata"])), float(scores[i])))
+            return results
+
+    def conversations(self) -> List[str]:
+        """The ids of the conversations that have memories."""
+        with self._lock:
+            conversations = {self._docs[row]["metadata"].get("conversation_id") for row in np.nonzero(self._alive)[0]}
+        return [conversation for conversation in conversations if conversation is not None]
+
+    def memories(self, conversation_id: str, limit: int=10000) -> List[dict]:
+        """The memories of a conversation with their vectors, oldest first."""
+        memories = []
+        with self._lock:
+            for row in np.nonzero(self._alive)[0]:
+                doc = self._docs[row]
+                if doc["metadata"].get("conversation_id") == conversation_id:
+                    memories.append({
+                        "id": doc["id"],
+                        "text": doc["text"],
+                        "metadata": dict(doc["metadata"]),
+                        "vector": self._vectors[row].tolist(),
+                    })
+        return memories[-limit:]
+
+    def delete(self, ids: Iterable[str], **kwargs: Any):
+        """Mark memories as deleted, vacuuming the files once half the store is deleted."""
+        ids = set(ids)
+        with self._lock:
+            rows = [row for row in np.nonzero(self._alive)[0] if self._docs[row]["id"] in ids]
+            if not rows:
+                return
+            with open(self._file("deleted.txt"), "a") as f:
+                for row in rows:
+                    f.write(self._docs[row]["id"] + "\n")
+            self._alive[rows] = False
+            self._removed += len(rows)
+            for namespace in {self._docs[row]["metadata"].get("namespace") for row in rows}:
+                if namespace in self._partitions:
+                    self._partitions[namespace] = [row for row in self._partitions[namespace] if self._alive[row]]
+            if self._removed * 2 >= self.count:
+                self.vacuum()
+
+    def vacuum(self):
+        """Rewrite the files without the deleted memories."""
+        with self._lock:
+            keep = np.nonzero(self._alive)[0]
+            vectors = np.array(self._vectors[keep]) if self._vectors is not None else None
+            with open(self._file("docs.jsonl.tmp"), "w") as f:
+                for row in keep:
+                    f.write(json.dumps(self._docs[row]) + "\n")
+                os.fsync(f.fileno())
+            if vectors is not None:
+                with open(self._file("vectors.f32.tmp"), "wb") as f:
+                    vectors.tofile(f)
+                    os.fsync(f.fileno())
+            # From here a restart finishes the vacuum, so the texts and the vectors never disagree
+            open(self._file("vacuum"), "w").close()
+            self._vectors = None
+            self._finish_vacuum()
+            self._docs = []
+            self._centroids = None
+            self._assignments = None
+            self._lists = []
+            self._built_at = 0
+            self._partitions = {}
+            self._load()
+            if self.count >= self.ivf_threshold:
+                self._build()
+
+    def _finish_vacuum(self):
+        for name in ("docs.jsonl", "vectors.f32"):
+            if os.path.exists(self._file(name + ".tmp")):
+                os.replace(self._file(name + ".tmp"), self._file(name))
+        for name in ("deleted.txt", "ivf.npz", "vacuum"):
+            if os.path.exists(self._file(name)):
+                os.remove(self._file(name))
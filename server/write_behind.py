@@ -0,0 +1,135 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional
+from server.metrics import metrics
+
+"""
+Saving a memory does not change the answer, so the client should not wait for it.
+WriteBehindStore wraps a vector store: add_texts only queues the texts and a thread
+writes them to the store in batches, every batch_size texts or flush_interval seconds.
+Everything else goes straight to the wrapped store.
+"""
+
+class WriteBehindStore:
+    """A vector store wrapper that saves the texts in the background, in batches."""
+
+    def __init__(self, vectorstore, batch_size: int=32, flush_interval: float=1.0, retries: int=3):
+        """Initialize the wrapper and start its writer thread.
+            batch_size: the most texts written in one call to the store
+            flush_interval: seconds the first queued text waits for others to join its batch
+            retries: how many times a failed batch is retried before it is dropped
+        """
+        self.vectorstore = vectorstore
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.written = 0
+        self.batches = 0
+        self.failures = 0
+        self.last_lag: Optional[float] = None
+        self._queue: queue.Queue = queue.Queue()
+        # The enqueue time of every text not written yet, oldest first
+        self._waiting: List[float] = []
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.vectorstore, name)
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]]=None, **kwargs: Any) -> List[str]:
+        """Queue the texts, they are written later so no ids are returned."""
+        if self._closed:
+            return self.vectorstore.add_texts(texts, metadatas=metadatas, **kwargs)
+        texts = list(texts)
+        now = time.monotonic()
+        with self._lock:
+            self._waiting.extend([now] * len(texts))
+        for i, text in enumerate(texts):
+            self._queue.put((text, metadatas[i] if metadatas is not None else None, now))
+        return []
+
+    def flush(self):
+        """Block until every text queued so far is written."""
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+
+    def close(self):
+        """Write everything still queued and stop the writer thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the queue depth and how far behind the writes are."""
+        with self._lock:
+            oldest = self._waiting[0] if self._waiting else None
+            depth = len(self._waiting)
+        stats = {
+            'queue_depth': depth,
+            'lag': time.monotonic() - oldest if oldest is not None else 0,
+            'last_lag': self.last_lag,
+            'written': self.written,
+            'batches': self.batches,
+            'failures': self.failures,
+        }
+        inner = getattr(self.vectorstore, "stats", None)
+        if inner is not None:
+            stats['store'] = inner()
+        return stats
+
+    def _run(self):
+        """Collect the queued texts into batches and write them."""
+        while True:
+            item = self._queue.get()
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            # None stops the thread, an Event is a flush; both write what they follow right away
+            while isinstance(item, tuple):
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    self._write(batch)
+                    batch = []
+                    deadline = time.monotonic() + self.flush_interval
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    item = False
+                    break
+            if batch:
+                self._write(batch)
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is None:
+                break
+
+    def _write(self, batch: List[tuple]):
+        texts = [text for text, _, _ in batch]
+        metadatas = None
+        if any(metadata is not None for _, metadata, _ in batch):
+            metadatas = [metadata or {} for _, metadata, _ in batch]
+        for attempt in range(self.retries + 1):
+            try:
+                with metrics.timer("save_seconds"):
+                    self.vectorstore.add_texts(texts, metadatas=metadatas)
+                self.written += len(texts)
+                self.batches += 1
+                break
+            except Exception as e:
+                logging.error(f"Saving {len(texts)} memories failed (attempt {attempt + 1}): {e}")
+                if attempt < self.retries:
+                    time.sleep(min(2 ** attempt, 10))
+        else:
+            self.failures += len(texts)
+        self.last_lag = time.monotonic() - batch[0][2]
+        with self._lock:
+            del self._waiting[:len(batch)]
@@ -0,0 +1,53 @@
+import hashlib
+import zlib
+from typing import List
+import numpy as np
+import pytest
+from bench.fakes import WORDS, FakeLlamaCpp
+from server.scheduler import Scheduler
+
+"""
+The fixtures shared by the tests: the fake model of the benchmark, fast enough for a test,
+and embeddings built from the words of a text so texts sharing words are similar.
+"""
+
+def expected_tokens(prompt: str, max_tokens: int) -> List[str]:
+    """The tokens the fake model generates for a prompt."""
+    seed = zlib.crc32(prompt.encode())
+    return [" " + WORDS[(seed + i) % len(WORDS)] for i in range(max_tokens)]
+
+class WordEmbeddings:
+    """Bag of words embeddings, every word adds a fixed random vector."""
+
+    def __init__(self, dimensions: int=32):
+        self.dimensions = dimensions
+        self.calls = 0
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for word in text.lower().split():
+            seed = int.from_bytes(hashlib.sha256(word.encode()).digest()[:4], "little")
+            vector += np.random.default_rng(seed).normal(size=self.dimensions).astype(np.float32)
+        return vector.tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.calls += 1
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        self.calls += 1
+        return self._embed(text)
+
+@pytest.fixture
+def llm():
+    return FakeLlamaCpp(max_tokens=8, tokens_per_second=5000, prefill_cost=0)
+
+@pytest.fixture
+def scheduler(llm):
+    scheduler = Scheduler(llm, echo=False)
+    yield scheduler
+    scheduler.close()
+
+@pytest.fixture
+def embeddings():
+    return WordEmbeddings()
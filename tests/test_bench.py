@@ -0,0 +1,39 @@
+from bench.fakes import FakeLlamaCpp
+from bench.load import build_request, percentiles, summarize
+from bench.wire import frame_header, measure, responses
+from server.codec import JSON_SUBPROTOCOL, MSGPACK_SUBPROTOCOL
+from server.protocol import validate_prompt_request
+from tests.conftest import expected_tokens
+
+def test_the_fake_model_is_deterministic():
+    first, second = FakeLlamaCpp(model_path="fake", max_tokens=8), FakeLlamaCpp(model_path="fake", max_tokens=8)
+    generate = lambda llm: [chunk["choices"][0]["text"] for chunk in llm.client("Hello", max_tokens=8)]
+    assert generate(first) == generate(second) == expected_tokens("Hello", 8)
+    assert len(first.client.tokenize(b"one two three")) == 4
+
+def test_a_bench_request_is_a_valid_prompt_request():
+    request = validate_prompt_request(build_request(3, 1))
+    assert request.user_id == "bench-3"
+
+def test_percentiles():
+    assert percentiles([]) == {'avg': None, 'p50': None, 'p95': None, 'p99': None}
+    result = percentiles([float(i) for i in range(100, 0, -1)])
+    assert result == {'avg': 50.5, 'p50': 51.0, 'p95': 96.0, 'p99': 100.0}
+
+def test_summarize_leaves_out_the_failed_requests():
+    samples = [{'error': None, 'tokens': 10, 'latency': 1.0, 'ttft': 0.1, 'bytes': 50},
+               {'error': "timeout", 'tokens': 0, 'latency': 9.0, 'ttft': None}]
+    summary = summarize(samples, 2.0)
+    assert summary['requests'] == 2 and summary['errors'] == 1
+    assert summary['tokens_per_second'] == 5.0 and summary['bytes_per_token'] == 5.0
+    assert summary['latency']['p99'] == 1.0
+
+def test_wire_frames():
+    assert len(responses(10, 4)) == 4
+    assert [frame_header(n) for n in (125, 126, 65535, 65536)] == [2, 4, 4, 10]
+
+def test_msgpack_and_compression_take_fewer_bytes():
+    plain = measure(JSON_SUBPROTOCOL, False, tokens=64)
+    assert plain['messages'] == 65
+    assert measure(MSGPACK_SUBPROTOCOL, False, tokens=64)['bytes'] < plain['bytes']
+    assert measure(JSON_SUBPROTOCOL, True, tokens=64)['bytes'] < plain['bytes']
@@ -0,0 +1,25 @@
+import threading
+from server.bridge import TokenBuffer
+
+def test_tokens_queued_between_takes_come_out_together():
+    tokens = TokenBuffer()
+    for token in ["a", "b", "c"]:
+        tokens.put(token)
+    assert tokens.take() == ["a", "b", "c"]
+    tokens.close()
+    assert tokens.take() is None
+
+def test_take_waits_for_a_token_from_another_thread():
+    tokens = TokenBuffer()
+    threading.Timer(0.01, tokens.put, args=("late",)).start()
+    assert tokens.take() == ["late"]
+
+def test_a_slow_reader_stops_getting_tokens():
+    tokens = TokenBuffer(max_pending=4)
+    tokens.put("ab")
+    tokens.put("cd")
+    tokens.put("e")
+    tokens.put("f")
+    tokens.close()
+    assert tokens.overflowed
+    assert tokens.take() is None
@@ -0,0 +1,39 @@
+import threading
+import pytest
+from bench.fakes import FakeVectorStore
+from server import chain
+from server.protocol import PromptRequest
+from server.scheduler import GenerationCancelled
+from tests.conftest import expected_tokens
+
+def chat_request(**kwargs):
+    return PromptRequest("Chat:\n{history}\n### {user_name}: {user_text}\n### {ai_name}:{ai_text}",
+                         chat={'user_text': "hello", 'ai_text': ""}, names={'user_name': "Human", 'ai_name': "AI"},
+                         chat_text={'user_name': "### {user_name}: {user_text}", 'ai_name': "### {ai_name}: {ai_text}"},
+                         args={'history': ""}, **kwargs)
+
+def test_run_chain_saves_the_turn_in_the_users_namespace(scheduler):
+    store = FakeVectorStore(latency=0)
+    response = chain.run_chain(chat_request(save=True, user_id="alice"), scheduler, store)
+    prompt = "Chat:\n\n### Human: hello\n### AI:"
+    assert response.prompt == prompt + "".join(expected_tokens(prompt, 8))
+    assert [doc.page_content for doc in store.similarity_search("", namespace="alice")] == ["### Human: hello\n### AI: " + response.chat['ai_text']]
+
+def test_a_cancelled_chain_raises_and_saves_nothing(scheduler):
+    store = FakeVectorStore(latency=0)
+    cancel = threading.Event()
+    with pytest.raises(GenerationCancelled):
+        chain.run_chain(chat_request(save=True, user_id="alice"), scheduler, store,
+                        on_token=lambda token: cancel.set(), cancel=cancel)
+    assert store.similarity_search("", namespace="alice") == []
+
+def test_a_session_turn_only_sends_the_new_lines(scheduler):
+    store = FakeVectorStore(latency=0)
+    session = chain.ChatSession(chat_request(session=True))
+    chain.run_session(session, "hello", scheduler, store)
+    prompt = session.prompt + "\n### Human: and again\n### AI: "
+    second = chain.run_session(session, "and again", scheduler, store)
+    # The response only has the new ai text, the prompt kept growing from the last one
+    assert second.prompt == "".join(expected_tokens(prompt, 8))
+    assert session.prompt == prompt + second.prompt
+    assert session.turns == 2
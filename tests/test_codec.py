@@ -0,0 +1,43 @@
+import msgpack
+import pytest
+from server.codec import JSON_SUBPROTOCOL, MSGPACK_SUBPROTOCOL, get_codec, subprotocols
+from server.protocol import SERVER_CODES, PromptResponse
+
+def test_json_is_the_default_and_writes_what_it_always_did():
+    codec = get_codec()
+    response = PromptResponse(status=SERVER_CODES['RUNNING'], token=" hi")
+    assert codec.subprotocol == JSON_SUBPROTOCOL
+    assert codec.encode_response(response) == response.to_json()
+    assert codec.decode_request(codec.encode_request({"type": "cancel"})) == {"type": "cancel"}
+
+def test_msgpack_leaves_out_the_empty_fields():
+    codec = get_codec(MSGPACK_SUBPROTOCOL)
+    message = codec.encode_response(PromptResponse(status=SERVER_CODES['RUNNING'], token=" hi", chat={}))
+    assert msgpack.unpackb(message) == {"s": 0, "t": " hi"}
+    assert codec.decode_response(message) == {'status': 0, 'token': " hi", 'prompt': None, 'error': None, 'chat': None}
+
+def test_msgpack_round_trips_a_final_response():
+    codec = get_codec(MSGPACK_SUBPROTOCOL)
+    chat = {'user_text': " hello", 'ai_text': " hi"}
+    response = PromptResponse(status=SERVER_CODES['SUCCESS'], prompt="the prompt", chat=chat)
+    decoded = codec.decode_response(codec.encode_response(response))
+    assert decoded['prompt'] == "the prompt" and decoded['chat'] == chat
+
+def test_json_rejects_what_is_not_an_object():
+    codec = get_codec()
+    with pytest.raises(ValueError, match="A request must be an object"):
+        codec.decode_request('[1, 2]')
+    with pytest.raises(ValueError):
+        codec.decode_request('{"type": ')
+
+def test_msgpack_rejects_text_frames_and_non_maps():
+    codec = get_codec(MSGPACK_SUBPROTOCOL)
+    with pytest.raises(ValueError):
+        codec.decode_request('{"type": "cancel"}')
+    with pytest.raises(ValueError):
+        codec.decode_request(msgpack.packb([1, 2]))
+
+def test_subprotocols_prefer_msgpack_and_unknown_ones_raise():
+    assert subprotocols() == [MSGPACK_SUBPROTOCOL, JSON_SUBPROTOCOL]
+    with pytest.raises(ValueError):
+        get_codec("memorylane.xml")
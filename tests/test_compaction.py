@@ -0,0 +1,80 @@
+from server.compaction import MemoryCompactor, SUMMARY_PROMPT
+
+class MemoryStore:
+    """The part of a vector store the compaction uses, memories oldest first."""
+
+    def __init__(self, memories):
+        self.memories_ = list(memories)
+        self.next_id = len(self.memories_)
+
+    def conversations(self):
+        return ["c"]
+
+    def memories(self, conversation_id):
+        return list(self.memories_)
+
+    def delete(self, ids, namespace=None):
+        ids = set(ids)
+        self.memories_ = [memory for memory in self.memories_ if memory["id"] not in ids]
+
+    def add_texts(self, texts, metadatas=None):
+        for text, metadata in zip(texts, metadatas):
+            self.memories_.append(memory(self.next_id, text, [0.0, 0.0, 1.0], **metadata))
+            self.next_id += 1
+
+class WordScheduler:
+    """Counts a token per word, writes one word summaries and records its prompts."""
+
+    def __init__(self, prompt_budget=60, busy=False):
+        self.prompt_budget = prompt_budget
+        self.prompts = []
+        self.queue_depth = 1 if busy else 0
+        self.active = 0
+
+    def count_tokens(self, text):
+        return len(text.split()) + 1
+
+    def generate(self, prompt, session=None):
+        self.prompts.append(prompt)
+        return "summary"
+
+def memory(i, text, vector, **metadata):
+    return {"id": str(i), "text": text, "vector": vector, "metadata": {"namespace": "u", **metadata}}
+
+def test_dedupe_keeps_the_newest_across_blocks():
+    memories = [memory(0, "old", [1.0, 0.0]), memory(1, "other", [0.0, 1.0]), memory(2, "x", [0.0, -1.0]),
+                memory(3, "new", [1.0, 0.01])]
+    store = MemoryStore(memories)
+    compactor = MemoryCompactor(store, dedupe_block=2)
+    compactor.compact()
+    assert [m["text"] for m in store.memories_] == ["other", "x", "new"]
+    assert compactor.merged == 1
+
+def test_cap_without_a_scheduler_drops_the_oldest():
+    store = MemoryStore([memory(i, f"m{i}", [1.0, float(i)]) for i in range(10)])
+    compactor = MemoryCompactor(store, similarity=1.1, max_memories=4)
+    compactor.compact()
+    assert [m["text"] for m in store.memories_] == ["m6", "m7", "m8", "m9"]
+    assert compactor.dropped == 6
+
+def test_summaries_fit_the_context_of_the_model():
+    long = " ".join(["word"] * 200)
+    memories = [memory(i, long if i % 4 == 0 else f"short memory {i}", [1.0, float(i)]) for i in range(30)]
+    store = MemoryStore(memories)
+    scheduler = WordScheduler(prompt_budget=60)
+    compactor = MemoryCompactor(store, scheduler, similarity=1.1, max_memories=10, summarize_batch=20)
+    compactor.compact()
+    assert scheduler.prompts
+    for prompt in scheduler.prompts:
+        assert scheduler.count_tokens(prompt) <= scheduler.prompt_budget
+        assert prompt.startswith(SUMMARY_PROMPT.split("{memories}")[0])
+    assert len(store.memories_) <= 10
+    assert sum(m["metadata"].get("summary", False) for m in store.memories_) == len(scheduler.prompts)
+
+def test_summaries_wait_while_the_model_is_busy():
+    store = MemoryStore([memory(i, f"m{i}", [1.0, float(i)]) for i in range(10)])
+    scheduler = WordScheduler(busy=True)
+    compactor = MemoryCompactor(store, scheduler, similarity=1.1, max_memories=4)
+    compactor.compact()
+    assert scheduler.prompts == []
+    assert len(store.memories_) == 10
@@ -0,0 +1,81 @@
+import threading
+import pytest
+from bench.fakes import FakeLlamaCpp
+from server import chain
+from server.completion_cache import CompletionCache
+from server.protocol import PromptRequest
+from server.scheduler import GenerationCancelled, Scheduler
+
+def request(cache=True):
+    return PromptRequest("{user_text}", chat={'user_text': "hi", 'ai_text': ""}, args={}, cache=cache)
+
+@pytest.fixture
+def completions(monkeypatch):
+    completions = CompletionCache(maxsize=8)
+    monkeypatch.setattr(chain, "completions", completions)
+    return completions
+
+def test_key_has_the_model_the_parameters_and_the_prompt():
+    cache = CompletionCache()
+    key = cache.key("model", {'temperature': 0, 'max_tokens': 8}, "prompt")
+    assert key == cache.key("model", {'max_tokens': 8, 'temperature': 0}, "prompt")
+    assert key != cache.key("other", {'temperature': 0, 'max_tokens': 8}, "prompt")
+    assert key != cache.key("model", {'temperature': 0, 'max_tokens': 9}, "prompt")
+    assert key != cache.key("model", {'temperature': 0, 'max_tokens': 8}, "prompt ")
+
+def test_memory_tier_is_lru():
+    cache = CompletionCache(maxsize=2)
+    cache.put(b"a", ["1"])
+    cache.put(b"b", ["2"])
+    cache.get(b"a")
+    cache.put(b"c", ["3"])
+    assert cache.get(b"b") is None
+    assert cache.get(b"a") == ["1"]
+
+def test_disk_tier_survives_a_restart_and_stays_under_max_bytes(tmp_path):
+    path = str(tmp_path / "completions.sqlite")
+    cache = CompletionCache(maxsize=1, path=path, max_bytes=100)
+    cache.put(b"a", ["first"])
+    cache.close()
+    reopened = CompletionCache(maxsize=1, path=path, max_bytes=100)
+    assert reopened.get(b"a") == ["first"]
+    assert reopened.stats()['disk_hits'] == 1
+    for i in range(20):
+        reopened.put(bytes([i]), ["x" * 10])
+    assert reopened.stats()['bytes'] <= 100
+    assert reopened.evictions > 0
+    reopened.close()
+
+def test_deterministic_prompts_are_generated_once(completions):
+    llm = FakeLlamaCpp(max_tokens=4, temperature=0, tokens_per_second=5000, prefill_cost=0)
+    scheduler = Scheduler(llm, echo=False)
+    tokens = []
+    try:
+        first = chain.generate(request(), scheduler, "same prompt")
+        second = chain.generate(request(), scheduler, "same prompt", on_token=tokens.append)
+    finally:
+        scheduler.close()
+    assert first == second
+    assert scheduler.completed == 1
+    # The cached completion is replayed token by token
+    assert "".join(tokens) == first and len(tokens) == 4
+
+def test_a_fixed_seed_is_deterministic_and_sampling_is_not(completions):
+    assert chain.deterministic({'temperature': 0.8, 'seed': 42})
+    assert not chain.deterministic({'temperature': 0.8, 'seed': -1})
+    llm = FakeLlamaCpp(max_tokens=4, temperature=0.8, tokens_per_second=5000, prefill_cost=0)
+    scheduler = Scheduler(llm, echo=False)
+    try:
+        for _ in range(2):
+            chain.generate(request(), scheduler, "same prompt")
+        chain.generate(request(cache=False), scheduler, "same prompt")
+    finally:
+        scheduler.close()
+    assert scheduler.completed == 3
+    assert completions.skipped == 2
+
+def test_a_cancelled_replay_raises():
+    cancel = threading.Event()
+    cancel.set()
+    with pytest.raises(GenerationCancelled):
+        chain.replay(["a", "b"], cancel=cancel)
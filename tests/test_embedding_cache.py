@@ -0,0 +1,63 @@
+import pytest
+from server.embedding_cache import CachedEmbeddings
+
+class CountingEmbeddings:
+    """Embeds a text as its length, counting the texts it was asked for."""
+
+    def __init__(self):
+        self.embedded = 0
+
+    def embed_documents(self, texts):
+        self.embedded += len(texts)
+        return [[float(len(text)), 1.0] for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+def test_a_text_is_embedded_once(tmp_path):
+    backend = CountingEmbeddings()
+    cache = CachedEmbeddings(backend, str(tmp_path / "embeddings.sqlite"), model_name="counting")
+    assert cache.embed_documents(["hi", "there", "hi"]) == [[2.0, 1.0], [5.0, 1.0], [2.0, 1.0]]
+    assert cache.embed_query("there") == [5.0, 1.0]
+    assert backend.embedded == 2
+    assert cache.stats()['hits'] == 2 and cache.stats()['misses'] == 2
+
+def test_vectors_survive_a_reopen(tmp_path):
+    path = str(tmp_path / "embeddings.sqlite")
+    cache = CachedEmbeddings(CountingEmbeddings(), path, model_name="counting")
+    cache.embed_documents(["kept"])
+    cache.close()
+    backend = CountingEmbeddings()
+    reopened = CachedEmbeddings(backend, path, model_name="counting")
+    assert reopened.embed_query("kept") == [4.0, 1.0]
+    assert backend.embedded == 0
+    assert reopened.stats()['bytes'] == 8
+    # Another model never gets the vectors of this one
+    CachedEmbeddings(backend, path, model_name="other").embed_query("kept")
+    assert backend.embedded == 1
+
+def test_the_least_recently_used_vectors_go_past_max_bytes(tmp_path):
+    backend = CountingEmbeddings()
+    # Every vector is 8 bytes, 4 of them fit
+    cache = CachedEmbeddings(backend, str(tmp_path / "embeddings.sqlite"), max_bytes=32, model_name="counting")
+    cache.embed_documents(["a", "b", "c", "d"])
+    cache.embed_query("a")
+    cache.embed_query("e")
+    assert cache.stats()['evictions'] == 2 and cache.stats()['bytes'] <= 32
+    backend.embedded = 0
+    cache.embed_documents(["a", "e"])
+    assert backend.embedded == 0
+    cache.embed_query("b")
+    assert backend.embedded == 1
+
+def test_a_failed_save_is_rolled_back(tmp_path, monkeypatch):
+    cache = CachedEmbeddings(CountingEmbeddings(), str(tmp_path / "embeddings.sqlite"), max_bytes=8, model_name="counting")
+    def fail():
+        raise RuntimeError("disk full")
+    monkeypatch.setattr(cache, "_evict", fail)
+    with pytest.raises(RuntimeError):
+        cache.embed_documents(["a", "b"])
+    assert not cache._db.in_transaction
+    assert cache.stats()['bytes'] == 0
+    monkeypatch.undo()
+    assert cache.embed_documents(["a"]) == [[1.0, 1.0]]
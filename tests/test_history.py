@@ -0,0 +1,39 @@
+from server.history import HistoryPacker
+
+def count_words(text):
+    return len(text.split())
+
+def test_the_best_memories_that_fit_are_packed():
+    packer = HistoryPacker(budget=6, separator="")
+    assert packer.pack(["one two three", "four five", "six seven"], count_words) == "one two threefour five"
+
+def test_a_memory_that_does_not_fit_is_skipped_for_a_shorter_one():
+    packer = HistoryPacker(budget=5, item_template="- {text}", separator="\n")
+    # "- a b c d e" is 6 tokens, the ones after it still fit; the separator counts 0 words
+    assert packer.pack(["a b c d e", "f g", " h "], count_words) == "- f g\n- h"
+    assert packer.pack(["a b c d e f g"], count_words) == ""
+
+def test_the_token_counts_are_cached():
+    counted = []
+    def count_tokens(text):
+        counted.append(text)
+        return count_words(text)
+    packer = HistoryPacker(budget=100)
+    packer.pack(["a", "b"], count_tokens)
+    packer.pack(["b", "a"], count_tokens)
+    assert counted == ["\n", "a", "b"]
+    assert packer.stats()['hits'] == 3 and packer.stats()['misses'] == 3
+    packer.clear()
+    packer.pack(["a"], count_tokens)
+    assert counted[-1] == "a"
+
+def test_the_least_recently_counted_text_is_forgotten():
+    packer = HistoryPacker(budget=100, maxsize=2)
+    packer.count("a", count_words)
+    packer.count("b", count_words)
+    packer.count("a", count_words)
+    packer.count("c", count_words)
+    packer.count("a", count_words)
+    assert packer.stats()['hits'] == 2 and packer.stats()['size'] == 2
+    packer.count("b", count_words)
+    assert packer.stats()['misses'] == 4
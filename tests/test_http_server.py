@@ -0,0 +1,91 @@
+import json
+import re
+import socket
+import threading
+from http.server import ThreadingHTTPServer
+import pytest
+from bench.fakes import FakeLlamaCpp, FakeVectorStore
+from server.http_server import HttpRequestHandler
+from server.models import ModelRegistry
+from server.scheduler import Scheduler
+from server.startup import Startup
+
+PROMPT = {
+    'complete_prompt': "Chat:\n{history}\n### {user_name}: {user_text}\n### {ai_name}:{ai_text}",
+    'chat_text': {'user_name': "### {user_name}: {user_text}", 'ai_name': "### {ai_name}: {ai_text}"},
+    'names': {'user_name': "Human", 'ai_name': "AI"},
+    'chat': {'user_text': "hello", 'ai_text': ""},
+    'args': {'history': ""},
+}
+
+@pytest.fixture
+def address(monkeypatch):
+    startup = Startup()
+    startup.complete()
+    startup.wait(5)
+    registry = ModelRegistry(lambda name: Scheduler(FakeLlamaCpp(max_tokens=8, tokens_per_second=5000, prefill_cost=0),
+                                                     echo=False), "fake")
+    monkeypatch.setattr(HttpRequestHandler, "startup", startup)
+    monkeypatch.setattr(HttpRequestHandler, "registry", registry)
+    monkeypatch.setattr(HttpRequestHandler, "vectorstore", FakeVectorStore(latency=0))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), HttpRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server.server_address
+    server.shutdown()
+    server.server_close()
+    registry.close()
+
+def request(method, path, body=b"", headers=""):
+    return f"{method} {path} HTTP/1.1\r\nHost: test\r\nContent-Length: {len(body)}\r\n{headers}\r\n".encode() + body
+
+def read_responses(sock, count):
+    """Read count responses from the connection, the status codes and the bodies."""
+    data = b""
+    responses = []
+    while len(responses) < count:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+        while len(responses) < count:
+            head, separator, rest = data.partition(b"\r\n\r\n")
+            if not separator:
+                break
+            status = int(head.split(b" ")[1])
+            if b"chunked" in head.lower():
+                # Up to the last empty chunk
+                end = rest.find(b"\r\n0\r\n\r\n")
+                if end < 0:
+                    break
+                body, data = rest[:end + 2], rest[end + 7:]
+            else:
+                length = int(re.search(rb"Content-Length: (\d+)", head, re.I).group(1))
+                if len(rest) < length:
+                    break
+                body, data = rest[:length], rest[length:]
+            responses.append((status, body))
+    return responses
+
+def test_every_path_reads_the_body_before_the_next_request(address):
+    body = json.dumps({'ignored': True}).encode()
+    with socket.create_connection(address, timeout=10) as sock:
+        sock.sendall(request("POST", "/nope", body) + request("GET", "/health", body) + request("GET", "/metrics", body)
+                     + request("GET", "/ready", body) + request("GET", "/scheduler", body) + request("GET", "/stats", body)
+                     + request("GET", "/nope", body) + request("GET", "/health"))
+        statuses = [status for status, _ in read_responses(sock, 8)]
+    assert statuses == [404, 200, 200, 200, 200, 200, 404, 200]
+
+def test_a_streamed_prompt_leaves_the_connection_usable(address):
+    body = json.dumps({**PROMPT, 'stream': True}).encode()
+    with socket.create_connection(address, timeout=10) as sock:
+        sock.sendall(request("GET", "/prompt", body) + request("GET", "/health"))
+        (stream_status, stream), (health_status, _) = read_responses(sock, 2)
+    events = [json.loads(line[len(b"data: "):]) for line in stream.split(b"\n") if line.startswith(b"data: ")]
+    assert stream_status == 200 and health_status == 200
+    assert events[-1]['prompt'].endswith("".join(event['token'] for event in events[:-1]))
+
+def test_a_body_that_can_not_be_framed_closes_the_connection(address):
+    with socket.create_connection(address, timeout=10) as sock:
+        sock.sendall(b"GET /health HTTP/1.1\r\nHost: test\r\nContent-Length: nope\r\n\r\n")
+        assert read_responses(sock, 1)[0][0] == 400
+        assert sock.recv(1) == b""
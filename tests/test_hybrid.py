@@ -0,0 +1,73 @@
+from langchain.docstore.document import Document
+from server.hybrid import BM25Index, HybridStore
+from server.retrieval_cache import RetrievalCacheStore
+
+class RankedStore:
+    """A vector store that answers every search with the same ranking, or fails."""
+
+    def __init__(self, ranking=(), fail=False):
+        self.ranking = [Document(page_content=text) for text in ranking]
+        self.fail = fail
+
+    def similarity_search(self, query, k=4, **kwargs):
+        if self.fail:
+            raise RuntimeError("the store is down")
+        return self.ranking[:k]
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        return []
+
+    def delete(self, ids, **kwargs):
+        pass
+
+def test_bm25_ranks_the_rare_word_first():
+    index = BM25Index()
+    index.add(["1", "2", "3"], ["the cat sat", "the dog sat", "my order number is 4711"])
+    assert index.search("what was order 4711", k=1)[0][0].page_content == "my order number is 4711"
+
+def test_bm25_searches_one_namespace():
+    index = BM25Index()
+    index.add(["1", "2"], ["alice likes tea", "bob likes tea"], [{"namespace": "alice"}, {"namespace": "bob"}])
+    assert [doc.page_content for doc, _ in index.search("tea", namespace="bob")] == ["bob likes tea"]
+    assert len(index.search("tea", all_namespaces=True)) == 2
+
+def test_bm25_log_replays_adds_and_deletes(tmp_path):
+    path = str(tmp_path / "bm25.jsonl")
+    index = BM25Index(path)
+    index.add(["1", "2"], ["kept memory", "deleted memory"])
+    index.remove(["2"])
+    reopened = BM25Index(path)
+    assert len(reopened) == 1
+    assert [doc.page_content for doc, _ in reopened.search("memory", all_namespaces=True)] == ["kept memory"]
+
+def test_rrf_puts_the_doc_both_rankings_agree_on_first():
+    store = HybridStore(RankedStore(), BM25Index(), rrf_k=60)
+    vector = [Document(page_content=text) for text in ["a", "b", "c"]]
+    lexical = [Document(page_content=text) for text in ["b", "d"]]
+    assert [doc.page_content for doc in store.fuse([vector, lexical], 3)] == ["b", "a", "d"]
+
+def test_hybrid_fuses_and_falls_back_to_lexical():
+    index = BM25Index()
+    store = HybridStore(RankedStore(["vector only", "both"]), index)
+    store.add_texts(["both", "lexical only"])
+    assert {doc.page_content for doc in store.similarity_search("both lexical only", k=3)} == {"vector only", "both", "lexical only"}
+    assert store.similarity_search("both", k=1)[0].page_content == "both"
+    failing = HybridStore(RankedStore(fail=True), index)
+    assert [doc.page_content for doc in failing.similarity_search("lexical", k=1)] == ["lexical only"]
+    assert failing.stats()['fallbacks'] == 1
+
+def test_lexical_mode_never_asks_the_vector_store():
+    store = HybridStore(RankedStore(fail=True), BM25Index(), mode="lexical")
+    store.add_texts(["just words"])
+    assert store.similarity_search("words", k=1)[0].page_content == "just words"
+
+def test_lexical_fallback_results_are_not_cached():
+    vector = RankedStore(["vector only"], fail=True)
+    cache = RetrievalCacheStore(HybridStore(vector, BM25Index()))
+    cache.add_texts(["just words"])
+    assert [doc.page_content for doc in cache.similarity_search("words", k=2)] == ["just words"]
+    vector.fail = False
+    assert {doc.page_content for doc in cache.similarity_search("words", k=2)} == {"just words", "vector only"}
+    assert cache.stats()['hits'] == 0
+    cache.similarity_search("words", k=2)
+    assert cache.stats()['hits'] == 1
@@ -0,0 +1,60 @@
+import time
+from bench.fakes import FakeLlamaCpp, FakeState
+from server.kv_cache import KVStateCache
+from server.scheduler import Scheduler
+
+def state(tokens, size=100):
+    return FakeState(list(tokens), size)
+
+def test_lookup_returns_the_longest_shared_prefix():
+    cache = KVStateCache(max_bytes=1000, min_prefix=2)
+    cache.put("a", state([1, 2, 3]))
+    cache.put("b", state([1, 2, 3, 4, 5]))
+    found, prefix = cache.lookup("c", [1, 2, 3, 4, 9])
+    assert prefix == 4
+    assert found.input_ids == [1, 2, 3, 4, 5]
+
+def test_own_session_wins_ties():
+    cache = KVStateCache(max_bytes=1000, min_prefix=2)
+    cache.put("a", state([1, 2, 3]))
+    cache.put("b", state([1, 2, 3]))
+    found, _ = cache.lookup("a", [1, 2, 3, 4])
+    assert found is cache._states["a"][1]
+
+def test_short_prefixes_are_misses():
+    cache = KVStateCache(max_bytes=1000, min_prefix=3)
+    cache.put("a", state([1, 2, 7]))
+    assert cache.lookup("a", [1, 2, 3]) == (None, 0)
+    assert cache.stats()['misses'] == 1
+
+def test_least_recently_used_states_are_evicted_over_budget():
+    cache = KVStateCache(max_bytes=250, min_prefix=1)
+    cache.put("a", state([1]))
+    cache.put("b", state([2]))
+    cache.lookup(None, [1])
+    cache.put("c", state([3]))
+    assert set(cache._states) == {"a", "c"}
+    assert cache.size == 200
+    # A state bigger than the whole budget is never kept
+    cache.put("d", state([4], size=1000))
+    assert "d" not in cache._states
+
+def test_idle_states_are_dropped():
+    cache = KVStateCache(max_bytes=1000, max_idle=0.01, min_prefix=1)
+    cache.put("a", state([1]))
+    time.sleep(0.02)
+    assert cache.lookup("a", [1]) == (None, 0)
+    assert cache.stats()['evictions'] == 1
+
+def test_next_turn_starts_from_the_state_of_the_last_one():
+    llm = FakeLlamaCpp(max_tokens=4, tokens_per_second=5000, prefill_cost=0)
+    scheduler = Scheduler(llm, echo=False, kv_cache=KVStateCache(max_bytes=1 << 30, min_prefix=2))
+    try:
+        first = "the start of a conversation"
+        output = scheduler.generate(first, session="s")
+        job = scheduler.submit(first + output + " and more", session="s")
+        job.result()
+    finally:
+        scheduler.close()
+    # Everything but the new words came from the cached state
+    assert job.prefix_tokens == len(llm.client.tokenize((first + output).encode()))
@@ -0,0 +1,50 @@
+import pytest
+from server.metrics import Histogram, Metrics
+
+def test_percentiles_interpolate_inside_their_bucket():
+    histogram = Histogram("latency", "", buckets=(1, 2, 4))
+    assert histogram.percentile(0.5) is None
+    for value in (0.5, 1.5, 1.5, 3):
+        histogram.observe(value)
+    assert histogram.percentile(0.5) == pytest.approx(1.5)
+    assert histogram.percentile(0.99) == pytest.approx(3.92)
+    assert histogram.snapshot() == {'count': 4, 'avg': pytest.approx(1.625), 'p50': pytest.approx(1.5),
+                                    'p95': pytest.approx(3.6), 'p99': pytest.approx(3.92)}
+
+def test_a_value_on_a_bound_is_in_that_bucket_and_past_the_last_one_is_capped():
+    histogram = Histogram("latency", "", buckets=(1, 2))
+    histogram.observe(1)
+    assert histogram.counts == [1, 0, 0]
+    histogram.observe(100)
+    assert histogram.counts == [1, 0, 1]
+    assert histogram.percentile(1.0) == 2
+
+def test_render_is_the_prometheus_text_format():
+    metrics = Metrics(prefix="test")
+    metrics.counter("requests_total", "Prompt requests received")
+    metrics.inc("requests_total", 3)
+    metrics.histogram("wait_seconds", "Seconds waited", buckets=(0.1, 1))
+    metrics.observe("wait_seconds", 0.05)
+    metrics.observe("wait_seconds", 0.5)
+    metrics.observe("wait_seconds", 5)
+    assert metrics.render() == "\n".join([
+        "# HELP test_requests_total Prompt requests received",
+        "# TYPE test_requests_total counter",
+        "test_requests_total 3",
+        "# HELP test_wait_seconds Seconds waited",
+        "# TYPE test_wait_seconds histogram",
+        'test_wait_seconds_bucket{le="0.1"} 1',
+        'test_wait_seconds_bucket{le="1"} 2',
+        'test_wait_seconds_bucket{le="+Inf"} 3',
+        "test_wait_seconds_sum 5.55",
+        "test_wait_seconds_count 3",
+    ]) + "\n"
+
+def test_timer_records_the_block_and_snapshot_has_every_metric():
+    metrics = Metrics(prefix="test")
+    with metrics.timer("block_seconds"):
+        pass
+    metrics.inc("errors_total")
+    snapshot = metrics.snapshot()
+    assert snapshot['histograms']['block_seconds']['count'] == 1
+    assert snapshot['counters'] == {'errors_total': 1}
@@ -0,0 +1,70 @@
+import threading
+import time
+import pytest
+from server.models import ModelRegistry, find_model
+
+class Model:
+    """Stands in for a scheduler, counts the models loaded at the same time."""
+    resident = set()
+    peak = 0
+    lock = threading.Lock()
+
+    def __init__(self, name):
+        self.name = name
+        with Model.lock:
+            Model.resident.add(name)
+            Model.peak = max(Model.peak, len(Model.resident))
+
+    def close(self):
+        with Model.lock:
+            Model.resident.discard(self.name)
+
+@pytest.fixture(autouse=True)
+def reset():
+    Model.resident, Model.peak = set(), 0
+
+def load(name):
+    model = Model(name)
+    time.sleep(0.01)
+    return model
+
+def test_one_model_is_resident_at_a_time():
+    registry = ModelRegistry(load, "a", max_resident=1)
+    def use(name):
+        with registry.lease(name):
+            time.sleep(0.005)
+    threads = [threading.Thread(target=use, args=("abc"[i % 3],)) for i in range(18)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    registry.close()
+    assert Model.peak == 1
+
+def test_a_leased_model_is_unloaded_once_its_requests_are_done():
+    registry = ModelRegistry(load, "a", max_resident=1)
+    with registry.lease("a"):
+        switch = threading.Thread(target=registry.set_default, args=("b",))
+        switch.start()
+        time.sleep(0.05)
+        # b waits for a to be unloaded, which waits for this request
+        assert Model.resident == {"a"}
+    switch.join()
+    assert registry.default == "b" and Model.resident == {"b"}
+    registry.close()
+
+def test_requests_choose_the_model_only_when_allowed():
+    registry = ModelRegistry(load, "a", allow_selection=False)
+    with pytest.raises(ValueError):
+        with registry.lease("b"):
+            pass
+    with registry.lease("a") as model:
+        assert model.name == "a"
+    registry.close()
+
+def test_find_model_stays_in_the_folder(tmp_path):
+    (tmp_path / "vicuna").mkdir()
+    (tmp_path / "vicuna" / "model.bin").write_bytes(b"")
+    assert find_model("vicuna", str(tmp_path)).endswith("model.bin")
+    with pytest.raises(ValueError):
+        find_model("../vicuna", str(tmp_path))
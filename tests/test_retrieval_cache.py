@@ -0,0 +1,69 @@
+import time
+from server.retrieval_cache import RetrievalCacheStore
+
+class CountingStore:
+    def __init__(self):
+        self.searches = 0
+
+    def similarity_search(self, query, k=4, **kwargs):
+        self.searches += 1
+        return [f"{query}/{kwargs.get('namespace')}/{self.searches}"]
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        return []
+
+    def delete(self, ids, **kwargs):
+        pass
+
+def test_same_normalized_query_is_a_hit():
+    store = CountingStore()
+    cache = RetrievalCacheStore(store)
+    first = cache.similarity_search("Hello  There", k=4, namespace="u")
+    assert cache.similarity_search("hello there", k=4, namespace="u") == first
+    assert store.searches == 1
+    assert cache.stats()['hits'] == 1
+
+def test_key_has_the_namespace_and_k():
+    store = CountingStore()
+    cache = RetrievalCacheStore(store)
+    cache.similarity_search("hi", k=4, namespace="alice")
+    assert cache.similarity_search("hi", k=4, namespace="bob") == ["hi/bob/2"]
+    cache.similarity_search("hi", k=2, namespace="alice")
+    assert store.searches == 3
+
+def test_saving_invalidates_only_its_namespace():
+    store = CountingStore()
+    cache = RetrievalCacheStore(store)
+    cache.similarity_search("hi", namespace="alice")
+    cache.similarity_search("hi", namespace="bob")
+    cache.add_texts(["new memory"], metadatas=[{"namespace": "alice"}])
+    cache.similarity_search("hi", namespace="alice")
+    cache.similarity_search("hi", namespace="bob")
+    assert store.searches == 3
+
+def test_saving_without_namespace_and_deleting_invalidate_everything():
+    store = CountingStore()
+    cache = RetrievalCacheStore(store)
+    cache.similarity_search("hi", namespace="alice")
+    cache.add_texts(["no namespace"])
+    cache.similarity_search("hi", namespace="alice")
+    cache.delete(["id"])
+    cache.similarity_search("hi", namespace="alice")
+    assert store.searches == 3
+
+def test_results_expire_after_ttl():
+    store = CountingStore()
+    cache = RetrievalCacheStore(store, ttl=0.01)
+    cache.similarity_search("hi")
+    time.sleep(0.02)
+    cache.similarity_search("hi")
+    assert store.searches == 2
+
+def test_saving_in_a_namespace_invalidates_the_searches_without_one():
+    store = CountingStore()
+    cache = RetrievalCacheStore(store)
+    cache.similarity_search("hi")
+    cache.add_texts(["new memory"], metadatas=[{"namespace": "alice"}])
+    assert cache.similarity_search("hi") == ["hi/None/2"]
+    cache.delete(["id"], namespace="bob")
+    assert cache.similarity_search("hi") == ["hi/None/3"]
@@ -0,0 +1,95 @@
+import threading
+import pytest
+from bench.fakes import FakeLlamaCpp
+from server.scheduler import GenerationCancelled, Scheduler
+from tests.conftest import expected_tokens
+
+def test_generate_returns_the_tokens_of_the_prompt(scheduler):
+    assert scheduler.generate("hello there") == "".join(expected_tokens("hello there", 8))
+    assert scheduler.stats()['completed'] == 1
+
+def test_round_robin_interleaves_the_prompts_and_keeps_their_outputs(llm):
+    scheduler = Scheduler(llm, max_active=3, quantum=2, echo=False)
+    order = []
+    prompts = ["first prompt", "second prompt", "third prompt"]
+    try:
+        jobs = [scheduler.submit(prompt, on_token=lambda token, i=i: order.append(i)) for i, prompt in enumerate(prompts)]
+        for job, prompt in zip(jobs, prompts):
+            assert job.result() == "".join(expected_tokens(prompt, 8))
+    finally:
+        scheduler.close()
+    # Every prompt got a turn before the first one finished
+    assert set(order[:8]) == {0, 1, 2}
+    assert scheduler.parked_bytes == 0
+
+def test_one_prompt_at_a_time_by_default(llm):
+    scheduler = Scheduler(llm, echo=False)
+    order = []
+    try:
+        jobs = [scheduler.submit(prompt, on_token=lambda token, i=i: order.append(i)) for i, prompt in enumerate(["a b", "c d"])]
+        for job in jobs:
+            job.result()
+    finally:
+        scheduler.close()
+    assert scheduler.max_active == 1
+    assert order == [0] * 8 + [1] * 8
+
+def test_parked_states_stay_within_the_budget():
+    llm = FakeLlamaCpp(max_tokens=12, tokens_per_second=5000, prefill_cost=0, state_size=1000)
+    scheduler = Scheduler(llm, max_active=4, quantum=1, echo=False, max_parked_bytes=1000)
+    parked = []
+    try:
+        jobs = [scheduler.submit(f"prompt number {i}", on_token=lambda token: parked.append(scheduler.parked_bytes))
+                for i in range(4)]
+        for i, job in enumerate(jobs):
+            assert job.result() == "".join(expected_tokens(f"prompt number {i}", 12))
+    finally:
+        scheduler.close()
+    assert max(parked) <= 1000
+    assert scheduler.parked_bytes == 0
+
+def test_cancel_while_running_stops_within_a_token(llm):
+    scheduler = Scheduler(llm, echo=False)
+    cancel = threading.Event()
+    tokens = []
+    def on_token(token):
+        tokens.append(token)
+        if len(tokens) == 2:
+            cancel.set()
+    try:
+        job = scheduler.submit("cancel me", on_token=on_token, cancel=cancel)
+        with pytest.raises(GenerationCancelled):
+            job.result(timeout=5)
+    finally:
+        scheduler.close()
+    assert len(job.tokens) == 2
+    assert scheduler.stats()['cancelled'] == 1
+
+def test_cancel_while_queued_never_starts():
+    llm = FakeLlamaCpp(max_tokens=8, tokens_per_second=200, prefill_cost=0)
+    scheduler = Scheduler(llm, echo=False)
+    try:
+        first = scheduler.submit("keeps the model busy")
+        second = scheduler.submit("is cancelled while it waits")
+        second.cancel()
+        with pytest.raises(GenerationCancelled):
+            second.result(timeout=5)
+        first.result(timeout=5)
+    finally:
+        scheduler.close()
+    assert second.tokens == []
+    assert second.first_step_at is None
+
+def test_submit_after_close_raises(llm):
+    scheduler = Scheduler(llm, echo=False)
+    scheduler.close()
+    with pytest.raises(RuntimeError):
+        scheduler.submit("too late")
+    # Closing twice is fine
+    scheduler.close()
+
+def test_count_tokens_and_prompt_budget(llm, scheduler):
+    # One token per word and the BOS token
+    assert scheduler.count_tokens("one two three") == 4
+    llm.n_ctx = 100
+    assert scheduler.prompt_budget == 100 - 8
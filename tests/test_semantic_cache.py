@@ -0,0 +1,70 @@
+import time
+import numpy as np
+import pytest
+from bench.fakes import FakeLlamaCpp, FakeVectorStore
+from server import chain
+from server.protocol import PromptRequest
+from server.scheduler import Scheduler
+from server.semantic_cache import SemanticCache
+
+def unit(*values):
+    vector = np.asarray(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+def test_scope_has_the_template_the_names_the_model_and_the_user():
+    cache = SemanticCache()
+    scope = cache.scope("template", {'user_name': "a"}, "model", "alice")
+    assert scope == cache.scope("template", {'user_name': "a"}, "model", "alice")
+    assert scope != cache.scope("template", {'user_name': "a"}, "model", "bob")
+    assert scope != cache.scope("template", {'user_name': "a"}, "other", "alice")
+    assert scope != cache.scope("other", {'user_name': "a"}, "model", "alice")
+    assert scope != cache.scope("template", {'user_name': "b"}, "model", "alice")
+
+def test_lookup_hits_above_the_threshold_only():
+    cache = SemanticCache(threshold=0.9)
+    cache.put("s", unit(1, 0), ["answer"])
+    assert cache.lookup("s", unit(1, 0.1))[0] == ["answer"]
+    assert cache.lookup("s", unit(1, 1))[0] is None
+    assert cache.lookup("other", unit(1, 0))[0] is None
+    assert cache.stats()['hits'] == 1
+
+def test_answers_expire_and_the_ring_keeps_the_newest():
+    cache = SemanticCache(threshold=0.9, ttl=0.01, max_entries=2)
+    cache.put("s", unit(1, 0), ["old"])
+    time.sleep(0.02)
+    assert cache.lookup("s", unit(1, 0))[0] is None
+    cache.put("s", unit(0, 1), ["b"])
+    cache.put("s", unit(1, 1), ["c"])
+    assert len(cache._scopes["s"].answers) == 2
+    assert cache.lookup("s", unit(1, 0))[0] is None
+
+class EmbeddingStore(FakeVectorStore):
+    def __init__(self, embedding):
+        super().__init__(latency=0)
+        self.embedding = embedding
+
+@pytest.fixture
+def semantic(monkeypatch):
+    semantic = SemanticCache(threshold=0.95)
+    monkeypatch.setattr(chain, "semantic", semantic)
+    return semantic
+
+def chat_request(user_id, text="hello there friend"):
+    return PromptRequest("Chat:\n{history}\n### {user_name}: {user_text}\n### {ai_name}:{ai_text}",
+                         chat={'user_text': text, 'ai_text': ""}, names={'user_name': "Human", 'ai_name': "AI"},
+                         chat_text={'user_name': "### {user_name}: {user_text}", 'ai_name': "### {ai_name}: {ai_text}"},
+                         args={'history': ""}, memory=True, user_id=user_id, semantic_cache=True)
+
+def test_answers_are_not_shared_between_users(semantic, embeddings):
+    llm = FakeLlamaCpp(max_tokens=4, tokens_per_second=5000, prefill_cost=0)
+    scheduler = Scheduler(llm, echo=False)
+    store = EmbeddingStore(embeddings)
+    try:
+        chain.run_chain(chat_request("alice"), scheduler, store)
+        chain.run_chain(chat_request("alice", "Hello there friend "), scheduler, store)
+        chain.run_chain(chat_request("bob"), scheduler, store)
+    finally:
+        scheduler.close()
+    # alice's second request came from the cache, bob's ran the model
+    assert scheduler.completed == 2
+    assert semantic.hits == 1
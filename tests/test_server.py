@@ -0,0 +1,83 @@
+import asyncio
+import pytest
+import websockets.exceptions
+from server.codec import MSGPACK_SUBPROTOCOL, get_codec
+from server.protocol import SERVER_CODES, PromptResponse
+from server.server import Server
+
+class FakeWebsocket:
+    """A connection that sends right away, or never when it is stalled."""
+
+    def __init__(self, stalled=False, subprotocol=None):
+        self.stalled = stalled
+        self.subprotocol = subprotocol
+        self.remote_address = ("127.0.0.1", 0)
+        self.sending = []
+        self.sent = []
+        self.closed = []
+
+    async def send(self, message):
+        self.sending.append(message)
+        if self.stalled:
+            await asyncio.Event().wait()
+        self.sent.append(message)
+
+    async def close(self, code=1000, reason=""):
+        self.closed.append(code)
+
+def test_a_stalled_client_does_not_hold_up_the_others():
+    async def run():
+        server = Server(max_outbox=2)
+        fast, stalled = FakeWebsocket(), FakeWebsocket(stalled=True)
+        fast_id = await server.register(fast)
+        stalled_id = await server.register(stalled)
+        for i in range(10):
+            await server.send_to_clients(f"message {i}")
+        await asyncio.sleep(0)
+        sent = list(fast.sent)
+        waiting = server.outboxes[stalled_id].qsize()
+        await server.unregister(fast_id)
+        await server.unregister(stalled_id)
+        return sent, waiting
+    sent, waiting = asyncio.run(run())
+    assert sent == [f"message {i}" for i in range(10)]
+    assert waiting == 2
+
+def test_a_stalled_client_is_disconnected_once():
+    async def run():
+        server = Server(max_outbox=1, overflow="disconnect")
+        stalled = FakeWebsocket(stalled=True)
+        client_id = await server.register(stalled)
+        for i in range(5):
+            await server.send_to_clients(f"message {i}")
+        await asyncio.sleep(0)
+        await server.unregister(client_id)
+        return stalled.closed
+    assert asyncio.run(run()) == [1008]
+
+def test_responses_are_written_in_the_subprotocol_of_the_client():
+    async def run():
+        server = Server()
+        ws = FakeWebsocket(subprotocol=MSGPACK_SUBPROTOCOL)
+        client_id = await server.register(ws)
+        await server.send_response(client_id, PromptResponse(status=SERVER_CODES['RUNNING'], token=" hi"))
+        await server.unregister(client_id)
+        return ws.sent
+    sent = asyncio.run(run())
+    assert get_codec(MSGPACK_SUBPROTOCOL).decode_response(sent[0])['token'] == " hi"
+
+def test_messages_queued_for_a_client_that_leaves_fail():
+    async def run():
+        server = Server()
+        ws = FakeWebsocket(stalled=True)
+        client_id = await server.register(ws)
+        first = asyncio.ensure_future(server.send_to_client(client_id, "in flight"))
+        second = asyncio.ensure_future(server.send_to_client(client_id, "queued"))
+        while not ws.sending:
+            await asyncio.sleep(0)
+        await server.unregister(client_id)
+        with pytest.raises(ValueError):
+            await second
+        with pytest.raises(ValueError):
+            await asyncio.wait_for(first, 1)
+    asyncio.run(run())
@@ -0,0 +1,50 @@
+import threading
+import time
+import pytest
+from server.startup import Startup
+
+def test_a_phase_starts_after_the_phases_it_comes_after():
+    startup = Startup()
+    order = []
+    release = threading.Event()
+    def first():
+        release.wait(5)
+        order.append("first")
+        return 1
+    a = startup.run("first", first)
+    b = startup.run("second", lambda: order.append("second") or a.result() + 1, after=[a])
+    startup.complete(a, b)
+    assert not startup.wait(0.05)
+    release.set()
+    assert startup.wait(5)
+    assert order == ["first", "second"] and b.result() == 2
+    report = startup.report()
+    assert report['ready'] and report['error'] is None
+    assert set(report['phases']) == {"first", "second", "total"}
+    assert report['phases']['second']['started'] >= report['phases']['first']['seconds']
+
+def test_a_failing_phase_fails_the_startup_and_the_phases_after_it():
+    startup = Startup()
+    def fail():
+        raise RuntimeError("no model")
+    model = startup.run("model", fail)
+    compaction = startup.run("compaction", lambda: None, after=[model])
+    startup.complete(model, compaction)
+    assert not startup.wait(5)
+    with pytest.raises(RuntimeError):
+        compaction.result(5)
+    report = startup.report()
+    assert not report['ready'] and report['error'] == "no model"
+    assert report['phases']['model']['error'] == "no model"
+    # The phase after it never ran
+    assert report['phases']['compaction']['started'] is None
+
+def test_wait_gives_up_after_its_timeout():
+    startup = Startup()
+    release = threading.Event()
+    startup.complete(startup.run("slow", lambda: release.wait(5)))
+    start = time.monotonic()
+    assert not startup.wait(0.2)
+    assert 0.2 <= time.monotonic() - start < 1
+    release.set()
+    assert startup.wait(5) and startup.ready
@@ -0,0 +1,26 @@
+from server.template_cache import TemplateCache
+
+def test_the_same_template_is_built_once():
+    cache = TemplateCache()
+    first = cache.get("{history}\n### {user_name}: {user_text}", ["user_text", "history", "user_name"])
+    # The order of the variables does not matter
+    assert cache.get("{history}\n### {user_name}: {user_text}", ["user_name", "user_text", "history"]) is first
+    assert first.format(history="", user_name="Human", user_text="hi") == "\n### Human: hi"
+    assert cache.get("{history}\n### {user_name}: {user_text}!", ["user_text", "history", "user_name"]) is not first
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['size']) == (1, 2, 2)
+    assert stats['hit_ratio'] == 1 / 3
+
+def test_the_least_recently_used_template_is_evicted():
+    cache = TemplateCache(maxsize=2)
+    first = cache.get("{a}", ["a"])
+    cache.get("{b}", ["b"])
+    cache.get("{a}", ["a"])
+    cache.get("{c}", ["c"])
+    assert cache.stats()['size'] == 2
+    assert cache.get("{a}", ["a"]) is first
+    cache.get("{b}", ["b"])
+    assert cache.stats()['misses'] == 4
+
+def test_an_empty_cache_has_no_hit_ratio():
+    assert TemplateCache().stats()['hit_ratio'] is None
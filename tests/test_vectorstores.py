@@ -0,0 +1,71 @@
+import pytest
+from server.vectorstores import MmapVectorStore, WeaviateStore
+
+def texts(n):
+    return [f"memory {i} about topic{i % 7} and thing{i}" for i in range(n)]
+
+def test_search_finds_the_closest_memory(tmp_path, embeddings):
+    store = MmapVectorStore(str(tmp_path), embeddings)
+    store.add_texts(texts(20))
+    assert store.similarity_search("memory 3 about topic3 and thing3", k=1)[0].page_content == texts(20)[3]
+
+def test_search_stays_in_its_namespace(tmp_path, embeddings):
+    store = MmapVectorStore(str(tmp_path), embeddings)
+    store.add_texts(["a secret of alice"], metadatas=[{"namespace": "alice"}])
+    store.add_texts(["a secret of bob"], metadatas=[{"namespace": "bob"}])
+    docs = store.similarity_search("a secret of alice", k=4, namespace="bob")
+    assert [doc.page_content for doc in docs] == ["a secret of bob"]
+
+def test_ivf_index_finds_every_memory(tmp_path, embeddings):
+    store = MmapVectorStore(str(tmp_path), embeddings, ivf_threshold=50, nprobe=2)
+    memories = texts(200)
+    for start in range(0, 200, 25):
+        store.add_texts(memories[start:start + 25])
+    assert store._centroids is not None
+    # The list of a memory is the one of its closest centroid, so it is always probed
+    for i in range(0, 200, 13):
+        assert store.similarity_search(memories[i], k=1)[0].page_content == memories[i]
+
+def test_memories_survive_a_restart(tmp_path, embeddings):
+    store = MmapVectorStore(str(tmp_path), embeddings, ivf_threshold=50)
+    store.add_texts(texts(60), metadatas=[{"namespace": "u", "conversation_id": "c"}] * 60)
+    reopened = MmapVectorStore(str(tmp_path), embeddings, ivf_threshold=50)
+    assert reopened.count == 60
+    assert reopened.similarity_search(texts(60)[5], k=1, namespace="u")[0].page_content == texts(60)[5]
+
+def test_deleted_memories_are_not_found_and_vacuumed(tmp_path, embeddings):
+    store = MmapVectorStore(str(tmp_path), embeddings)
+    ids = store.add_texts(texts(10), metadatas=[{"namespace": "u", "conversation_id": "c"}] * 10)
+    store.delete(ids[:3])
+    assert texts(10)[0] not in [doc.page_content for doc in store.similarity_search(texts(10)[0], k=10)]
+    store.delete(ids[3:6])
+    # Past half the store deleted the files are rewritten without them
+    assert store.count == 4
+    assert [memory["text"] for memory in store.memories("c")] == texts(10)[6:]
+
+class FakeBatch:
+    def __init__(self, errors=None):
+        self.objects = []
+        self.errors = errors
+
+    def add_data_object(self, data_object, class_name, uuid=None, vector=None):
+        self.objects.append(data_object)
+
+    def create_objects(self):
+        results = [{"properties": data_object, "result": {}} for data_object in self.objects]
+        if self.errors:
+            results[0]["result"]["errors"] = self.errors
+        self.objects = []
+        return results
+
+class FakeClient:
+    def __init__(self, batch):
+        self.batch = batch
+
+def test_weaviate_raises_when_an_object_of_the_batch_fails():
+    pytest.importorskip("weaviate")
+    store = WeaviateStore(FakeClient(FakeBatch()), "Memory", "text")
+    assert len(store.add_texts(["one", "two"], metadatas=[{"namespace": "u"}] * 2)) == 2
+    store = WeaviateStore(FakeClient(FakeBatch({"error": [{"message": "invalid vector"}]})), "Memory", "text")
+    with pytest.raises(ValueError, match="invalid vector"):
+        store.add_texts(["one", "two"])
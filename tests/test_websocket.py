@@ -0,0 +1,231 @@
+import asyncio
+import json
+import threading
+import pytest
+import websockets.exceptions
+import websocket_main
+from bench.fakes import FakeLlamaCpp, FakeVectorStore
+from server import chain
+from server.models import ModelRegistry
+from server.protocol import SERVER_CODES, PromptResponse
+from server.scheduler import GenerationCancelled, Scheduler
+from server.server import Server
+from server.startup import Startup
+
+PROMPT = {
+    'complete_prompt': "Chat:\n{history}\n### {user_name}: {user_text}\n### {ai_name}:{ai_text}",
+    'chat_text': {'user_name': "### {user_name}: {user_text}", 'ai_name': "### {ai_name}: {ai_text}"},
+    'names': {'user_name': "Human", 'ai_name': "AI"},
+    'chat': {'user_text': "hello", 'ai_text': ""},
+    'args': {'history': ""},
+}
+
+class FakeSocket:
+    """A client connection, the test sends its messages and reads what the server wrote."""
+    subprotocol = None
+    remote_address = ("127.0.0.1", 0)
+
+    def __init__(self):
+        self.incoming = asyncio.Queue()
+        self.outgoing = asyncio.Queue()
+        self.closed = False
+
+    def send_request(self, message):
+        self.incoming.put_nowait(json.dumps(message))
+
+    def disconnect(self):
+        self.incoming.put_nowait(None)
+
+    async def recv(self):
+        message = await self.incoming.get()
+        if message is None:
+            self.closed = True
+            raise websockets.exceptions.ConnectionClosedOK(None, None)
+        return message
+
+    async def send(self, message):
+        if self.closed:
+            raise websockets.exceptions.ConnectionClosedOK(None, None)
+        self.outgoing.put_nowait(json.loads(message))
+
+    async def close(self, code=1000, reason=""):
+        self.closed = True
+
+    async def response(self):
+        """The next response that is not a token."""
+        while True:
+            response = await asyncio.wait_for(self.outgoing.get(), 5)
+            if response['status'] != SERVER_CODES['RUNNING']:
+                return response
+
+class StubChain:
+    """Stands in for the chains: streams a token, then runs until released or cancelled."""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.user_texts = []
+        self.cancelled = 0
+        self.error = None
+
+    def run(self, user_text, on_token, cancel):
+        self.user_texts.append(user_text)
+        if self.error is not None:
+            raise self.error
+        on_token(" hi")
+        while not self.release.wait(0.01):
+            if cancel.is_set():
+                self.cancelled += 1
+                raise GenerationCancelled()
+        return PromptResponse(status=SERVER_CODES['SUCCESS'], prompt=" done", chat={'user_text': user_text, 'ai_text': " done"})
+
+    def run_chain(self, prompt_request, scheduler, vectorstore, on_token=None, cancel=None):
+        return self.run(prompt_request.chat['user_text'], on_token, cancel)
+
+    def run_session(self, session, user_text, scheduler, vectorstore, on_token=None, cancel=None):
+        return self.run(user_text, on_token, cancel)
+
+@pytest.fixture
+def stub(monkeypatch):
+    startup = Startup()
+    startup.complete()
+    startup.wait(5)
+    registry = ModelRegistry(lambda name: Scheduler(FakeLlamaCpp(max_tokens=8, tokens_per_second=5000, prefill_cost=0),
+                                                     echo=False), "fake")
+    stub = StubChain()
+    monkeypatch.setattr(websocket_main, "startup", startup)
+    monkeypatch.setattr(websocket_main, "registry", registry)
+    monkeypatch.setattr(websocket_main, "vectorstore", FakeVectorStore(latency=0))
+    monkeypatch.setattr(websocket_main, "echo", False)
+    monkeypatch.setattr(websocket_main, "sessions", {})
+    monkeypatch.setattr(websocket_main, "cancels", {})
+    monkeypatch.setattr(websocket_main, "queued", {})
+    monkeypatch.setattr(chain, "run_chain", stub.run_chain)
+    monkeypatch.setattr(chain, "run_session", stub.run_session)
+    yield stub
+    stub.release.set()
+    registry.close()
+
+def connect():
+    """A client connected to a server running the websocket handler."""
+    server = Server()
+    server.server_handler = websocket_main.server_handler
+    server.on_disconnect = websocket_main.on_disconnect
+    ws = FakeSocket()
+    return ws, asyncio.ensure_future(server.ws_handler(ws, "/"))
+
+def test_a_cancel_message_stops_the_running_prompt(stub):
+    async def main():
+        ws, handler = connect()
+        ws.send_request(PROMPT)
+        assert (await asyncio.wait_for(ws.outgoing.get(), 5))['token'] == " hi"
+        ws.send_request({"type": "cancel"})
+        assert (await ws.response())['status'] == SERVER_CODES['CANCELLED']
+        await asyncio.wait_for(handler, 5)
+    asyncio.run(main())
+    assert stub.cancelled == 1
+    assert websocket_main.cancels == {}
+
+def test_a_client_that_disconnects_cancels_its_prompt(stub):
+    async def main():
+        ws, handler = connect()
+        ws.send_request(dict(PROMPT, session=True))
+        await asyncio.wait_for(ws.outgoing.get(), 5)
+        ws.disconnect()
+        await asyncio.wait_for(handler, 5)
+    asyncio.run(main())
+    assert stub.cancelled == 1
+    assert websocket_main.cancels == {} and websocket_main.sessions == {}
+
+def test_messages_sent_while_a_prompt_runs_are_answered_after_it(stub):
+    async def main():
+        ws, handler = connect()
+        ws.send_request(dict(PROMPT, session=True))
+        await asyncio.wait_for(ws.outgoing.get(), 5)
+        ws.send_request({"user_text": " again"})
+        await asyncio.sleep(0.05)
+        stub.release.set()
+        assert (await ws.response())['chat']['user_text'] == "hello"
+        assert (await ws.response())['chat']['user_text'] == " again"
+        ws.send_request({"type": "end"})
+        await asyncio.wait_for(handler, 5)
+    asyncio.run(main())
+    assert stub.user_texts == ["hello", " again"]
+
+def test_messages_past_max_queued_get_an_error(stub, monkeypatch):
+    monkeypatch.setattr(websocket_main, "MAX_QUEUED", 1)
+    async def main():
+        ws, handler = connect()
+        ws.send_request(dict(PROMPT, session=True))
+        await asyncio.wait_for(ws.outgoing.get(), 5)
+        ws.send_request({"user_text": " kept"})
+        ws.send_request({"user_text": " dropped"})
+        error = await ws.response()
+        assert error['status'] == SERVER_CODES['ERROR'] and "Too many messages" in error['error']
+        stub.release.set()
+        assert (await ws.response())['chat']['user_text'] == "hello"
+        assert (await ws.response())['chat']['user_text'] == " kept"
+        ws.send_request({"type": "end"})
+        await asyncio.wait_for(handler, 5)
+    asyncio.run(main())
+    assert stub.user_texts == ["hello", " kept"]
+
+def test_a_session_turn_only_sends_the_new_user_text_and_end_closes_it(stub):
+    stub.release.set()
+    async def main():
+        ws, handler = connect()
+        ws.send_request(dict(PROMPT, session=True))
+        assert (await ws.response())['status'] == SERVER_CODES['SUCCESS']
+        ws.send_request({"user_text": " and again"})
+        assert (await ws.response())['chat']['user_text'] == " and again"
+        ws.send_request({"type": "end"})
+        await asyncio.wait_for(handler, 5)
+    asyncio.run(main())
+    assert stub.user_texts == ["hello", " and again"]
+    assert websocket_main.sessions == {}
+
+def test_an_invalid_session_message_gets_an_error_and_the_session_goes_on(stub):
+    stub.release.set()
+    async def main():
+        ws, handler = connect()
+        ws.send_request(dict(PROMPT, session=True))
+        await ws.response()
+        ws.send_request({"foo": 1})
+        error = await ws.response()
+        assert error['status'] == SERVER_CODES['ERROR'] and "User text must be a string" in error['error']
+        ws.send_request({"user_text": " still here"})
+        assert (await ws.response())['status'] == SERVER_CODES['SUCCESS']
+        ws.send_request({"type": "end"})
+        await asyncio.wait_for(handler, 5)
+    asyncio.run(main())
+    assert stub.user_texts == ["hello", " still here"]
+
+def test_a_message_that_is_not_an_object_gets_an_error(stub):
+    stub.release.set()
+    async def main():
+        ws, handler = connect()
+        ws.incoming.put_nowait("[1, 2]")
+        error = await ws.response()
+        assert error['status'] == SERVER_CODES['ERROR'] and "A request must be an object" in error['error']
+        ws.send_request(PROMPT)
+        assert (await ws.response())['status'] == SERVER_CODES['SUCCESS']
+        await asyncio.wait_for(handler, 5)
+    asyncio.run(main())
+    assert stub.user_texts == ["hello"]
+
+def test_a_chain_that_fails_gets_an_error_and_the_session_goes_on(stub):
+    stub.release.set()
+    async def main():
+        ws, handler = connect()
+        ws.send_request(dict(PROMPT, session=True))
+        await ws.response()
+        stub.error = RuntimeError("the model went away")
+        ws.send_request({"user_text": " fails"})
+        assert (await ws.response())['status'] == SERVER_CODES['ERROR']
+        stub.error = None
+        ws.send_request({"user_text": " works"})
+        assert (await ws.response())['status'] == SERVER_CODES['SUCCESS']
+        ws.send_request({"type": "end"})
+        await asyncio.wait_for(handler, 5)
+    asyncio.run(main())
+    assert stub.user_texts == ["hello", " fails", " works"]
+    assert websocket_main.cancels == {}
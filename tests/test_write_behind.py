@@ -0,0 +1,62 @@
+import threading
+from server.write_behind import WriteBehindStore
+
+class RecordingStore:
+    """Records every batch written to it, the first failures calls fail."""
+
+    def __init__(self, failures=0):
+        self.batches = []
+        self.failures = failures
+        self.searched = 0
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("the store is down")
+        self.batches.append((list(texts), metadatas))
+        return [str(i) for i in range(len(texts))]
+
+    def similarity_search(self, query, k=4, **kwargs):
+        self.searched += 1
+        return []
+
+def test_texts_are_written_in_batches_in_order():
+    store = RecordingStore()
+    writer = WriteBehindStore(store, batch_size=2, flush_interval=10)
+    try:
+        assert writer.add_texts(["a", "b", "c"], metadatas=[{"n": 1}, {"n": 2}, {"n": 3}]) == []
+        writer.flush()
+    finally:
+        writer.close()
+    assert [texts for texts, _ in store.batches] == [["a", "b"], ["c"]]
+    assert store.batches[1][1] == [{"n": 3}]
+    assert writer.stats()['queue_depth'] == 0
+    assert writer.written == 3
+
+def test_close_writes_what_is_queued_and_later_writes_go_straight_through():
+    store = RecordingStore()
+    writer = WriteBehindStore(store, batch_size=100, flush_interval=10)
+    writer.add_texts(["queued"])
+    writer.close()
+    assert store.batches == [(["queued"], None)]
+    assert writer.add_texts(["direct"]) == ["0"]
+
+def test_failed_batches_are_retried():
+    store = RecordingStore(failures=1)
+    writer = WriteBehindStore(store, batch_size=1, flush_interval=10, retries=1)
+    try:
+        writer.add_texts(["retried"])
+        writer.flush()
+    finally:
+        writer.close()
+    assert store.batches == [(["retried"], None)]
+    assert writer.failures == 0
+
+def test_everything_else_goes_to_the_store():
+    store = RecordingStore()
+    writer = WriteBehindStore(store)
+    try:
+        writer.similarity_search("hello")
+    finally:
+        writer.close()
+    assert store.searched == 1
@@ -1,185 +1,114 @@
-from langchain.llms import LlamaCpp
-from langchain import PromptTemplate, LLMChain
-from langchain.callbacks.base import CallbackManager
-from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.vectorstores import Weaviate
 from dotenv import load_dotenv
-from server.streaming import StreamingWebsocketCallbackHandler
 import os
-from server.server import Server, SERVER_CODES, PromptRequest, PromptResponse
+from server.server import Server, SERVER_CODES, PromptRequest, PromptResponse, validate_prompt_request
+from server.protocol import validate_session_message
+from server.models import setup_registry
+from server.database import setup_memory, setup_compaction
+from server.startup import Startup
+from server.metrics import metrics
+from server.scheduler import GenerationCancelled
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+import asyncio
+import importlib
 import json
-import weaviate
+import logging
+import threading
+import websockets
 load_dotenv(".env") # load environment variables from ".env
-# import environment variables
-model_path = os.getenv("MODEL_PATH")
-
-# Start the server
-server = Server()
-
-count = 0
-running = False
-#Streaming reference
-streaming_callback = StreamingWebsocketCallbackHandler(server, -1)
-# Create the callback manager
-callback_manager = CallbackManager([ StreamingStdOutCallbackHandler()])
-
-# Load the model
-llm = LlamaCpp(
-    model_path=model_path,
-    callback_manager=callback_manager,
-    verbose=True,
-    streaming=True,
-)
 
-# Connect to weaviate
-WEAVIATE_URL = os.getenv("WEAVIATE_URL")
-client = weaviate.Client(
-    url=WEAVIATE_URL,
-    additional_headers={
-        'X-OpenAI-Api-Key': os.getenv("OPENAI_API_KEY"),
-    }
-)
+# Print the requests and the tokens, off in production: it slows the hot path
+echo = os.getenv("ECHO_TOKENS", "true").lower() == "true"
 
-# Check if the class Chat exists
-#client.schema.delete_all()
-client.schema.get()
-chat_exists = False
-for class_ in client.schema.get()['classes']:
-    if class_['class'] == 'Chat':
-        chat_exists = True
-        break
-
-if not chat_exists:
-    # Create the class
-    schema = {
-    "classes": [
-        {
-            "class": "Chat",
-            "description": "A chat between two people",
-            "vectorizer": "text2vec-openai",
-              "moduleConfig": {
-                "text2vec-openai": {
-                  "model": "ada",
-                  "modelVersion": "002",
-                  "type": "text"
-                }
-              },
-            "properties": [
-                {
-                    "dataType": ["text"],
-                    "description": "The content of the chat",
-                    "moduleConfig": {
-                        "text2vec-openai": {
-                          "skip": False,
-                          "vectorizePropertyName": False
-                        }
-                      },
-                    "name": "content",
-                },
-            ],
-        },
-        ]
-    }
-
-    client.schema.create(schema)
-# Create the vector store
-client.schema.get()
-vectorstore = Weaviate(client, "Chat", "content")
+# Start the server, a broadcast never waits for a slow client
+server = Server(
+    max_outbox=int(os.getenv("OUTBOX_SIZE", 256)),
+    overflow=os.getenv("OUTBOX_OVERFLOW", "drop"),
+)
+# The model and the database load in the background, the socket is bound right away
+startup = Startup()
+
+# The models are loaded on demand
+registry = setup_registry()
+# The chains block on the scheduler and the database, so they run here and not on the event loop
+chain_executor = ThreadPoolExecutor(max_workers=int(os.getenv("CHAIN_WORKERS", 8)), thread_name_prefix="chain")
+
+embeddings = None
+vectorstore = None
+compactor = None
+
+def setup_database():
+    """Load the embeddings and create the vector store."""
+    global embeddings, vectorstore
+    from server.embeddings import load_embeddings
+    # Load the embeddings, none means weaviate computes them
+    embeddings = load_embeddings(
+        os.getenv("EMBEDDINGS", "weaviate"),
+        os.getenv("EMBEDDINGS_MODEL"),
+        cache_path=os.getenv("EMBEDDINGS_CACHE_PATH"),
+        cache_max_bytes=int(os.getenv("EMBEDDINGS_CACHE_MAX_BYTES", 256 * 1024 * 1024)),
+    )
+    # Create the vector store with its caches, the memories are saved in the background
+    vectorstore = setup_memory(embeddings)
+
+def setup_compactor():
+    """Dedupe and summarize the memories in the background."""
+    global compactor
+    compactor = setup_compaction(vectorstore, registry)
+
+async def health_check(path, request_headers):
+    """Answer /health, /ready and /metrics over plain HTTP, every other path is a websocket."""
+    if path == "/health":
+        return HTTPStatus.OK, [("Content-Type", "application/json")], json.dumps({'status': 'ok'}).encode()
+    if path == "/metrics":
+        return HTTPStatus.OK, [("Content-Type", "text/plain; version=0.0.4")], metrics.render().encode()
+    if path == "/ready":
+        report = startup.report()
+        status = HTTPStatus.OK if report['ready'] else HTTPStatus.SERVICE_UNAVAILABLE
+        return status, [("Content-Type", "application/json")], json.dumps(report).encode()
+    return None
+
+# The chat sessions of the connected clients
+sessions = {}
+# The cancel events of the prompts running for the clients, and the messages that came while they ran
+cancels = {}
+queued = {}
+# The most messages a client can send while its prompt runs, the ones past it get an error
+MAX_QUEUED = 8
 
 def on_disconnect(client_id):
-    """Handle the disconnect event."""
-    global count
+    """Handle the disconnect event, the prompt of the client stops."""
+    sessions.pop(client_id, None)
+    dropped = queued.pop(client_id, None)
+    if dropped:
+        print("Client {} disconnected, dropped its {} queued messages".format(client_id, len(dropped)))
+    cancel = cancels.pop(client_id, None)
+    if cancel is not None:
+        cancel.set()
     print("Client {} disconnected".format(client_id))
-    count -= 1
-
-def validate_prompt_request(prompt_dictionary: dict) -> PromptRequest:
-    """Validate the prompt request."""
-    
-    # Check if the completed prompt is a string and in the dictionary
-    if "complete_prompt" not in prompt_dictionary or not isinstance(prompt_dictionary["complete_prompt"], str):
-        raise ValueError("Prompt must be a string")
-    prompt = prompt_dictionary["complete_prompt"]
-    # Check if the chat text is a dictionary
-    if "chat_text" not in prompt_dictionary or not isinstance(prompt_dictionary["chat_text"], dict):
-        raise ValueError("Chat text must be a dictionary")
-    chat_text = prompt_dictionary["chat_text"]
-    # Check if the args is a dictionary
-    if "args" not in prompt_dictionary or not isinstance(prompt_dictionary["args"], dict):
-        raise ValueError("Args must be a dictionary")
-    args = prompt_dictionary["args"]
-    # Check if the names is a dictionary
-    if "names" not in prompt_dictionary or not isinstance(prompt_dictionary["names"], dict):
-        raise ValueError("Names must be a dictionary")
-    names = prompt_dictionary["names"]
-
-    # Check if the chat is a dictionary
-    if "chat" not in prompt_dictionary or not isinstance(prompt_dictionary["chat"], dict):
-        raise ValueError("Chat must be a dictionary")
-    chat = prompt_dictionary["chat"]
-    return PromptRequest(
-        complete_prompt=prompt,
-        chat_text=chat_text,
-        args=args,
-        names=names,
-        chat=chat,
-    )
 
-def run_chain(client_id, prompt_request: PromptRequest) -> PromptResponse:
-    """Run a chain."""
-    global running
-    running = True
-    global llm
-    input_variables = []
-    input_variables.extend(list(prompt_request.names.keys()))
-    input_variables.extend(list(prompt_request.chat.keys()))
-    template = None
-    if prompt_request.args is not None:
-        input_variables.extend(list(prompt_request.args.keys()))
-        print(input_variables)
-        template = PromptTemplate(
-            template=prompt_request.complete_prompt,
-            input_variables=input_variables,
-        )
-    
-    streaming_callback.client_id = client_id
-    output = ""
-    # Create the chain
-    chain = LLMChain(
-        llm=llm,
-        prompt=template,
-        callback_manager=callback_manager,
-    )
+async def watch_cancel(server, client_id, cancel):
+    """Read the messages of the client while its prompt runs, until the prompt is done and the task is cancelled.
+        {"type": "cancel"} sets the cancel event of the prompt, any other message is kept for after it,
+        and a message that can not be read gets an error response. A client that goes away cancels the prompt.
+    """
+    try:
+        while True:
+            try:
+                message = await server.receive_request(client_id)
+            except ValueError as e:
+                await server.send_response(client_id, PromptResponse(status=SERVER_CODES['ERROR'], error=f"Invalid message: {e}"))
+                continue
+            if message.get("type") == "cancel":
+                cancel.set()
+            elif len(queued.setdefault(client_id, [])) >= MAX_QUEUED:
+                await server.send_response(client_id, PromptResponse(status=SERVER_CODES['ERROR'], error="Too many messages while the prompt runs"))
+            else:
+                queued[client_id].append(message)
+    except (websockets.exceptions.ConnectionClosed, KeyError, ValueError):
+        # The client is gone, nobody is waiting for the prompt
+        cancel.set()
 
-    # Get docs from the vector store
-    docs = vectorstore.similarity_search(
-        prompt_request.chat_text["user_name"].format(**prompt_request.chat, **prompt_request.names),
-        k=4)
-    history = []
-    for doc in docs:
-        history.append(doc.page_content)
-    prompt_request.args["history"] = history
-    # Run the chain
-    output = chain.run(**prompt_request.args, **prompt_request.names, **prompt_request.chat)
-    chat=prompt_request.chat
-    chat["ai_text"]+=output
-    complete_prompt = prompt_request.complete_prompt.format(**prompt_request.args, **prompt_request.names, **prompt_request.chat)
-    output=complete_prompt+output
-
-    # Create query
-    chat_text = prompt_request.chat_text
-    
-    text = f'{chat_text["user_name"]}\n{chat_text["ai_name"]}'.format(**prompt_request.chat, **prompt_request.names)
-    
-    # Save the embeddings to the database
-    result=vectorstore.add_texts([text])
-    print(result)
-    # Create the response
-    response = PromptResponse(status=SERVER_CODES['SUCCESS'], prompt=output, chat=chat)
-    
-    # Return the response
-    return response
-    
 async def server_handler(server, ws, uri, client_id):
     """
     It must return one of the following codes:
@@ -187,27 +116,132 @@ async def server_handler(server, ws, uri, client_id):
     SERVER_CODES['ERROR'] - if there was an error and wants to end the connection
     SERVER_CODES['RUNNING'] - if the request was successful and wants to keep the connection open
     This is where you would run the chain and send the output to the client
-    """
-    global count
-    global running
-    count += 1
-    if count>1 and not running:
-        # Disconnect the client
-        await server.disconnect(client_id)
-        return SERVER_CODES['SUCCESS']
-    
-    # Get the prompt request
-    prompt_request = json.loads(await server.receive(client_id))
-    print(prompt_request)
-    prompt_request = validate_prompt_request(prompt_request)
-
-    # LLM stuff
-    prompt_response=run_chain(client_id, prompt_request)
-
-    # Send the response
-    await server.send_to_client(client_id, prompt_response.to_json())
-    return SERVER_CODES['SUCCESS']
 
+    A request with session true starts a chat session: the connection stays open and every later
+    message only has the new user text, {"user_text": str}, and gets only the new ai text back.
+    {"type": "end"} ends the session.
 
-server.on_disconnect = on_disconnect
-server.start('localhost', 9001, server_handler)
\ No newline at end of file
+    {"type": "cancel"} stops the running prompt: the generation stops within a token, nothing is
+    saved and the last response has the status cancelled. A client that disconnects does the same.
+    """
+    # Get the prompt request, or the next message of the session
+    if queued.get(client_id):
+        message = queued[client_id].pop(0)
+    else:
+        try:
+            message = await server.receive_request(client_id)
+        except ValueError as e:
+            # A message that can not be read gets an error, the connection stays open
+            await server.send_response(client_id, PromptResponse(status=SERVER_CODES['ERROR'], error=f"Invalid message: {e}"))
+            metrics.inc("errors_total")
+            return SERVER_CODES['RUNNING']
+    if message.get("type") == "cancel":
+        # Nothing is running, the prompt it was for is already done
+        return SERVER_CODES['RUNNING']
+    metrics.inc("requests_total")
+    if echo:
+        print(message)
+    session = sessions.get(client_id)
+    if session is None:
+        # The websocket server always used the memory and saved the chat
+        prompt_request = validate_prompt_request(message, save=True, memory=True)
+        user_text = prompt_request.chat.get('user_text', "")
+    elif message.get("type") == "end":
+        sessions.pop(client_id, None)
+        return SERVER_CODES['SUCCESS']
+    else:
+        prompt_request = session.request
+        try:
+            user_text = validate_session_message(message)
+        except ValueError as e:
+            # A bad turn does not end the session
+            await server.send_response(client_id, PromptResponse(status=SERVER_CODES['ERROR'], error=f"Invalid message: {e}"))
+            metrics.inc("errors_total")
+            return SERVER_CODES['RUNNING']
+
+    # A prompt that comes in while the server starts waits for it
+    loop = asyncio.get_running_loop()
+    if not await loop.run_in_executor(None, startup.wait, float(os.getenv("STARTUP_WAIT_TIMEOUT", 120))):
+        error = "The server failed to start" if startup.error is not None else "The server is starting"
+        await server.send_response(client_id, PromptResponse(status=SERVER_CODES['ERROR'], error=error))
+        metrics.inc("errors_total")
+        return SERVER_CODES['ERROR']
+    from server.chain import ChatSession, run_chain, run_session
+    from server.streaming import StreamingWebsocketCallbackHandler
+    if session is None and prompt_request.session:
+        session = sessions[client_id] = ChatSession(prompt_request)
+
+    # LLM stuff, the chain runs in the executor and the scheduler queues the prompt behind the other clients
+    streaming = StreamingWebsocketCallbackHandler(
+        server, client_id, loop=loop,
+        interval=int(os.getenv("STREAM_INTERVAL_MS", 20)) / 1000,
+        max_tokens=int(os.getenv("STREAM_MAX_TOKENS", 16)),
+        max_pending=int(os.getenv("STREAM_MAX_PENDING", 65536)),
+    )
+    # A cancel message, or the client going away, stops the generation
+    cancel = cancels[client_id] = threading.Event()
+    def chain_job():
+        # The model stays loaded until the chain is done, even if another one replaces it
+        with registry.lease(prompt_request.model) as scheduler:
+            if session is not None:
+                return run_session(session, user_text, scheduler, vectorstore,
+                                   on_token=streaming.on_llm_new_token, cancel=cancel)
+            return run_chain(prompt_request, scheduler, vectorstore, on_token=streaming.on_llm_new_token, cancel=cancel)
+    def chain_done(future):
+        streaming.close()
+        # A chain whose client left has nobody to raise its error to
+        if not future.cancelled():
+            future.exception()
+    chain = loop.run_in_executor(chain_executor, chain_job)
+    chain.add_done_callback(chain_done)
+    watcher = asyncio.ensure_future(watch_cancel(server, client_id, cancel))
+
+    try:
+        # Send the tokens while they get generated
+        await streaming.stream()
+        prompt_response = await chain
+    except GenerationCancelled:
+        prompt_response = PromptResponse(status=SERVER_CODES['CANCELLED'], error="Cancelled")
+    except Exception as e:
+        # The chain failed, the client gets an error and a session goes on
+        logging.error(e)
+        metrics.inc("errors_total")
+        prompt_response = PromptResponse(status=SERVER_CODES['ERROR'], error="Internal Server Error or Invalid Request")
+    finally:
+        # However the prompt ended, nothing keeps decoding for it
+        cancel.set()
+        watcher.cancel()
+        cancels.pop(client_id, None)
+
+    # Send the response, a session keeps the connection for its next turn
+    await server.send_response(client_id, prompt_response)
+    return SERVER_CODES['RUNNING'] if session is not None else SERVER_CODES['SUCCESS']
+
+
+def main():
+    """Load everything in the background and serve until stopped."""
+    imports = startup.run("imports", lambda: [importlib.import_module(name) for name in ("server.chain", "server.streaming")])
+    # The default model (MODEL_PATH) is loaded right away
+    model = startup.run("model", lambda: registry.set_default(registry.default))
+    memory = startup.run("memory", setup_database)
+    compaction = startup.run("compaction", setup_compactor, after=[model, memory])
+    startup.complete(imports, model, memory, compaction)
+
+    server.on_disconnect = on_disconnect
+    try:
+        # permessage-deflate is offered unless WS_COMPRESSION is none
+        compression = None if os.getenv("WS_COMPRESSION", "deflate").lower() == "none" else "deflate"
+        server.start('localhost', 9001, server_handler, process_request=health_check, compression=compression)
+    except KeyboardInterrupt:
+        print("Stopping server")
+    finally:
+        if compactor is not None:
+            compactor.close()
+        # Write the memories still queued
+        if vectorstore is not None:
+            vectorstore.close()
+        registry.close()
+        print("Server closed")
+
+if __name__ == "__main__":
+    main()